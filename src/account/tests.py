@@ -1,3 +1,157 @@
-from django.test import TestCase
+import json
+from types import SimpleNamespace
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.test import TestCase, TransactionTestCase
+from rest_framework.test import APIClient
+from rest_framework_jwt.settings import api_settings
+
+from account.models import Account
+from codenames_api.channels_middleware import JwtTokenAuthMiddleware, get_token, get_user_cache
+from codenames_api.testing import QueryBudgetMixin, seed_accounts, seed_friends, seed_friend_requests
+
+
+class AccountEndpointsQueryBudgetTest(QueryBudgetMixin, TestCase):
+    """
+    The account endpoints must not run more queries when there are more accounts,
+    friends or friend requests: at each size, 2 * size accounts, size friends,
+    size / 2 friend requests.
+    """
+
+    def seed_fixture(self, size):
+        accounts = seed_accounts(2 * size, prefix=f"size{size}-")
+        user, friends = accounts[0], accounts[1:size + 1]
+        seed_friends(user, friends)
+        seed_friend_requests(user, accounts[size + 1:size + 1 + size // 2])
+        self.client.force_authenticate(user)
+        return SimpleNamespace(size=size, accounts=accounts, user=user, friends=friends)
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def get(self, url, endpoint, budget):
+        with self.assertQueryBudget(endpoint, budget):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)
+
+    def test_all(self):
+        for fixture in self.sized_fixtures():
+            data = self.get('/api/account/all/', 'account:all', 2)['data']
+            self.assertEqual(len(data), Account.objects.count())
+            self.assertEqual(sum(account['is_friend'] for account in data), fixture.size)
+            self.assertEqual([account['username'] for account in data], sorted(account['username'] for account in data))
+
+    def test_search(self):
+        for fixture in self.sized_fixtures():
+            query = f"size{fixture.size}-1"
+            data = self.get(f'/api/account/search/?q={query}', 'account:search', 2)['data']
+            self.assertEqual(len(data), sum(account.username.startswith(query) for account in fixture.accounts))
+            self.assertEqual(sum(account['is_friend'] for account in data), sum(friend.username.startswith(query) for friend in fixture.friends))
+
+    def test_profile(self):
+        for fixture in self.sized_fixtures():
+            data = self.get('/api/account/profile/', 'account:profile', 4)['data']
+            self.assertEqual(len(data['friend_list']), fixture.size)
+            self.assertEqual(len(data['friend_requests']), fixture.size // 2)
+
+    def test_detail_self(self):
+        for fixture in self.sized_fixtures():
+            data = self.get(f'/api/account/{fixture.user.id}/', 'account:detail (self)', 4)['data']
+            self.assertTrue(data['is_self'])
+            self.assertEqual(len(data['friend_requests']), fixture.size // 2)
+
+    def test_detail_friend(self):
+        for fixture in self.sized_fixtures():
+            data = self.get(f'/api/account/{fixture.friends[0].id}/', 'account:detail (friend)', 4)['data']
+            self.assertTrue(data['is_friend'])
+
+    def test_detail_stranger(self):
+        for fixture in self.sized_fixtures():
+            data = self.get(f'/api/account/{fixture.accounts[-1].id}/', 'account:detail (stranger)', 6)['data']
+            self.assertFalse(data['is_friend'])
+
+
+class AccountMutationsQueryBudgetTest(QueryBudgetMixin, TestCase):
+    """
+    Registering, logging in and editing an account must not run more queries
+    when there are more accounts or friends: at each size, 2 * size accounts,
+    size friends.
+    """
+
+    def seed_fixture(self, size):
+        accounts = seed_accounts(2 * size, prefix=f"size{size}-")
+        seed_friends(accounts[0], accounts[1:size // 2 + 1])
+        user = Account.objects.create_user(f"player{size}@codenames.com", f"player{size}", "password")
+        seed_friends(user, accounts[size:2 * size])
+        return SimpleNamespace(size=size, user=user)
+
+    def test_register(self):
+        client = APIClient()
+        for fixture in self.sized_fixtures():
+            with self.assertQueryBudget('account:register', 11):
+                response = client.post('/api/account/register/', {'email': f"new{fixture.size}@codenames.com", 'username': f"new{fixture.size}", 'password': "password"}, format='json')
+            self.assertEqual(response.status_code, 201)
+            self.assertTrue(json.loads(response.data)['token'])
+
+    def test_login(self):
+        client = APIClient()
+        for fixture in self.sized_fixtures():
+            with self.assertQueryBudget('account:login', 4):
+                response = client.post('/api/account/login/', {'email': fixture.user.email, 'password': "password"}, format='json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data)['user']['username'], fixture.user.username)
+
+    def test_edit(self):
+        client = APIClient()
+        for fixture in self.sized_fixtures():
+            client.force_authenticate(fixture.user)
+            with self.assertQueryBudget('account:edit', 4):
+                response = client.post('/api/account/edit/', {'email': fixture.user.email, 'username': f"renamed{fixture.size}", 'hide_email': True}, format='json')
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(Account.objects.get(id=fixture.user.id).username, f"renamed{fixture.size}")
+
+
+class JwtTokenAuthMiddlewareTest(TransactionTestCase):
+    """
+    Websocket handshake authentication: the user is read once per token, until the account changes.
+    (database_sync_to_async closes the connection, no TestCase transaction)
+    """
+
+    def setUp(self):
+        self.user = seed_accounts(1)[0]
+        self.token = api_settings.JWT_ENCODE_HANDLER(api_settings.JWT_PAYLOAD_HANDLER(self.user))
+        get_user_cache().clear()
+        self.middleware = JwtTokenAuthMiddleware(None)
+
+    def authenticate(self, cookie):
+        return async_to_sync(self.middleware.authenticate)([(b'host', b'localhost'), (b'cookie', cookie.encode())])
+
+    def test_get_token(self):
+        self.assertEqual(get_token([(b'cookie', f"theme=dark; authorization=Bearer {self.token}; lang=fr".encode())]), self.token)
+        self.assertEqual(get_token([(b'cookie', f"authorization=Bearer%20{self.token}".encode())]), self.token)
+        self.assertEqual(get_token([(b'cookie', b"theme=dark"), (b'cookie', f'authorization="Bearer {self.token}"'.encode())]), self.token)
+        self.assertIsNone(get_token([(b'cookie', f"authorization={self.token}".encode())]))
+        self.assertIsNone(get_token([(b'cookie', b"authorization=Bearer ")]))
+        self.assertIsNone(get_token([(b'host', b'localhost')]))
+
+    def test_cached_user(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.authenticate(f"authorization=Bearer {self.token}"), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.authenticate(f"authorization=Bearer {self.token}"), self.user)
+
+    def test_invalid_token(self):
+        with self.assertNumQueries(0):
+            self.assertTrue(self.authenticate(f"authorization=Bearer {self.token}x").is_anonymous)
+            self.assertTrue(self.authenticate("authorization=Bearer not.a.token").is_anonymous)
+
+    def test_account_change_invalidates(self):
+        self.authenticate(f"authorization=Bearer {self.token}")
+        self.user.is_active = False
+        self.user.save()
+        with self.assertNumQueries(1):
+            self.assertTrue(self.authenticate(f"authorization=Bearer {self.token}").is_anonymous)
+        self.user.is_active = True
+        self.user.save()
+        self.assertEqual(self.authenticate(f"authorization=Bearer {self.token}"), self.user)
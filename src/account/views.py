@@ -19,7 +19,7 @@ from account.serializers import (
 from account.models import Account
 
 from friend.models import FriendList, FriendRequest
-from friend.utils import get_friend_request_or_false
+from friend.utils import get_friend_request_or_false, get_friend_ids
 from friend.friend_request_status import FriendRequestStatus
 from friend.serializers import FriendListSerializer, FriendRequestSerializer
 
@@ -227,24 +227,20 @@ class AccountSearchView(RetrieveAPIView):
         accounts = []
         if len(search_query) != 0:
             search_result = Account.objects.filter(Q(email__icontains=search_query) | Q(username__icontains=search_query)).distinct()
+            # friends of the authenticated user, fetched once for all the results
+            friend_ids = get_friend_ids(request.user)
             for account in search_result:
                 serialized_account = self.serializer_class(account).data
                 if account.id == request.user.id:
                     serialized_account['is_self'] = True
                 else:
                     serialized_account['is_self'] = False
-                # get the friend list of the authenticated user
-                try:
-                    friend_list = FriendList.objects.get(user=request.user)
-                except FriendList.DoesNotExist:
-                    # TODO check what we wanna do here
-                    serialized_account['is_friend'] = False
-                if account in friend_list.friends.all():
+                if account.id in friend_ids:
                     serialized_account['is_friend'] = True
                 else: 
                     serialized_account['is_friend'] = False
                 accounts.append(serialized_account)
-                accounts = sorted(accounts, key= lambda i: (i['username']))
+            accounts = sorted(accounts, key= lambda i: (i['username']))
         status_code = status.HTTP_200_OK  
         response = JSONRenderer().render({
                 'success': True,
@@ -264,24 +260,20 @@ class AccountAllView(RetrieveAPIView):
     def get(self, request):
         accounts = []
         search_result = Account.objects.filter()
+        # friends of the authenticated user, fetched once for all the accounts
+        friend_ids = get_friend_ids(request.user)
         for account in search_result:
             serialized_account = self.serializer_class(account).data
             if account.id == request.user.id:
                 serialized_account['is_self'] = True
             else:
                 serialized_account['is_self'] = False
-            # get the friend list of the authenticated user
-            try:
-                friend_list = FriendList.objects.get(user=request.user)
-            except FriendList.DoesNotExist:
-                # TODO check what we wanna do here
-                serialized_account['is_friend'] = False
-            if account in friend_list.friends.all():
+            if account.id in friend_ids:
                 serialized_account['is_friend'] = True
             else: 
                 serialized_account['is_friend'] = False
             accounts.append(serialized_account)
-            accounts = sorted(accounts, key= lambda i: (i['username']))
+        accounts = sorted(accounts, key= lambda i: (i['username']))
         status_code = status.HTTP_200_OK  
         response = JSONRenderer().render({
                 'success': True,
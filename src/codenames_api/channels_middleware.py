@@ -1,32 +1,190 @@
+import asyncio
+import time
+from collections import OrderedDict
+from urllib.parse import unquote
 
-from rest_framework_jwt.serializers import VerifyJSONWebTokenSerializer
+import jwt
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
+from django.db.models.signals import post_delete, post_save
+from django.http.cookie import parse_cookie
+from rest_framework_jwt.settings import api_settings
 
+from codenames_api.log import get_logger
+from codenames_api.metrics import metered_database_sync_to_async
 
-class JwtTokenAuthMiddleware:
+
+log = get_logger(__name__)
+
+AUTH_COOKIE = 'authorization'
+
+DEFAULT_WEBSOCKET_AUTH_CACHE = {
+    'TTL': 60,              # seconds a loaded user is trusted without a database query
+    'MAX_ENTRIES': 10000,
+}
+
+
+def get_auth_cache_config():
+    config = dict(DEFAULT_WEBSOCKET_AUTH_CACHE)
+    config.update(getattr(settings, 'WEBSOCKET_AUTH_CACHE', {}))
+    return config
+
+
+class UserCache:
+    """
+    Process local TTL cache of the users authenticated by a token, keyed by (user id, token)
+    (None for a token whose user does not exist anymore or is disabled).
+    Concurrent handshakes with the same token wait for a single database lookup.
+    Only used from the event loop: no lock, the dicts are never touched across an await.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # (user id, token) -> (expires, user or None)
+        self.entries = OrderedDict()
+        # (user id, token) -> Future of the lookup in progress
+        self.loading = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, user_id, token, load):
+        """
+        the cached user, or the result of await load() (cached)
+        """
+        key = (user_id, token)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+        self.misses += 1
+        future = self.loading.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = self.loading[key] = asyncio.get_event_loop().create_future()
+        try:
+            user = await load()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # retrieved, no "exception was never retrieved" warning without waiters
+            future.exception()
+            raise
+        else:
+            future.set_result(user)
+            # invalidated during the lookup: do not cache a user read before the change
+            if self.loading.get(key) is future:
+                self.set(key, user)
+            return user
+        finally:
+            if self.loading.get(key) is future:
+                del self.loading[key]
+
+    def set(self, key, user):
+        self.entries[key] = (time.monotonic() + self.ttl, user)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """
+        forget every token of the user, and the lookups in progress
+        """
+        for key in [key for key in self.entries if key[0] == user_id]:
+            del self.entries[key]
+        for key in [key for key in self.loading if key[0] == user_id]:
+            del self.loading[key]
+
+    def clear(self):
+        self.entries.clear()
+        self.loading.clear()
+
+
+_user_cache = None
+
+
+def get_user_cache():
+    global _user_cache
+    if _user_cache is None:
+        config = get_auth_cache_config()
+        _user_cache = UserCache(config['TTL'], config['MAX_ENTRIES'])
+    return _user_cache
+
+
+def invalidate_user(user_id):
+    """
+    Called when an account changes (saved or deleted): its next handshake reloads it.
+    Process local, a change made by another process is seen after the TTL at most.
+    """
+    if _user_cache is not None:
+        _user_cache.invalidate(user_id)
+
+
+def account_changed(sender, instance, **kwargs):
+    invalidate_user(instance.pk)
+
+
+post_save.connect(account_changed, sender=settings.AUTH_USER_MODEL, dispatch_uid='websocket_auth_account_saved')
+post_delete.connect(account_changed, sender=settings.AUTH_USER_MODEL, dispatch_uid='websocket_auth_account_deleted')
+
+
+def get_token(headers):
     """
-    JWT token authorization middleware for Django Channels 2
+    The JWT of the "authorization=Bearer <token>" cookie, None without one
     """
+    cookies = {}
+    for name, value in headers:
+        if name == b'cookie':
+            cookies.update(parse_cookie(value.decode('latin1')))
+    value = unquote(cookies.get(AUTH_COOKIE, '')).strip()
+    prefix, _, token = value.partition(' ')
+    if prefix.lower() != api_settings.JWT_AUTH_HEADER_PREFIX.lower() or not token.strip():
+        return None
+    return token.strip()
+
 
-    inner = None
+class JwtTokenAuthMiddleware(BaseMiddleware):
+    """
+    JWT token authorization middleware for Django Channels 3.
+    The signature is checked on the event loop (no database), the user comes from
+    the UserCache and is only read from the database on a miss, in a thread.
+    scope['user'] is AnonymousUser for a missing, invalid or expired token.
+    """
 
-    def __init__(self, inner):
-        self.inner = inner
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        scope['user'] = await self.authenticate(scope.get('headers', ()))
+        return await super().__call__(scope, receive, send)
 
-    def __call__(self, scope, receive, send):
+    async def authenticate(self, headers):
+        token = get_token(headers)
+        if token is None:
+            return AnonymousUser()
         try:
-            coockies = str(dict(scope['headers'])[b'cookie']).split(';')
-            token = ''
-            for coockie in coockies:
-                if 'authorization=' in coockie:
-                    token = coockie.split('=')
-                    token = token[-1] if token[-1][-1] != "'" else token[-1][:-1]
-            # split the bearer tag
-            token_header = token.split(" ")[1]
-            data = {'token': token_header}
-            valid_data = VerifyJSONWebTokenSerializer().validate(data)
-            user = valid_data['user']
-            scope['user'] = user
-        except:
-            scope['user'] = AnonymousUser()
-        return self.inner(scope, receive, send)
\ No newline at end of file
+            payload = api_settings.JWT_DECODE_HANDLER(token)
+        except jwt.InvalidTokenError as e:
+            log.info("websocket_auth_rejected", reason=str(e))
+            return AnonymousUser()
+        user_id = payload.get('user_id')
+        username = api_settings.JWT_PAYLOAD_GET_USERNAME_HANDLER(payload)
+        if user_id is None or not username:
+            log.info("websocket_auth_rejected", reason="Invalid payload.")
+            return AnonymousUser()
+        user = await get_user_cache().get(user_id, token, lambda: get_active_user(user_id, username))
+        return user if user is not None else AnonymousUser()
+
+
+@metered_database_sync_to_async
+def get_active_user(user_id, username):
+    """
+    The active user of the token, the username of the token must still be the user's
+    """
+    user = get_user_model().objects.filter(pk=user_id).first()
+    if user is None or not user.is_active or user.get_username() != username:
+        return None
+    return user
@@ -0,0 +1,78 @@
+import json
+import logging
+
+
+class StructuredLogger:
+    """
+    logging.Logger taking the event fields as keyword arguments:
+        log.debug("join_room", room_id=room_id, user_id=user.id)
+    Nothing is formatted and no record is built when the level is disabled.
+    On the per message paths, check is_enabled() first to skip building the fields too.
+    The level of each subsystem (logger name, ex: public_chat.consumers) can be
+    changed at runtime with set_log_level or the log level endpoint.
+    """
+
+    def __init__(self, name):
+        self.logger = logging.getLogger(name)
+
+    def is_enabled(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def log(self, level, event, exc_info=False, **fields):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, event, exc_info=exc_info, extra={'fields': fields})
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self.log(logging.ERROR, event, **fields)
+
+    def exception(self, event, **fields):
+        self.log(logging.ERROR, event, exc_info=True, **fields)
+
+
+def get_logger(name):
+    return StructuredLogger(name)
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    One JSON object per line: time, level, logger, event and the event fields
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def get_log_levels(prefixes=('public_chat', 'private_chat')):
+    """
+    {logger name: effective level name} of the chat subsystems
+    """
+    names = [name for name in logging.root.manager.loggerDict if name.split('.')[0] in prefixes]
+    return {name: logging.getLevelName(logging.getLogger(name).getEffectiveLevel()) for name in sorted(set(names) | set(prefixes))}
+
+
+def set_log_level(name, level):
+    """
+    Change the level of a subsystem logger (and its children) in this process.
+    Raise ValueError on an unknown level.
+    """
+    if not isinstance(logging.getLevelName(str(level).upper()), int):
+        raise ValueError(f"Unknown log level: {level}")
+    logging.getLogger(name).setLevel(str(level).upper())
@@ -0,0 +1,329 @@
+import functools
+import threading
+import time
+import weakref
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+from public_chat.constants import CHAT_COMMANDS
+
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+class Metric:
+    """
+    Base of the in-process metrics: one value per set of label values.
+    Values are kept per process (per Daphne worker), Prometheus sums them.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        labels = ','.join('{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs)
+        return '{' + labels + '}'
+
+    def samples(self):
+        with self.lock:
+            return [(self.name + self.format_labels(key), value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines += [f"{sample} {value}" for sample, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+    function = None
+
+    def set_function(self, function):
+        """
+        Compute the value at each scrape instead: function() returns the value,
+        or {label values tuple: value} for a gauge with labels
+        """
+        self.function = function
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        values = self.function()
+        if not self.labelnames:
+            values = {(): values}
+        return [(self.name + self.format_labels(tuple(str(label) for label in key)), value) for key, value in values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            # [count per bucket..., count, sum]
+            values = self.values.get(key)
+            if values is None:
+                values = self.values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += 1
+            values[-1] += value
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, values in self.values.items():
+                for bound, count in zip(self.buckets, values):
+                    samples.append((self.name + '_bucket' + self.format_labels(key, [('le', str(bound))]), count))
+                samples.append((self.name + '_bucket' + self.format_labels(key, [('le', '+Inf')]), values[-2]))
+                samples.append((self.name + '_count' + self.format_labels(key), values[-2]))
+                samples.append((self.name + '_sum' + self.format_labels(key), values[-1]))
+        return samples
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+registry = Registry()
+
+WEBSOCKET_CONNECTIONS = registry.register(Gauge(
+    'chat_websocket_connections', "Open websockets of this process by type of the rooms joined, 'public' or 'private' "
+    "(a multiplexed socket counts once per type, 'none' before its first join)", ['consumer', 'room_type']))
+WEBSOCKET_MESSAGES_RECEIVED = registry.register(Counter(
+    'chat_websocket_messages_received_total', "Websocket frames received from the clients", ['consumer']))
+WEBSOCKET_MESSAGES_SENT = registry.register(Counter(
+    'chat_websocket_messages_sent_total', "Websocket frames written to the clients", ['consumer']))
+COMMAND_DURATION = registry.register(Histogram(
+    'chat_command_duration_seconds', "Handling time of the websocket commands", ['consumer', 'command']))
+CHANNEL_LAYER_SEND_DURATION = registry.register(Histogram(
+    'chat_channel_layer_send_seconds', "Duration of the channel layer group_send calls", ['type']))
+DATABASE_CALL_DURATION = registry.register(Histogram(
+    'chat_database_call_seconds', "Duration of the database_sync_to_async calls, in the thread", ['function']))
+THREAD_POOL_WAIT = registry.register(Histogram(
+    'chat_thread_pool_wait_seconds', "Time a database_sync_to_async call waits for a thread", ['function']))
+GROUP_FANOUT_DURATION = registry.register(Histogram(
+    'chat_group_fanout_seconds', "Duration of a sharded room fan-out, every sub-group included", ['shards']))
+GROUP_FANOUT_ROUND_TRIPS = registry.register(Histogram(
+    'chat_group_fanout_round_trips', "Redis round trip sequences of a sharded room fan-out: shard count read + one group_send per sub-group",
+    ['shards'], buckets=(1, 2, 3, 5, 9, 17, 33, 65)))
+LOCAL_FANOUT_DELIVERIES = registry.register(Counter(
+    'chat_local_fanout_deliveries_total', "Group events handed by the relay to the local members, sent by this process (local) or another one (relay)", ['source']))
+LOCAL_FANOUT_REMOTE_SENDS = registry.register(Counter(
+    'chat_local_fanout_layer_sends_total', "Group events sent once through the channel layer for every process"))
+CONNECTED_USER_COUNT_SENT = registry.register(Counter(
+    'chat_connected_user_count_sent_total', "Connected user count updates sent to a room"))
+CONNECTED_USER_COUNT_SUPPRESSED = registry.register(Counter(
+    'chat_connected_user_count_suppressed_total', "Connected user count updates replaced by a later one during their window"))
+CONNECTED_USER_COUNT_PENDING_GROUPS = registry.register(Gauge(
+    'chat_connected_user_count_pending_groups', "Rooms with a connected user count update waiting for the end of its window"))
+WRITE_BEHIND_DEPTH = registry.register(Gauge(
+    'chat_write_behind_depth', "Chat messages broadcast and not saved yet", ['model']))
+WRITE_BEHIND_FLUSHED = registry.register(Counter(
+    'chat_write_behind_flushed_total', "Chat messages saved by a write-behind batch", ['model']))
+WRITE_BEHIND_REQUEUED = registry.register(Counter(
+    'chat_write_behind_requeued_total', "Chat messages put back in the write-behind buffer after a failed batch", ['model']))
+WRITE_BEHIND_DIRECT_INSERTS = registry.register(Counter(
+    'chat_write_behind_direct_inserts_total', "Chat messages inserted right away, the write-behind buffer being full", ['model']))
+WRITE_BEHIND_FAILED_FLUSHES = registry.register(Counter(
+    'chat_write_behind_failed_flushes_total', "Write-behind batch inserts that failed (each retry counts)", ['model']))
+WRITE_BEHIND_DROPPED = registry.register(Counter(
+    'chat_write_behind_dropped_total', "Chat messages lost, the insert at exit failed", ['model']))
+RECENT_MESSAGES_LOOKUPS = registry.register(Counter(
+    'chat_recent_messages_lookups_total', "Lookups of the recent messages rings of the rooms", ['result']))
+RECENT_MESSAGES_REBUILDS_SKIPPED = registry.register(Counter(
+    'chat_recent_messages_rebuilds_skipped_total', "Ring rebuilds skipped, a message was appended during the database read"))
+OUTBOUND_DROPPED = registry.register(Counter(
+    'chat_outbound_dropped_total', "Frames dropped from a full websocket outbound queue", ['consumer']))
+OUTBOUND_COALESCED = registry.register(Counter(
+    'chat_outbound_coalesced_total', "Frames replacing a frame with the same key waiting in the outbound queue", ['consumer']))
+OUTBOUND_SLOW_DISCONNECTS = registry.register(Counter(
+    'chat_outbound_slow_disconnects_total', "Websockets closed because their outbound queue was full", ['consumer']))
+OUTBOUND_TRANSPORT_PAUSES = registry.register(Counter(
+    'chat_outbound_transport_pauses_total', "Times an outbound queue waited for the transport buffer of its socket to drain", ['consumer']))
+OUTBOUND_QUEUED_FRAMES = registry.register(Gauge(
+    'chat_outbound_queued_frames', "Frames waiting in the outbound queues of the open websockets", ['consumer']))
+OUTBOUND_DEEPEST_QUEUE = registry.register(Gauge(
+    'chat_outbound_deepest_queue', "Frames waiting in the deepest outbound queue", ['consumer']))
+OUTBOUND_PAUSED_SOCKETS = registry.register(Gauge(
+    'chat_outbound_paused_sockets', "Open websockets waiting for their transport buffer to drain", ['consumer']))
+MESSAGE_BATCH_SIZE = registry.register(Histogram(
+    'chat_message_batch_size', "New messages per batch sent to a socket with a batching window", ['consumer'],
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250)))
+MESSAGE_BATCH_DELAY = registry.register(Histogram(
+    'chat_message_batch_delay_seconds', "Time the first message of a batch waited to be sent", ['consumer'],
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1)))
+HTTP_REQUEST_DURATION = registry.register(Histogram(
+    'http_request_duration_seconds', "Duration of the REST views", ['view', 'method', 'status']))
+
+
+def command_label(command):
+    """
+    The command of a websocket frame as a label, client input is not trusted as a label value
+    """
+    return command if command in CHAT_COMMANDS else 'unknown'
+
+
+async def group_send(channel_layer, group_name, event):
+    """
+    channel_layer.group_send, timed
+    """
+    start = time.perf_counter()
+    try:
+        await channel_layer.group_send(group_name, event)
+    finally:
+        CHANNEL_LAYER_SEND_DURATION.observe(time.perf_counter() - start, type=event['type'])
+
+
+def metered_database_sync_to_async(func):
+    """
+    database_sync_to_async, timing the wait for a thread of the pool and the call itself
+    """
+    name = func.__name__
+
+    def run(submitted, *args, **kwargs):
+        started = time.perf_counter()
+        THREAD_POOL_WAIT.observe(started - submitted, function=name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            DATABASE_CALL_DURATION.observe(time.perf_counter() - started, function=name)
+
+    run_in_thread = database_sync_to_async(run)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_in_thread(time.perf_counter(), *args, **kwargs)
+    return wrapper
+
+
+# every open websocket of a consumer with ConsumerMetricsMixin
+open_sockets = weakref.WeakSet()
+
+
+def count_open_sockets():
+    """
+    Gauge function of WEBSOCKET_CONNECTIONS: open sockets per consumer and room type
+    """
+    # scraped from a thread while the event loop opens sockets and joins rooms
+    while True:
+        try:
+            counts = {}
+            for consumer in list(open_sockets):
+                for room_type in consumer.metrics_room_types() or ('none',):
+                    key = (consumer.metrics_label, room_type)
+                    counts[key] = counts.get(key, 0) + 1
+            return counts
+        except RuntimeError:
+            pass
+
+
+WEBSOCKET_CONNECTIONS.set_function(count_open_sockets)
+
+
+class ConsumerMetricsMixin:
+    """
+    Connections, frames in and frames out of a websocket consumer,
+    metrics_label names the consumer ('public_chat', 'private_chat'),
+    metrics_room_types() the types of the rooms the socket joined.
+    Placed after OutboundQueueMixin, only the frames really written are counted.
+    """
+    metrics_label = None
+
+    def metrics_room_types(self):
+        return ()
+
+    async def websocket_connect(self, message):
+        open_sockets.add(self)
+        await super().websocket_connect(message)
+
+    async def websocket_receive(self, message):
+        WEBSOCKET_MESSAGES_RECEIVED.inc(consumer=self.metrics_label)
+        await super().websocket_receive(message)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        WEBSOCKET_MESSAGES_SENT.inc(consumer=self.metrics_label)
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+
+    async def websocket_disconnect(self, message):
+        open_sockets.discard(self)
+        await super().websocket_disconnect(message)
+
+
+class MetricsMiddleware:
+    """
+    Duration of every REST request, labelled by view name
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        match = request.resolver_match
+        HTTP_REQUEST_DURATION.observe(
+            time.perf_counter() - start,
+            view=match.view_name if match else 'unresolved',
+            method=request.method,
+            status=response.status_code,
+        )
+        return response
+
+
+def metrics_view(request):
+    """
+    Prometheus text format, only for the addresses of settings.METRICS_ALLOWED_IPS
+    """
+    if request.META.get('REMOTE_ADDR') not in getattr(settings, 'METRICS_ALLOWED_IPS', ('127.0.0.1', '::1')):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
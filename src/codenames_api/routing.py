@@ -13,6 +13,7 @@ from django.conf import settings
 from codenames_api.channels_middleware import JwtTokenAuthMiddleware
 from public_chat.consumers import PublicChatConsumer
 from private_chat.consumers import PrivateChatConsumer
+from public_chat.multiplex import MultiplexChatConsumer
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'codenames_api.settings')
 django.setup()
@@ -24,6 +25,8 @@ application = ProtocolTypeRouter({
 			URLRouter([
 				path("public-chat/<room_id>/", PublicChatConsumer.as_asgi()),
 				path("private-chat/<room_id>/", PrivateChatConsumer.as_asgi()),
+				# every room of the user on one socket, see MultiplexChatConsumer
+				path("chat/", MultiplexChatConsumer.as_asgi()),
 			])
 		)
 	),
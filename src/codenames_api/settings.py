@@ -57,6 +57,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'codenames_api.metrics.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -92,6 +93,9 @@ ASGI_APPLICATION = 'codenames_api.routing.application'
 
 # Redis
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
+# Process local fan-out (see public_chat.local_fanout): same CONFIG with
+#   'BACKEND': 'public_chat.local_fanout.LocalFanoutRedisChannelLayer'
+# every worker then gets one copy of a group event instead of one per socket.
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
@@ -101,6 +105,95 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Public chat rooms presence (connected users per room), shared by every worker
+PRESENCE_STORE = {
+    'BACKEND': 'public_chat.presence.RedisPresenceStore',
+    'CONFIG': {
+        "hosts": [('127.0.0.1', 6379)],
+    },
+}
+
+# Public chat rooms send at most one connected user count update per window (seconds)
+CONNECTED_USER_COUNT_BROADCAST_WINDOW = 0.5
+
+# Chat messages write-behind: broadcast first, save later with bulk_create (see public_chat.write_behind)
+CHAT_MESSAGE_WRITE_BEHIND = {
+    'ENABLED': False,
+    'BATCH_SIZE': 100,
+    'FLUSH_INTERVAL': 0.2,
+    'MAX_RETRIES': 3,
+    'RETRY_DELAY': 0.5,
+    'MAX_DEPTH': 10000,
+}
+
+# Add the raw epoch milliseconds ("timestamp_ms") to chat messages, for clients formatting dates themselves
+CHAT_TIMESTAMP_EPOCH_MS = False
+
+# JSON codec of the chat websockets: public_chat.codecs.JsonCodec, OrjsonCodec (orjson) or UjsonCodec (ujson)
+WEBSOCKET_JSON_CODEC = 'public_chat.codecs.JsonCodec'
+
+# Outbound queue of every chat websocket (see public_chat.outbound.OutboundQueueMixin):
+# POLICY when MAX_SIZE frames are waiting, 'drop_oldest' or 'disconnect' (close code 4008)
+WEBSOCKET_OUTBOUND_QUEUE = {
+    'MAX_SIZE': 256,
+    'MAX_BYTES': 1024 * 1024,
+    'POLICY': 'drop_oldest',
+    'COALESCE': True,
+    'TRANSPORT_PRESSURE': True,
+}
+
+# Opt-in micro-batching of new chat messages ("set_batch_window" command), see public_chat.batching
+CHAT_MESSAGE_BATCHING = {
+    'MAX_WINDOW_MS': 50,
+    'MAX_SIZE': 100,
+}
+
+# Public rooms fan-out split over sub-groups growing with the connected users (see public_chat.sharding)
+CHAT_GROUP_SHARDING = {
+    'ENABLED': False,
+    'MEMBERS_PER_SHARD': 200,
+    'MAX_SHARDS': 32,
+    'STORE': {
+        'BACKEND': 'public_chat.sharding.RedisShardCountStore',
+        'CONFIG': {
+            "hosts": [('127.0.0.1', 6379)],
+        },
+    },
+}
+
+# Rooms one multiplexed chat socket ("chat/" route, see public_chat.multiplex) can join
+CHAT_MULTIPLEX_MAX_ROOMS = 20
+
+# Users of the websocket handshakes, cached per (user id, token) by codenames_api.channels_middleware
+WEBSOCKET_AUTH_CACHE = {
+    'TTL': 60,
+    'MAX_ENTRIES': 10000,
+}
+
+# Last messages of each chat room, first history page served without a database query
+RECENT_MESSAGES_CACHE = {
+    'BACKEND': 'public_chat.recent_messages.RedisRecentMessagesCache',
+    'CONFIG': {
+        "hosts": [('127.0.0.1', 6379)],
+    },
+}
+
+# Process local cache, use a shared backend (memcached, ...) with several workers:
+# the private chat lists are invalidated from any of them
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+# Private chat list of each user, cached until one of its rooms changes (private_chat.chat_list_cache).
+# WORKERS: processes serving the API, above 1 the app refuses to start on a process local cache
+PRIVATE_CHAT_LIST_CACHE = {
+    'CACHE': 'default',
+    'TIMEOUT': 300,
+    'WORKERS': int(os.environ.get('WEB_CONCURRENCY', 1)),
+}
+
 # CHANNEL_LAYERS = {
 #     'default': {
 #         'BACKEND': 'channels_redis.core.RedisChannelLayer',
@@ -146,6 +239,45 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 
+# Prometheus metrics of this process (codenames_api.metrics) at /metrics, only for these addresses
+METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')
+
+# Logging: one JSON line per event (codenames_api.log.StructuredFormatter).
+# The per message events of the consumers are DEBUG, off by default. The level of each
+# subsystem (public_chat.consumers, private_chat.consumers, public_chat.outbound...)
+# can be changed at runtime with the log level endpoint (api/chat/log-levels/), in the
+# process answering the request only; CHAT_LOG_LEVEL sets it for every worker.
+CHAT_LOG_LEVEL = os.environ.get('CHAT_LOG_LEVEL', 'INFO')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'structured': {
+            '()': 'codenames_api.log.StructuredFormatter',
+        },
+    },
+    'handlers': {
+        'chat_console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'structured',
+        },
+    },
+    'loggers': {
+        'public_chat': {
+            'handlers': ['chat_console'],
+            'level': CHAT_LOG_LEVEL,
+            'propagate': False,
+        },
+        'private_chat': {
+            'handlers': ['chat_console'],
+            'level': CHAT_LOG_LEVEL,
+            'propagate': False,
+        },
+    },
+}
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/2.2/topics/i18n/
 
@@ -174,6 +306,14 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static_cdn')  # In prod, here is AWS or an
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media_cdn')  # cdn => Content Delivery Network
 TEMP = os.path.join(BASE_DIR, 'media_cdn/temp')
 
+# Chat messages older than AFTER_DAYS are moved by month to gzip segments under ROOT
+# (python manage.py archive_chat_messages), the history keeps paging into them
+CHAT_ARCHIVE = {
+    'ENABLED': False,
+    'ROOT': os.path.join(BASE_DIR, 'chat_archive'),
+    'AFTER_DAYS': 180,
+}
+
 BASE_DIR = "http://localhost:8000"  # domain name
 
 
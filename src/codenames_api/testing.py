@@ -0,0 +1,108 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from account.models import Account
+from friend.models import FriendList, FriendRequest
+from private_chat.models import PrivateChatRoom, PrivateRoomChatMessage
+
+
+class QueryBudgetMixin:
+    """
+    TestCase mixin: assertQueryBudget fails when a block runs more SQL queries than
+    the budget declared for the endpoint, and lists them.
+    Inside `for fixture in self.sized_fixtures():` the test runs once per FIXTURE_SIZES on
+    the fixture seed_fixture(size) builds, and an endpoint must also run the same
+    number of queries at every size: a count growing with the data fails even under
+    its budget.
+    Every measure (queries and wall time) is appended as a JSON line to the file
+    named by the QUERY_BUDGET_REPORT environment variable, if set:
+        QUERY_BUDGET_REPORT=/tmp/budgets.jsonl python manage.py test
+    """
+    FIXTURE_SIZES = (10, 100)
+    fixture_size = None
+
+    def seed_fixture(self, size):
+        raise NotImplementedError
+
+    def sized_fixtures(self):
+        self.query_counts = {}
+        for size in self.FIXTURE_SIZES:
+            self.fixture_size = size
+            yield self.seed_fixture(size)
+        self.fixture_size = None
+
+    @contextmanager
+    def assertQueryBudget(self, endpoint, budget):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            yield
+            elapsed = time.perf_counter() - start
+        report_query_budget(endpoint, len(queries), budget, elapsed, self.fixture_size)
+        if len(queries) > budget:
+            self.fail(
+                f"{endpoint} ran {len(queries)} queries, its budget is {budget}:\n"
+                + "\n".join(query['sql'] for query in queries.captured_queries)
+            )
+        if self.fixture_size is not None:
+            counts = self.query_counts.setdefault(endpoint, {})
+            counts[self.fixture_size] = len(queries)
+            if len(set(counts.values())) > 1:
+                self.fail(
+                    f"{endpoint} ran " + ", ".join(f"{count} queries at size {size}" for size, count in counts.items())
+                    + ":\n" + "\n".join(query['sql'] for query in queries.captured_queries)
+                )
+
+
+def report_query_budget(endpoint, queries, budget, elapsed, size=None):
+    path = os.environ.get('QUERY_BUDGET_REPORT')
+    if not path:
+        return
+    with open(path, 'a') as f:
+        f.write(json.dumps({'endpoint': endpoint, 'size': size, 'queries': queries, 'budget': budget, 'ms': elapsed * 1000}) + "\n")
+
+
+def seed_accounts(count, prefix="seed"):
+    """
+    count accounts (and their friend lists) in a few queries, no password hashing
+    """
+    Account.objects.bulk_create([
+        Account(email=f"{prefix}{i}@codenames.com", username=f"{prefix}{i}")
+        for i in range(count)
+    ])
+    accounts = list(Account.objects.filter(username__startswith=prefix).order_by('id'))
+    FriendList.objects.bulk_create([FriendList(user=account) for account in accounts])
+    return accounts
+
+
+def seed_friends(user, friends, messages=0):
+    """
+    Make user and friends mutual friends with a private chat room each,
+    holding `messages` messages.
+    """
+    Friends = FriendList.friends.through
+    user_list = FriendList.objects.get(user=user)
+    friend_lists = {friend_list.user_id: friend_list for friend_list in FriendList.objects.filter(user__in=friends)}
+    Friends.objects.bulk_create(
+        [Friends(friendlist_id=user_list.id, account_id=friend.id) for friend in friends]
+        + [Friends(friendlist_id=friend_lists[friend.id].id, account_id=user.id) for friend in friends]
+    )
+    RoomUsers = PrivateChatRoom.users.through
+    for friend in friends:
+        room = PrivateChatRoom.objects.create(min_user_id=min(user.id, friend.id), max_user_id=max(user.id, friend.id))
+        RoomUsers.objects.bulk_create([
+            RoomUsers(privatechatroom_id=room.id, account_id=user.id),
+            RoomUsers(privatechatroom_id=room.id, account_id=friend.id),
+        ])
+        PrivateRoomChatMessage.objects.bulk_create([
+            PrivateRoomChatMessage(room=room, user=friend if i % 2 else user, content=f"message {i}")
+            for i in range(messages)
+        ])
+
+
+def seed_friend_requests(reciever, senders):
+    FriendRequest.objects.bulk_create([FriendRequest(sender=sender, reciever=reciever) for sender in senders])
@@ -2,7 +2,7 @@ from django.db import models
 from django.conf import settings
 from django.utils import timezone
 
-from private_chat.utils import find_or_create_private_chat
+from private_chat.utils import find_or_create_private_chat, invalidate_private_chat_room
 
 
 class FriendList(models.Model):
@@ -23,6 +23,7 @@ class FriendList(models.Model):
             if not chat.is_active:
                 chat.is_active = True
                 chat.save()
+                invalidate_private_chat_room(chat)
 
     def remove_friend(self, account):
         """
@@ -34,6 +35,7 @@ class FriendList(models.Model):
             if chat.is_active:
                 chat.is_active = False
                 chat.save()
+                invalidate_private_chat_room(chat)
 
     def unfriend(self, removee):
         """
@@ -1,3 +1,115 @@
+import json
+from types import SimpleNamespace
+
 from django.test import TestCase
+from rest_framework.test import APIClient
+
+from codenames_api.testing import QueryBudgetMixin, seed_accounts, seed_friends, seed_friend_requests
+from friend.models import FriendList, FriendRequest
+
+
+class FriendEndpointsQueryBudgetTest(QueryBudgetMixin, TestCase):
+    """
+    The friend endpoints must not run more queries when there are more friends
+    or friend requests: at each size, size friends (the first one with size / 5
+    friends of its own), size / 2 friend requests.
+    """
+
+    def seed_fixture(self, size):
+        accounts = seed_accounts(2 * size, prefix=f"size{size}-")
+        user, friends = accounts[0], accounts[1:size + 1]
+        seed_friends(user, friends)
+        seed_friends(friends[0], accounts[size + 1:size + 1 + size // 5])
+        seed_friend_requests(user, accounts[2 * size - size // 2:])
+        self.client.force_authenticate(user)
+        return SimpleNamespace(size=size, user=user, friends=friends)
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def get(self, url, endpoint, budget):
+        with self.assertQueryBudget(endpoint, budget):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)
+
+    def test_own_friend_list(self):
+        for fixture in self.sized_fixtures():
+            friends = self.get(f'/api/friend/list/{fixture.user.id}/', 'friend:friend-list (own)', 4)['friends']
+            self.assertEqual(len(friends), fixture.size)
+            self.assertTrue(all(friend['is_friend'] for friend in friends))
+
+    def test_friend_of_friend_list(self):
+        for fixture in self.sized_fixtures():
+            friends = self.get(f'/api/friend/list/{fixture.friends[0].id}/', 'friend:friend-list (friend)', 5)['friends']
+            self.assertEqual(len(friends), fixture.size // 5 + 1)
+            self.assertEqual(sum(friend['is_self'] for friend in friends), 1)
+            self.assertEqual(sum(friend['is_friend'] for friend in friends), 0)
+
+    def test_friend_list_search(self):
+        for fixture in self.sized_fixtures():
+            query = f"size{fixture.size}-1"
+            friends = self.get(f'/api/friend/list/{fixture.user.id}/?q={query}', 'friend:friend-list (search)', 4)['friends']
+            self.assertEqual(len(friends), sum(query in friend.username for friend in fixture.friends))
+
+    def test_friend_requests(self):
+        for fixture in self.sized_fixtures():
+            requests = self.get(f'/api/friend/friend-request/{fixture.user.id}/', 'friend:friend-requests', 2)['friend_requests']
+            self.assertEqual(len(requests), fixture.size // 2)
+            self.assertEqual(set(requests[0]['sender']), {'id', 'last_login', 'email', 'username', 'date_joined', 'is_admin', 'is_active', 'is_staff', 'is_superuser', 'profile_image', 'hide_email'})
+
+
+class FriendMutationsQueryBudgetTest(QueryBudgetMixin, TestCase):
+    """
+    Sending, answering and cancelling friend requests and unfriending must not run
+    more queries when the users have more friends: at each size, size friends
+    each side.
+    """
+
+    def seed_fixture(self, size):
+        accounts = seed_accounts(2 * size + 2, prefix=f"size{size}-")
+        user, friends, other = accounts[0], accounts[1:size + 1], accounts[size + 1]
+        seed_friends(user, friends)
+        seed_friends(other, accounts[size + 2:])
+        self.client.force_authenticate(user)
+        return SimpleNamespace(size=size, user=user, friends=friends, other=other)
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def request(self, method, url, endpoint, budget, data=None, status_code=200):
+        with self.assertQueryBudget(endpoint, budget):
+            response = getattr(self.client, method)(url, data, format='json')
+        self.assertEqual(response.status_code, status_code)
+        return json.loads(response.data)
+
+    def test_send(self):
+        for fixture in self.sized_fixtures():
+            self.request('post', '/api/friend/friend-request/', 'friend:friend-request (send)', 3, {'reciever_id': fixture.other.id}, 201)
+            self.assertTrue(FriendRequest.objects.filter(sender=fixture.user, reciever=fixture.other, is_active=True).exists())
+
+    def test_accept(self):
+        for fixture in self.sized_fixtures():
+            friend_request = FriendRequest.objects.create(sender=fixture.other, reciever=fixture.user)
+            self.request('get', f'/api/friend/accept-friend-request/{friend_request.id}/', 'friend:accept-friend-request', 21, status_code=201)
+            self.assertTrue(FriendList.objects.get(user=fixture.user).friends.filter(id=fixture.other.id).exists())
+            self.assertTrue(FriendList.objects.get(user=fixture.other).friends.filter(id=fixture.user.id).exists())
+
+    def test_decline(self):
+        for fixture in self.sized_fixtures():
+            friend_request = FriendRequest.objects.create(sender=fixture.other, reciever=fixture.user)
+            self.request('get', f'/api/friend/friend-decline/{friend_request.id}/', 'friend:decline-friend-request', 3, status_code=201)
+            self.assertFalse(FriendRequest.objects.get(id=friend_request.id).is_active)
+
+    def test_cancel(self):
+        for fixture in self.sized_fixtures():
+            FriendRequest.objects.create(sender=fixture.user, reciever=fixture.other)
+            self.request('post', '/api/friend/friend-cancel/', 'friend:cancel-friend-request', 3, {'reciever_id': fixture.other.id}, 201)
+            self.assertFalse(FriendRequest.objects.filter(sender=fixture.user, is_active=True).exists())
 
-# Create your tests here.
+    def test_unfriend(self):
+        for fixture in self.sized_fixtures():
+            friend = fixture.friends[0]
+            self.request('post', '/api/friend/friend-remove/', 'friend:remove-friend', 13, {'reciever_user_id': friend.id})
+            self.assertFalse(FriendList.objects.get(user=fixture.user).friends.filter(id=friend.id).exists())
+            self.assertFalse(FriendList.objects.get(user=friend).friends.filter(id=fixture.user.id).exists())
@@ -1,7 +1,14 @@
-from friend.models import FriendRequest
+from friend.models import FriendList, FriendRequest
 
 def get_friend_request_or_false(sender, reciever):
     try:
         return FriendRequest.objects.get(sender=sender, reciever= reciever, is_active=True)
     except FriendRequest.DoesNotExist:
-        return False
\ No newline at end of file
+        return False
+
+
+def get_friend_ids(user):
+    """
+    ids of the friends of a user in one query, to check many accounts without a query each
+    """
+    return set(FriendList.friends.through.objects.filter(friendlist__user=user).values_list('account_id', flat=True))
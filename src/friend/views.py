@@ -15,6 +15,7 @@ from account.models import Account
 from account.serializers import AccountSerializer
 from friend.models import FriendList, FriendRequest
 from friend.serializers import FriendRequestSerializer
+from friend.utils import get_friend_ids
 
 from django.db.models.query_utils import Q
 
@@ -59,17 +60,18 @@ class FriendListView(RetrieveAPIView):
                         'message': "You must be friend with a user to access this."
                     })
             friends = []
-            auth_user_friend_list = FriendList.objects.get(user=user)
+            # friends of the authenticated user, fetched once for the whole list
+            auth_user_friend_ids = get_friend_ids(user)
             for friend in friend_list.friends.all():
                 if not search_query:
                     account = self.serialize_class(friend).data
-                    account['is_friend'] = auth_user_friend_list.is_mutual_friend(friend)
+                    account['is_friend'] = friend.id in auth_user_friend_ids
                     account['is_self'] = friend == user
                     friends.append(account)
                 else:
                     if search_query in friend.username or search_query in friend.email:
                         account = self.serialize_class(friend).data
-                        account['is_friend'] = auth_user_friend_list.is_mutual_friend(friend)
+                        account['is_friend'] = friend.id in auth_user_friend_ids
                         account['is_self'] = friend == user
                         friends.append(account)
             friends = sorted(friends, key= lambda i: (i['username']))
@@ -115,9 +117,13 @@ class FriendRequestsSendersView(RetrieveAPIView):
                 friend_requests = FriendRequest.objects.filter(reciever=account, is_active=True).filter(Q(sender__email__icontains=search_query) | Q(sender__username__icontains=search_query))
             else:
                 friend_requests = FriendRequest.objects.filter(reciever=account, is_active=True)
-            datas = self.serializer_class(friend_requests, many=True).data
-            for data in datas:
-                data['sender'] = AccountSerializer(Account.objects.get(pk=data['sender'])).data
+            # senders fetched with the requests
+            friend_requests = friend_requests.select_related('sender')
+            datas = []
+            for friend_request in friend_requests:
+                data = self.serializer_class(friend_request).data
+                data['sender'] = AccountSerializer(friend_request.sender).data
+                datas.append(data)
             datas = sorted(datas, key= lambda i: (i['sender']['username']))
             status_code = status.HTTP_200_OK
             response = JSONRenderer().render({
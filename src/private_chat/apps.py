@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class PrivateChatConfig(AppConfig):
     name = 'private_chat'
+
+    def ready(self):
+        from private_chat.chat_list_cache import check_shared_cache
+        check_shared_cache()
@@ -0,0 +1,88 @@
+import hashlib
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+
+
+DEFAULT_PRIVATE_CHAT_LIST_CACHE = {
+    'CACHE': 'default',     # alias of settings.CACHES, shared by every worker in production
+    'TIMEOUT': 300,
+    'WORKERS': 1,           # processes serving the API, each one invalidates the lists
+}
+
+
+def get_chat_list_cache_config():
+    config = dict(DEFAULT_PRIVATE_CHAT_LIST_CACHE)
+    config.update(getattr(settings, 'PRIVATE_CHAT_LIST_CACHE', {}))
+    return config
+
+
+def get_cache():
+    return caches[get_chat_list_cache_config()['CACHE']]
+
+
+def check_shared_cache():
+    """
+    An invalidation reaches the lists cached by every worker only through a shared
+    cache: refuse a process local one when several workers serve the API
+    """
+    config = get_chat_list_cache_config()
+    if config['WORKERS'] > 1 and isinstance(get_cache(), LocMemCache):
+        raise ImproperlyConfigured(
+            f"PRIVATE_CHAT_LIST_CACHE uses the process local cache '{config['CACHE']}' with "
+            f"{config['WORKERS']} workers: their chat lists would not be invalidated by the others, "
+            "configure a shared cache (memcached, ...) in CACHES."
+        )
+
+
+def version_key(user_id):
+    return f"private_chat_list:version:{user_id}"
+
+
+def list_key(user_id):
+    return f"private_chat_list:{user_id}"
+
+
+def current_day():
+    # the last messages are shown as 'today' / 'yesterday' (UTC, see calculate_timestamp)
+    return int(time.time()) // 86400
+
+
+def get_cached_chat_list(user_id):
+    """
+    (version, cached list) of the user in one cache call, the list is None if it is
+    missing, older than the version (invalidated) or rendered another day.
+    The version is created if there is none yet.
+    """
+    cache = get_cache()
+    values = cache.get_many([version_key(user_id), list_key(user_id)])
+    version = values.get(version_key(user_id))
+    if version is None:
+        cache.add(version_key(user_id), uuid.uuid4().hex, None)
+        return cache.get(version_key(user_id)), None
+    cached = values.get(list_key(user_id))
+    if cached is None or cached['version'] != version or cached['day'] != current_day():
+        return version, None
+    return version, cached
+
+
+def set_cached_chat_list(user_id, version, body):
+    """
+    Cache the rendered list of the user, read at `version`. return its ETag
+    """
+    etag = '"%s"' % hashlib.md5(body).hexdigest()
+    get_cache().set(list_key(user_id), {'version': version, 'day': current_day(), 'etag': etag, 'body': body}, get_chat_list_cache_config()['TIMEOUT'])
+    return etag
+
+
+def invalidate_chat_lists(user_ids):
+    """
+    Next request of these users renders their list again.
+    A new version rather than a delete: a list rendered before the change and
+    cached after it is never served.
+    """
+    get_cache().set_many({version_key(user_id): uuid.uuid4().hex for user_id in set(user_ids)}, None)
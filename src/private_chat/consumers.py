@@ -1,16 +1,25 @@
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from channels.db import database_sync_to_async
 
-from public_chat.serializers import LazyRoomChatMessageEncoder, calculate_timestamp
+import logging
+import time
+
+from public_chat.serializers import LazyRoomChatMessageEncoder, encode_new_message_event
+from public_chat.pagination import get_messages_page_before
+from public_chat.codecs import JsonCodecMixin, MessagePackProtocolMixin
+from public_chat.outbound import OutboundQueueMixin
+from public_chat.batching import MessageBatchingMixin
+from public_chat.archive import ArchivedRoomMessages, get_chat_archive, is_chat_archive_enabled
+from public_chat.recent_messages import append_recent_message, get_recent_chat_messages, is_first_page
+from public_chat.write_behind import get_write_behind_buffer, is_write_behind_enabled
+from codenames_api.log import get_logger
+from codenames_api.metrics import ConsumerMetricsMixin, COMMAND_DURATION, command_label, group_send, metered_database_sync_to_async
 from django.core.paginator import Paginator
-import json
 
 from private_chat.models import PrivateChatRoom, PrivateRoomChatMessage
 from friend.models import FriendList
 from account.serializers import AccountSerializer
 from private_chat.exceptions import ClientError
 
-from django.utils import timezone
 from public_chat.constants import (
     DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE,
     MSG_TYPE_CONNECTED_USER_COUNT,
@@ -18,19 +27,29 @@ from public_chat.constants import (
 )
 
 
-class PrivateChatConsumer(AsyncJsonWebsocketConsumer):
+log = get_logger(__name__)
+
+
+class PrivateChatConsumer(MessageBatchingMixin, OutboundQueueMixin, ConsumerMetricsMixin, MessagePackProtocolMixin, JsonCodecMixin, AsyncJsonWebsocketConsumer):
+
+    metrics_label = "private_chat"
+
+    def metrics_room_types(self):
+        return ('private',) if getattr(self, 'room_id', None) is not None else ()
 
     async def connect(self):
         """
         Called when the websocket is handshaking as part of initial connection.
         """
-        print("[PrivateChatConsumer] connect: " + str(self.scope["user"]))
+        log.debug("connect", user_id=self.scope['user'].id)
 
         # let everyone connect. But limit read/write to authenticated users
         await self.accept()
 
         # the room_id will define what it means to be "connected". If it is not None, then the user is connected.
         self.room_id = None
+        # room resolved (and membership checked) at join, kept for the life of the socket
+        self.room = None
 
 
     async def receive_json(self, content):
@@ -39,8 +58,8 @@ class PrivateChatConsumer(AsyncJsonWebsocketConsumer):
         for us and pass it as the first argument.
         """
         # Messages will have a "command" key we can switch on
-        print("[PrivateChatConsumer] receive_json")
         command = content.get("command", None)
+        start = time.perf_counter()
         try:
             if command == "join":
                 await self.join_room(content['room_id'])
@@ -51,18 +70,37 @@ class PrivateChatConsumer(AsyncJsonWebsocketConsumer):
                     # HTTPstatus 422
                     raise ClientError(422, "You can not send an empty message.")
                 await self.send_room(content['room_id'], content['message'])
+            elif command == "set_batch_window":
+                await self.set_batch_window(content.get('window_ms'))
             elif command == "get_chatroom_messages":
-                room = await get_room_or_error(content['room_id'], self.scope['user'])
-                payload = await get_room_chat_message(room, content['page_number'])
+                room = await self.get_room(content['room_id'])
+                payload = None
+                if is_first_page(content):
+                    # opening the room: served from the room recent messages
+                    payload = await get_recent_chat_messages(room, PrivateRoomChatMessage.objects, 'before' in content)
+                if payload == None and 'before' in content:
+                    # keyset pagination, 'before' is None for the most recent page
+                    payload = await get_room_chat_message_before(room, content['before'])
+                elif payload == None:
+                    payload = await get_room_chat_message(room, content['page_number'])
                 if payload != None:
-                    payload = json.loads(payload)
-                    await self.send_messages_payload(payload['messages'], payload['new_page_number'])
+                    await self.send_messages_payload(payload['messages'], payload['new_page_number'], payload.get('next_cursor'))
                 else:
                     raise ClientError(204, "Something went wrong retrieving chatroom messages.")
             elif command == "get_user_info":
                 pass
         except ClientError as e:
             await self.handle_client_error(e)
+        duration = time.perf_counter() - start
+        COMMAND_DURATION.observe(duration, consumer=self.metrics_label, command=command_label(command))
+        if log.is_enabled(logging.DEBUG):
+            log.debug(
+                "command",
+                command=command,
+                room_id=content.get('room_id'),
+                user_id=self.scope['user'].id,
+                duration_ms=duration * 1000,
+            )
 
 
     async def disconnect(self, code):
@@ -70,7 +108,7 @@ class PrivateChatConsumer(AsyncJsonWebsocketConsumer):
         Called when the WebSocket closes for any reason.
         """
         # Leave the room
-        print("[PrivateChatConsumer] disconnect")
+        log.debug("disconnect", user_id=self.scope['user'].id, room_id=self.room_id, code=code)
         try:
             if self.room_id != None:
                 await self.leave_room(self.room_id)
@@ -83,13 +121,14 @@ class PrivateChatConsumer(AsyncJsonWebsocketConsumer):
         Called by receive_json when someone sent a join command.
         """
         # The logged-in user is in our scope thanks to the authentication ASGI middleware (AuthMiddlewareStack)
-        print("[PrivateChatConsumer] join_room: " + str(room_id))
+        log.debug("join_room", room_id=room_id, user_id=self.scope['user'].id)
         try:
             room = await get_room_or_error(room_id, self.scope['user'])
         except ClientError as e:
             return await self.handle_client_error(e)
         # Store thas we are in the room
         self.room_id = room_id
+        self.room = room
         # Add them to the group so they receive the room messages
         await self.channel_layer.group_add(
             room.group_name,
@@ -108,10 +147,11 @@ class PrivateChatConsumer(AsyncJsonWebsocketConsumer):
         Called by receive_json when someone sent a leave command.
         """
         # The logged-in user is in our scope thanks to the authentication ASGI middleware
-        print("[PrivateChatConsumer] leave_room")
-        room = await get_room_or_error(room_id, self.scope['user'])
+        log.debug("leave_room", room_id=room_id, user_id=self.scope['user'].id)
+        room = await self.get_room(room_id)
         # Notify the group that someone left
-        await self.channel_layer.group_send(
+        await group_send(
+            self.channel_layer,
             room.group_name,
             {
                 "type": "chat.leave",
@@ -122,6 +162,7 @@ class PrivateChatConsumer(AsyncJsonWebsocketConsumer):
             }
         )
         self.room_id = None
+        self.room = None
         await self.channel_layer.group_discard(
             room.group_name,
             self.channel_name
@@ -131,11 +172,21 @@ class PrivateChatConsumer(AsyncJsonWebsocketConsumer):
         })
 
 
+    async def get_room(self, room_id):
+        """
+        The room joined by this socket, without any query.
+        Other rooms are fetched and checked as usual.
+        """
+        if self.room != None and str(self.room.id) == str(room_id):
+            return self.room
+        return await get_room_or_error(room_id, self.scope['user'])
+
+
     async def send_room(self, room_id, message):
         """
         Called by receive_json when someone sends a message to a room.
         """
-        print("[PrivateChatConsumer] send_room")
+        log.debug("send_room", room_id=room_id, user_id=self.scope['user'].id)
         if self.room_id != None:
             # TODO WTF is this test
             if str(room_id) != str(self.room_id):
@@ -144,16 +195,21 @@ class PrivateChatConsumer(AsyncJsonWebsocketConsumer):
             raise ClientError(403, "Room acces denied. ")
         if not is_authenticated(self.scope['user']):
             raise ClientError(403, "You must be authenticated to chat.")
-        room = await get_room_or_error(room_id, self.scope['user'])
-        await create_room_chat_message(room, self.scope['user'], message)
-        await self.channel_layer.group_send(
+        room = await self.get_room(room_id)
+        if is_write_behind_enabled():
+            # broadcast right away, the message is saved with the next batch
+            chat_message = await get_write_behind_buffer(PrivateRoomChatMessage).append(user=self.scope['user'], room=room, content=message)
+            await append_recent_message(room, self.scope['user'], message, chat_message)
+        else:
+            chat_message = await create_room_chat_message(room, self.scope['user'], message)
+            await append_recent_message(room, self.scope['user'], message, chat_message)
+        await group_send(
+            self.channel_layer,
             room.group_name,
             {
                 "type": "chat.message",
-                "profile_image": self.scope["user"].profile_image.url,
-                "username": self.scope["user"].username,
                 "user_id": self.scope["user"].id,
-                "message": message,
+                **encode_new_message_event(self.scope["user"], message, room.room_tag),
             }
         )
 
@@ -163,7 +219,7 @@ class PrivateChatConsumer(AsyncJsonWebsocketConsumer):
         Called when someone has joined our chat.
         """
         # Send a message down to the client
-        print("[PrivateChatConsumer] chat_join: " + str(self.scope["user"].id))
+        log.debug("chat_join", room_id=self.room_id, user_id=self.scope['user'].id)
 
 
     async def chat_leave(self, event):
@@ -171,7 +227,26 @@ class PrivateChatConsumer(AsyncJsonWebsocketConsumer):
         Called when someone has left our chat.
         """
         # Send a message down to the client
-        print("[PrivateChatConsumer] chat_leave")
+        log.debug("chat_leave", room_id=self.room_id, user_id=self.scope['user'].id)
+
+
+    async def room_invalidate(self, event):
+        """
+        Called when the room or its members changed (ex: unfriend deactivating the room).
+        Drop the cached room and check again that we are still allowed in it.
+        """
+        log.debug("room_invalidate", room_id=event['room_id'], user_id=self.scope['user'].id)
+        if self.room == None or str(self.room.id) != str(event['room_id']):
+            return
+        group_name = self.room.group_name
+        self.room = None
+        try:
+            self.room = await get_room_or_error(event['room_id'], self.scope['user'])
+        except ClientError as e:
+            # not allowed anymore: leave the room
+            self.room_id = None
+            await self.channel_layer.group_discard(group_name, self.channel_name)
+            await self.handle_client_error(e)
 
 
     async def chat_message(self, event):
@@ -179,27 +254,22 @@ class PrivateChatConsumer(AsyncJsonWebsocketConsumer):
         Called when someone has messaged our chat.
         """
         # Send a message down to the client
-        print("[PrivateChatConsumer] chat_message")
-        timestamp = calculate_timestamp(timezone.now())
-        await self.send_json({
-            "message_type": MSG_TYPE_NEW_MESSAGE,
-            "profile_image": event['profile_image'],
-            "username": event['username'],
-            "user_id": event['user_id'],
-            "message": event['message'],
-            "timestamp": timestamp
-        })
+        if log.is_enabled(logging.DEBUG):
+            log.debug("chat_message", room_id=self.room_id, from_user_id=event['user_id'], user_id=self.scope['user'].id)
+        # already encoded by the sender, nothing to do per recipient
+        await self.send_pre_encoded(event)
 
 
-    async def send_messages_payload(self, messages, new_page_number):
+    async def send_messages_payload(self, messages, new_page_number, next_cursor=None):
         """
         Send a payload of messages to the ui
         """
-        print("[PrivateChatConsumer] send_messages_payload. ")
+        log.debug("send_messages_payload", room_id=self.room_id, count=len(messages or ()), user_id=self.scope['user'].id)
         await self.send_json({
             "messages_payload": "messages_payload",
             "messages": messages,
             "new_page_number": new_page_number,
+            "next_cursor": next_cursor,
         })
 
 
@@ -207,7 +277,7 @@ class PrivateChatConsumer(AsyncJsonWebsocketConsumer):
         """
         Send a payload of user information to the ui
         """
-        print("[PrivateChatConsumer] send_user_info_payload. ")
+        log.debug("send_user_info_payload", user_id=self.scope['user'].id)
 
 
     async def display_progress_bar(self, is_displayed):
@@ -217,7 +287,7 @@ class PrivateChatConsumer(AsyncJsonWebsocketConsumer):
         2. is_displayed = False
             - Hide the progress bar on UI
         """
-        print("DISPLAY PROGRESS BAR: " + str(is_displayed))
+        log.debug("display_progress_bar", is_displayed=is_displayed, user_id=self.scope['user'].id)
 
 
     async def handle_client_error(self, error):
@@ -239,7 +309,7 @@ def is_authenticated(user):
     return False
 
 
-@database_sync_to_async
+@metered_database_sync_to_async
 def get_room_or_error(room_id, user):
     """
     Tries to fetch a room for the user, checking permission along the way
@@ -249,18 +319,23 @@ def get_room_or_error(room_id, user):
     except PrivateChatRoom.DoesNotExist:
         raise ClientError(404, "Invalid room. ")
     # Is this user allowed in this room
-    if not user in room.users.all():
+    # (members kept on the room for the chat list invalidation of its new messages)
+    room.member_ids = list(room.users.values_list('id', flat=True))
+    if not room.is_active or user.pk not in room.member_ids:
         raise ClientError(403, "You do not have the permission to chat in that room. ")
     return room
 
-@database_sync_to_async
+@metered_database_sync_to_async
 def create_room_chat_message(room, user, message):
     return PrivateRoomChatMessage.objects.create(user=user, room=room, content=message)
 
-@database_sync_to_async
+@metered_database_sync_to_async
 def get_room_chat_message(room, page_number):
     try:
         qs = PrivateRoomChatMessage.objects.by_room(room)
+        if is_chat_archive_enabled():
+            # pages go on into the archived months
+            qs = ArchivedRoomMessages(qs, get_chat_archive(PrivateRoomChatMessage), room)
         p = Paginator(qs, DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE)
 
         payload = {}
@@ -272,7 +347,24 @@ def get_room_chat_message(room, page_number):
         else:
             payload['messages'] = None
         payload['new_page_number'] = new_page_number
-        return json.dumps(payload)
-    except Exception as e:
-        print(f"EXCEPTION: {str(e)}")
+        return payload
+    except Exception:
+        log.exception("get_room_chat_message", room_id=room.id)
+        return None
+
+@metered_database_sync_to_async
+def get_room_chat_message_before(room, cursor):
+    """
+    Keyset page of messages older than cursor (None: most recent page)
+    """
+    try:
+        messages, next_cursor = get_messages_page_before(PrivateRoomChatMessage.objects, room, cursor)
+        payload = {}
+        serializer = LazyRoomChatMessageEncoder()
+        payload['messages'] = serializer.serialize(messages)
+        payload['new_page_number'] = None
+        payload['next_cursor'] = next_cursor
+        return payload
+    except Exception:
+        log.exception("get_room_chat_message_before", room_id=room.id, cursor=cursor)
         return None
\ No newline at end of file
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.15 on 2026-10-18 09:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('private_chat', '0004_privatechatroom_chat_image'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='privateroomchatmessage',
+            index=models.Index(fields=['room', '-timestamp', 'id'], name='private_msg_room_ts_id_idx'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+from django.db import migrations
+
+
+def backfill_user_pairs(apps, schema_editor):
+    """
+    Key the 2 users rooms by their user pair, merging the duplicate rooms of a pair
+    into one: its messages, the title and is_active of any of them.
+    The room kept is the oldest one, the others are deleted.
+    """
+    PrivateChatRoom = apps.get_model('private_chat', 'PrivateChatRoom')
+    PrivateRoomChatMessage = apps.get_model('private_chat', 'PrivateRoomChatMessage')
+    RoomUsers = PrivateChatRoom._meta.get_field('users').remote_field.through
+    members = {}
+    for room_id, account_id in RoomUsers.objects.values_list('privatechatroom_id', 'account_id'):
+        members.setdefault(room_id, set()).add(account_id)
+    # (min user id, max user id) -> ids of its rooms, oldest first
+    pairs = {}
+    for room_id in sorted(members):
+        if len(members[room_id]) == 2:
+            pairs.setdefault(tuple(sorted(members[room_id])), []).append(room_id)
+    for (min_user_id, max_user_id), room_ids in pairs.items():
+        rooms = list(PrivateChatRoom.objects.filter(id__in=room_ids).order_by('id'))
+        room, duplicates = rooms[0], rooms[1:]
+        if duplicates:
+            duplicate_ids = [duplicate.id for duplicate in duplicates]
+            PrivateRoomChatMessage.objects.filter(room_id__in=duplicate_ids).update(room_id=room.id)
+            room.is_active = any(r.is_active for r in rooms)
+            room.title = room.title or next((r.title for r in duplicates if r.title), '')
+            PrivateChatRoom.objects.filter(id__in=duplicate_ids).delete()
+        room.min_user_id = min_user_id
+        room.max_user_id = max_user_id
+        room.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('private_chat', '0006_privatechatroom_user_pair'),
+    ]
+
+    operations = [
+        # the merge is not undone
+        migrations.RunPython(backfill_user_pairs, migrations.RunPython.noop),
+    ]
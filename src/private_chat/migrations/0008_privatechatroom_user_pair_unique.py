@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('private_chat', '0007_backfill_user_pair'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='privatechatroom',
+            constraint=models.UniqueConstraint(fields=('min_user', 'max_user'), name='private_room_user_pair_unique'),
+        ),
+    ]
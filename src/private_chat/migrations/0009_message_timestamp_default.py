@@ -0,0 +1,19 @@
+# Generated by Django 2.2.15 on 2026-10-18 10:31
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('private_chat', '0008_privatechatroom_user_pair_unique'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='privateroomchatmessage',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
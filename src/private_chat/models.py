@@ -1,5 +1,13 @@
 from django.db import models
+from django.db.models.query_utils import Q
+from django.db.models.signals import post_init, post_save
+from django.dispatch import receiver
 from django.conf import settings
+from django.utils import timezone
+
+from private_chat.chat_list_cache import invalidate_chat_lists
+from public_chat.constants import CHAT_HISTORY_FIELDS
+from public_chat.write_behind import messages_flushed
 
 
 def get_chat_image_filepath(self, filename):
@@ -17,6 +25,14 @@ class PrivateChatRoom(models.Model):
     connected_users = models.ManyToManyField(settings.AUTH_USER_MODEL, blank=True, related_name='connected_users', help_text="users connected to the chat")
     is_active = models.BooleanField(default=True)
     chat_image = models.ImageField(max_length=255, upload_to=get_chat_image_filepath, null=True, blank=True, default=get_default_chat_image)
+    # one-to-one rooms only (see find_or_create_private_chat): the 2 users, lowest id first
+    min_user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    max_user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['min_user', 'max_user'], name='private_room_user_pair_unique'),
+        ]
 
     def __str__(self):
         return f"Private chat {self.title}"
@@ -29,6 +45,13 @@ class PrivateChatRoom(models.Model):
         """
         return f"PrivateChatRoom-{self.id}"
 
+    @property
+    def room_tag(self):
+        """
+        The room in the frames of the multiplexed chat socket.
+        """
+        return f"private:{self.id}"
+
     def connect_user(self, user):
         """
         return True if the user is added to the connected_users list
@@ -65,7 +88,21 @@ class PrivateChatRoom(models.Model):
 class PrivateRoomChatMessageManager(models.Manager):
     
     def by_room(self, room):
-        qs = PrivateRoomChatMessage.objects.filter(room=room).order_by("-timestamp")
+        """
+        Messages of a room, most recent first, with their author (history columns only)
+        """
+        qs = PrivateRoomChatMessage.objects.filter(room=room).select_related("user").only(
+            *CHAT_HISTORY_FIELDS
+        ).order_by("-timestamp", "id")
+        return qs
+
+    def by_room_before(self, room, timestamp, message_id):
+        """
+        Messages of a room older than the (timestamp, id) cursor, same order as by_room.
+        """
+        qs = self.by_room(room).filter(
+            Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__gt=message_id)
+        )
         return qs
 
 
@@ -75,11 +112,81 @@ class PrivateRoomChatMessage(models.Model):
     """
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     room = models.ForeignKey(PrivateChatRoom, on_delete=models.CASCADE)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # set when the message is sent, write-behind inserts it later
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
     content = models.TextField(unique=False, blank=False)
 
     objects = PrivateRoomChatMessageManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', '-timestamp', 'id'], name='private_msg_room_ts_id_idx'),
+        ]
+
     def __str__(self):
         return self.content
 
+
+def get_member_ids(room):
+    """
+    ids of the users of the room, without a query for a room checked by the chat consumer
+    """
+    member_ids = getattr(room, 'member_ids', None)
+    if member_ids is None:
+        member_ids = list(room.users.values_list('id', flat=True))
+    return member_ids
+
+
+@receiver(post_save, sender=PrivateChatRoom)
+def private_room_saved(sender, instance, created, **kwargs):
+    # title, image or is_active (friend added / removed) of a room of the list
+    if not created:
+        invalidate_chat_lists(get_member_ids(instance))
+
+
+# fields of a member shown in the chat lists of its rooms (title and image)
+CHAT_LIST_ACCOUNT_FIELDS = ('username', 'profile_image')
+
+
+def get_chat_list_fields(account):
+    # loaded values only, None for a deferred field: changed if it was loaded since
+    return tuple(
+        None if account.__dict__.get(name) is None else str(account.__dict__[name])
+        for name in CHAT_LIST_ACCOUNT_FIELDS
+    )
+
+
+@receiver(post_init, sender=settings.AUTH_USER_MODEL)
+def account_loaded(sender, instance, **kwargs):
+    instance._chat_list_fields = get_chat_list_fields(instance)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def account_saved(sender, instance, created, update_fields=None, **kwargs):
+    """
+    A member is serialized in the chat lists of its rooms (username, avatar):
+    invalidate the lists of the user and of everyone sharing a room with it when
+    one of them changed, not on every save (last_login, ...)
+    """
+    if update_fields is not None and not set(update_fields) & set(CHAT_LIST_ACCOUNT_FIELDS):
+        return
+    fields = get_chat_list_fields(instance)
+    changed = fields != instance._chat_list_fields
+    instance._chat_list_fields = fields
+    if created or not changed:
+        return
+    members = PrivateChatRoom.users.through.objects.filter(privatechatroom__users=instance)
+    invalidate_chat_lists([instance.pk, *members.values_list('account_id', flat=True)])
+
+
+@receiver(post_save, sender=PrivateRoomChatMessage)
+def private_message_saved(sender, instance, created, **kwargs):
+    # new last message in the chat list of every member
+    if created:
+        invalidate_chat_lists(get_member_ids(instance.room))
+
+
+@receiver(messages_flushed, sender=PrivateRoomChatMessage)
+def private_messages_flushed(sender, messages, **kwargs):
+    rooms = {message.room_id: message.room for message in messages}
+    invalidate_chat_lists([user_id for room in rooms.values() for user_id in get_member_ids(room)])
@@ -1,3 +1,180 @@
-from django.test import TestCase
+import json
+from types import SimpleNamespace
+from unittest import skipUnless
+
+from django.contrib.auth.models import update_last_login
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from account.models import Account
+from friend.models import FriendList
+from public_chat.constants import DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE
+from public_chat.pagination import get_messages_page_before
+from public_chat.serializers import LazyRoomChatMessageEncoder
+from codenames_api.testing import QueryBudgetMixin, seed_accounts, seed_friends
+from private_chat.chat_list_cache import check_shared_cache, get_cache
+from private_chat.models import PrivateRoomChatMessage
+from private_chat.utils import find_or_create_private_chat, get_private_chat_rooms
+
+
+class ChatHistoryQueriesTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        user1 = Account.objects.create_user("user1@codenames.com", "user1", "password")
+        user2 = Account.objects.create_user("user2@codenames.com", "user2", "password")
+        cls.room = find_or_create_private_chat(user1, user2)
+        PrivateRoomChatMessage.objects.bulk_create([
+            PrivateRoomChatMessage(user=user1 if i % 2 else user2, room=cls.room, content=f"message {i}")
+            for i in range(DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE + 5)
+        ])
+
+    def test_cursor_pages_are_one_query_each(self):
+        with self.assertNumQueries(1):
+            messages, next_cursor = get_messages_page_before(PrivateRoomChatMessage.objects, self.room, None)
+            first_page = LazyRoomChatMessageEncoder().serialize(messages)
+        with self.assertNumQueries(1):
+            messages, next_cursor = get_messages_page_before(PrivateRoomChatMessage.objects, self.room, next_cursor)
+            last_page = LazyRoomChatMessageEncoder().serialize(messages)
+        self.assertEqual(len(first_page), DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE)
+        self.assertEqual(len(last_page), 5)
+        self.assertIsNone(next_cursor)
+
+
+class PrivateChatEndpointsQueryBudgetTest(QueryBudgetMixin, TestCase):
+    """
+    The private chat endpoints must not run more queries when there are more rooms
+    or messages: at each size, size friends, each with a room of size / 5 messages.
+    The list cache tests run with 30 friends, each with a room of 20 messages.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.accounts = seed_accounts(40)
+        cls.user = cls.accounts[0]
+        cls.friends = cls.accounts[1:31]
+        seed_friends(cls.user, cls.friends, messages=20)
+
+    def seed_fixture(self, size):
+        accounts = seed_accounts(size + 3, prefix=f"size{size}-")
+        user, friends = accounts[0], accounts[1:size + 1]
+        seed_friends(user, friends, messages=size // 5)
+        self.client.force_authenticate(user)
+        return SimpleNamespace(size=size, accounts=accounts, user=user, friends=friends)
+
+    def setUp(self):
+        get_cache().clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get(self, url, endpoint, budget):
+        with self.assertQueryBudget(endpoint, budget):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)
+
+    def test_room_list(self):
+        for fixture in self.sized_fixtures():
+            # rooms with the id of their last message + users prefetch + last messages
+            rooms = self.get('/api/private-chat/', 'private-chat:private-chat', 3)['private_chats']
+            self.assertEqual(len(rooms), fixture.size)
+            self.assertEqual({room['title'] for room in rooms}, {friend.username for friend in fixture.friends})
+            last_messages = {room['title']: room['last_message'] for room in rooms}
+            friend = fixture.friends[0]
+            last_message = PrivateRoomChatMessage.objects.filter(room__users=friend).order_by('-timestamp', 'id').first()
+            self.assertEqual(last_messages[friend.username]['message'], last_message.content)
+            self.assertEqual(last_messages[friend.username]['username'], last_message.user.username)
+
+    def test_room_list_without_messages(self):
+        for fixture in self.sized_fixtures():
+            user, friend = fixture.accounts[-2:]
+            seed_friends(user, [friend])
+            self.client.force_authenticate(user)
+            rooms = self.get('/api/private-chat/', 'private-chat:private-chat (no messages)', 2)['private_chats']
+            self.assertEqual([(room['title'], room['last_message']) for room in rooms], [(friend.username, None)])
+
+    @skipUnless(connection.vendor == 'sqlite', "EXPLAIN QUERY PLAN output of sqlite")
+    def test_room_list_plan(self):
+        with CaptureQueriesContext(connection) as queries:
+            rooms = get_private_chat_rooms(self.user)
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(sum(room.last_message is not None for room in rooms), 30)
+        plans = []
+        with connection.cursor() as cursor:
+            for query in (queries.captured_queries[0], queries.captured_queries[2]):
+                cursor.execute("EXPLAIN QUERY PLAN " + query['sql'])
+                plans.append([row[-1] for row in cursor.fetchall()])
+        # the last message of each room: one seek on the (room, -timestamp, id) index
+        self.assertIn('SEARCH U0 USING COVERING INDEX private_msg_room_ts_id_idx (room_id=?)', plans[0])
+        # then the messages by primary key, never a scan of the messages table
+        self.assertFalse([step for plan in plans for step in plan if step.startswith('SCAN')])
+
+    def test_room_list_etag(self):
+        response = self.client.get('/api/private-chat/')
+        etag = response['ETag']
+        # cached: neither the rooms nor a 304 query the database
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/api/private-chat/').data, response.data)
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/private-chat/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_room_list_invalidation(self):
+        etag = self.client.get('/api/private-chat/')['ETag']
+        friend = self.friends[0]
+        room = find_or_create_private_chat(self.user, friend)
+        PrivateRoomChatMessage.objects.create(user=friend, room=room, content="new message")
+        response = self.client.get('/api/private-chat/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        rooms = {room['title']: room for room in json.loads(response.data)['private_chats']}
+        self.assertEqual(rooms[friend.username]['last_message']['message'], "new message")
+        # unfriended: the room leaves the list of both users
+        etag = response['ETag']
+        FriendList.objects.get(user=self.user).unfriend(friend)
+        response = self.client.get('/api/private-chat/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(friend.username, {room['title'] for room in json.loads(response.data)['private_chats']})
+        # a member renamed
+        etag = response['ETag']
+        other = self.friends[1]
+        other.username = "renamed"
+        other.save()
+        response = self.client.get('/api/private-chat/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("renamed", {room['title'] for room in json.loads(response.data)['private_chats']})
+
+    def test_room_list_kept_on_unrelated_account_saves(self):
+        etag = self.client.get('/api/private-chat/')['ETag']
+        friend = Account.objects.get(id=self.friends[0].id)
+        friend.hide_email = True
+        with CaptureQueriesContext(connection) as queries:
+            friend.save()
+            update_last_login(None, friend)
+        # no lookup of the rooms of the user
+        self.assertFalse([query['sql'] for query in queries.captured_queries if 'private_chat' in query['sql']])
+        response = self.client.get('/api/private-chat/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    @override_settings(PRIVATE_CHAT_LIST_CACHE={'CACHE': 'default', 'WORKERS': 2})
+    def test_process_local_cache_refused_with_several_workers(self):
+        with self.assertRaises(ImproperlyConfigured):
+            check_shared_cache()
+
+    def test_find_or_create(self):
+        for fixture in self.sized_fixtures():
+            data = self.get(f'/api/private-chat/{fixture.friends[0].id}/', 'private-chat:private-chat-with-user', 4)
+            self.assertIsNotNone(data['room_id'])
+
+    def test_find_or_create_user_pair(self):
+        user, friend = self.accounts[33], self.accounts[34]
+        room = find_or_create_private_chat(friend, user)
+        self.assertEqual((room.min_user_id, room.max_user_id), (user.id, friend.id))
+        self.assertEqual(set(room.users.values_list('id', flat=True)), {user.id, friend.id})
+        # one lookup on the unique pair, whatever the order of the users
+        with self.assertNumQueries(1):
+            self.assertEqual(find_or_create_private_chat(user, friend).id, room.id)
 
-# Create your tests here.
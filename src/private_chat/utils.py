@@ -1,18 +1,77 @@
-from private_chat.models import PrivateChatRoom
-from django.db.models.query_utils import Q
-from django.db.models import Count
+from private_chat.chat_list_cache import invalidate_chat_lists
+from private_chat.models import PrivateChatRoom, PrivateRoomChatMessage
+from django.db import IntegrityError, transaction
+from django.db.models import OuterRef, Subquery
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from codenames_api.log import get_logger
+from codenames_api.metrics import group_send
+
+
+log = get_logger(__name__)
+
+
+def get_user_pair(user1, user2):
+    """
+    (min_user_id, max_user_id) key of the one-to-one room of 2 users
+    """
+    return (user1.id, user2.id) if user1.id < user2.id else (user2.id, user1.id)
 
 
 def find_or_create_private_chat(user1, user2):
     """
-    Find or create a 2 users chat room
+    Find or create a 2 users chat room, one lookup on the unique user pair.
+    Two concurrent creations of the same room: the loser of the insert gets the room of the winner.
     """
+    min_user_id, max_user_id = get_user_pair(user1, user2)
     try:
-        chat = PrivateChatRoom.objects.annotate(num_users=Count('users')).filter(Q(num_users=2) & Q(users__in=[user1])).get(users__in=[user2]) 
+        return PrivateChatRoom.objects.get(min_user_id=min_user_id, max_user_id=max_user_id)
     except PrivateChatRoom.DoesNotExist:
-        chat = PrivateChatRoom()
-        chat.save()
-        chat.users.add(user1)
-        chat.users.add(user2)
-        chat.save()
+        pass
+    try:
+        with transaction.atomic():
+            chat = PrivateChatRoom.objects.create(min_user_id=min_user_id, max_user_id=max_user_id)
+            chat.users.add(user1, user2)
+    except IntegrityError:
+        return PrivateChatRoom.objects.get(min_user_id=min_user_id, max_user_id=max_user_id)
+    invalidate_chat_lists([user1.id, user2.id])
     return chat
+
+
+def get_private_chat_rooms(user):
+    """
+    Active rooms of the user with their members (one prefetch query) and their last
+    message as room.last_message (None in a room without messages).
+    The rooms query carries the id of the last message, a correlated subquery per
+    room on the (room, -timestamp, id) index, same order as by_room; the messages
+    are then fetched in one query by id.
+    """
+    last_message = PrivateRoomChatMessage.objects.filter(room=OuterRef('pk')).order_by('-timestamp', 'id')
+    rooms = list(PrivateChatRoom.objects.filter(users=user, is_active=True).annotate(
+        last_message_id=Subquery(last_message.values('id')[:1]),
+    ).prefetch_related('users'))
+    messages = PrivateRoomChatMessage.objects.select_related('user').only(
+        'content', 'timestamp', 'user__username',
+    ).in_bulk([room.last_message_id for room in rooms if room.last_message_id is not None])
+    for room in rooms:
+        room.last_message = messages.get(room.last_message_id)
+    return rooms
+
+
+def invalidate_private_chat_room(room):
+    """
+    Tell the sockets connected to the room that the room or its members changed,
+    so they drop their cached room and check their permission again.
+    """
+    try:
+        async_to_sync(group_send)(
+            get_channel_layer(),
+            room.group_name,
+            {
+                "type": "room.invalidate",
+                "room_id": room.id,
+            }
+        )
+    except Exception:
+        log.exception("invalidate_private_chat_room", room_id=room.id)
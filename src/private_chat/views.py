@@ -11,8 +11,13 @@ from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework_jwt.authentication import JSONWebTokenAuthentication
 
+from django.conf import settings
+from django.utils.http import parse_etags
+
+from private_chat.chat_list_cache import get_cached_chat_list, set_cached_chat_list
 from private_chat.models import PrivateChatRoom
-from private_chat.utils import find_or_create_private_chat
+from private_chat.utils import find_or_create_private_chat, get_private_chat_rooms
+from public_chat.serializers import calculate_timestamp, timestamp_epoch_ms
 from itertools import chain
 from django.db.models.query_utils import Q
 from account.serializers import AccountSerializer
@@ -27,31 +32,54 @@ class PrivateChatRoomView(RetrieveAPIView):
     account_serialiser_class = AccountSerializer
 
     def get(self, request):
-        # find all the rooms this user is part of
-        rooms = PrivateChatRoom.objects.filter(users__in=[request.user], is_active=True)
+        """
+        The list is cached per user until one of its rooms, members or last messages
+        changes (see chat_list_cache), with an ETag: 304 without any query when the
+        client already has it.
+        """
+        version, cached = get_cached_chat_list(request.user.id)
+        if cached is not None:
+            return self.cached_response(request, cached['body'], cached['etag'])
+        response = self.render_rooms(request)
+        return self.cached_response(request, response, set_cached_chat_list(request.user.id, version, response))
+
+    def cached_response(self, request, body, etag):
+        etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+        if etag in etags or '*' in etags:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(body, status=status.HTTP_200_OK)
+        response['ETag'] = etag
+        return response
+
+    def render_rooms(self, request):
+        # find all the rooms this user is part of, with their users and last message
+        rooms = get_private_chat_rooms(request.user)
         private_chats = []
         status_code = status.HTTP_200_OK
+        # a user is in many rooms of the list, serialized once
+        serialized_users = {}
         # message_and_friend:
         # {"room_id": id, "users": Account[]}
         for room in rooms:
+            # prefetched, no query
+            room_users = list(room.users.all())
             title = ''
             is_title_set = False
             chat_image = room.chat_image.url
             if room.title:
                 title = room.title
             else:
-                if len(room.users.all()) ==2:
-                    if (room.users.all()[0] == request.user):
-                        title = room.users.all()[1].username
-                        chat_image = room.users.all()[1].profile_image.url
-                        is_title_set = True
-                    else:
-                        title = room.users.all()[0].username
-                        chat_image = room.users.all()[0].profile_image.url
-                        is_title_set = True
+                if len(room_users) == 2:
+                    other = room_users[1] if room_users[0] == request.user else room_users[0]
+                    title = other.username
+                    chat_image = other.profile_image.url
+                    is_title_set = True
             users = []
-            for user in room.users.all():
-                users.append(self.account_serialiser_class(user).data)
+            for user in room_users:
+                if user.id not in serialized_users:
+                    serialized_users[user.id] = self.account_serialiser_class(user).data
+                users.append(serialized_users[user.id])
                 if not is_title_set and user != request.user:
                     if title != '':
                         title += ', '
@@ -60,14 +88,31 @@ class PrivateChatRoomView(RetrieveAPIView):
                 "id" : room.id,
                 "title": title,
                 "chatImage": chat_image,
-                "users": users
+                "users": users,
+                "last_message": self.get_last_message(room),
             })
-        response = JSONRenderer().render({
+        return JSONRenderer().render({
                 'success': True,
                 'status_code': status_code,
                 'private_chats': private_chats
             })
-        return Response(response, status=status_code)
+
+    def get_last_message(self, room):
+        """
+        Preview of the last message of the room (fetched by get_private_chat_rooms), None without messages
+        """
+        message = room.last_message
+        if message is None:
+            return None
+        last_message = {
+            "user_id": message.user_id,
+            "username": message.user.username,
+            "message": message.content,
+            "timestamp": calculate_timestamp(message.timestamp),
+        }
+        if getattr(settings, 'CHAT_TIMESTAMP_EPOCH_MS', False):
+            last_message["timestamp_ms"] = timestamp_epoch_ms(message.timestamp)
+        return last_message
 
 
 class PrivateChatRoomFindOrCreateView(RetrieveAPIView):
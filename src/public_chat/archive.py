@@ -0,0 +1,194 @@
+import gzip
+import json
+import os
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+
+DEFAULT_CHAT_ARCHIVE = {
+    'ENABLED': False,
+    'ROOT': None,          # directory of the archive segments
+    'AFTER_DAYS': 180,     # months older than this are moved out of the database
+}
+
+
+def get_chat_archive_config():
+    config = dict(DEFAULT_CHAT_ARCHIVE)
+    config.update(getattr(settings, 'CHAT_ARCHIVE', {}))
+    return config
+
+
+def is_chat_archive_enabled():
+    return get_chat_archive_config()['ENABLED']
+
+
+class ChatArchive:
+    """
+    Cold storage of the chat messages of one model (public or private).
+    One gzip NDJSON segment per room and month:
+        <root>/<app_label>/<room_id>/<YYYY-MM>.ndjson.gz
+    plus <root>/<app_label>/<room_id>/index.json ({month: number of messages}).
+    Segments are append-only (a new gzip member per archiving run), a row
+    appended twice after an interrupted run is dropped when read (same id).
+    Every archived message is older than every message left in the database,
+    so the history reads the database first then the segments, most recent month first.
+    """
+
+    def __init__(self, model, root):
+        self.model = model
+        self.root = os.path.join(root, model._meta.app_label)
+
+    def room_dir(self, room_id):
+        return os.path.join(self.root, str(room_id))
+
+    def segment_path(self, room_id, month):
+        return os.path.join(self.room_dir(room_id), f"{month}.ndjson.gz")
+
+    def index_path(self, room_id):
+        return os.path.join(self.room_dir(room_id), "index.json")
+
+    def index(self, room_id):
+        """
+        {month: number of messages} of the room, {} if nothing is archived
+        """
+        try:
+            with open(self.index_path(room_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def months(self, room_id):
+        """
+        Archived months of the room, most recent first
+        """
+        return sorted(self.index(room_id), reverse=True)
+
+    def count(self, room_id):
+        return sum(self.index(room_id).values())
+
+    def append(self, room_id, month, messages):
+        """
+        Append messages (model instances of one room and month) to their segment
+        and update the room index.
+        """
+        os.makedirs(self.room_dir(room_id), exist_ok=True)
+        with gzip.open(self.segment_path(room_id, month), "at", encoding="utf-8") as f:
+            for message in messages:
+                f.write(json.dumps({
+                    'id': message.id,
+                    'user_id': message.user_id,
+                    'content': message.content,
+                    'timestamp': message.timestamp.isoformat(),
+                }))
+                f.write("\n")
+            f.flush()
+            os.fsync(f.fileno())
+        index = self.index(room_id)
+        index[month] = len(self.read_segment(room_id, month))
+        tmp_path = self.index_path(room_id) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path(room_id))
+
+    def read_segment(self, room_id, month):
+        """
+        Records of a segment in the history order (most recent first, then id)
+        """
+        records = {}
+        with gzip.open(self.segment_path(room_id, month), "rt", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                record['timestamp'] = parse_datetime(record['timestamp'])
+                records[record['id']] = record
+        records = sorted(records.values(), key=lambda r: r['id'])
+        return sorted(records, key=lambda r: r['timestamp'], reverse=True)
+
+    def slice(self, room_id, start, stop):
+        """
+        Archived messages [start:stop] of the room, in the history order
+        """
+        records = []
+        offset = 0
+        index = self.index(room_id)
+        for month in sorted(index, reverse=True):
+            count = index[month]
+            if offset + count > start:
+                records += self.read_segment(room_id, month)[max(start - offset, 0):stop - offset]
+            offset += count
+            if offset >= stop:
+                break
+        return self.to_messages(room_id, records)
+
+    def before(self, room_id, timestamp, message_id, limit):
+        """
+        Up to `limit` archived messages after the (timestamp, id) cursor in the history order,
+        cursor None: from the most recent archived message
+        """
+        records = []
+        # segments are named after the month in the current time zone (TruncMonth)
+        cursor_month = timezone.localtime(timestamp).strftime("%Y-%m") if timestamp else None
+        for month in self.months(room_id):
+            if cursor_month and month > cursor_month:
+                continue
+            for record in self.read_segment(room_id, month):
+                if timestamp is None or record['timestamp'] < timestamp or (record['timestamp'] == timestamp and record['id'] > message_id):
+                    records.append(record)
+                    if len(records) == limit:
+                        return self.to_messages(room_id, records)
+        return self.to_messages(room_id, records)
+
+    def to_messages(self, room_id, records):
+        """
+        Unsaved model instances for the records, authors fetched in one query.
+        Messages of deleted accounts are skipped, as the database cascade would have.
+        """
+        if not records:
+            return []
+        users = get_user_model().objects.only('id', 'username', 'profile_image').in_bulk({r['user_id'] for r in records})
+        return [
+            self.model(id=r['id'], room_id=room_id, user=users[r['user_id']], content=r['content'], timestamp=r['timestamp'])
+            for r in records if r['user_id'] in users
+        ]
+
+
+@lru_cache(maxsize=None)
+def get_chat_archive(model):
+    """
+    Archive of a chat message model, configured by settings.CHAT_ARCHIVE
+    """
+    return ChatArchive(model, get_chat_archive_config()['ROOT'])
+
+
+class ArchivedRoomMessages:
+    """
+    by_room queryset followed by the archived messages of the room,
+    sliced and counted like a queryset so page numbers go on into the archive.
+    """
+    ordered = True
+
+    def __init__(self, qs, archive, room):
+        self.qs = qs
+        self.archive = archive
+        self.room = room
+        self.hot_count = None
+
+    def count(self):
+        if self.hot_count is None:
+            self.hot_count = self.qs.count()
+        return self.hot_count + self.archive.count(self.room.id)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, s):
+        hot_count = self.count() - self.archive.count(self.room.id)
+        messages = []
+        if s.start < hot_count:
+            messages += list(self.qs[s.start:min(s.stop, hot_count)])
+        if s.stop > hot_count:
+            messages += self.archive.slice(self.room.id, max(s.start - hot_count, 0), s.stop - hot_count)
+        return messages
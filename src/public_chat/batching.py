@@ -0,0 +1,128 @@
+import asyncio
+import math
+import time
+
+from django.conf import settings
+
+from codenames_api.log import get_logger
+from codenames_api.metrics import MESSAGE_BATCH_DELAY, MESSAGE_BATCH_SIZE
+from private_chat.exceptions import ClientError
+
+
+log = get_logger(__name__)
+
+
+DEFAULT_CHAT_MESSAGE_BATCHING = {
+    'MAX_WINDOW_MS': 50,    # longest batching window a client can ask for (latency cap)
+    'MAX_SIZE': 100,        # a batch is sent as soon as it holds this many messages
+}
+
+
+def get_batching_config():
+    config = dict(DEFAULT_CHAT_MESSAGE_BATCHING)
+    config.update(getattr(settings, 'CHAT_MESSAGE_BATCHING', {}))
+    return config
+
+
+def parse_window_ms(window_ms):
+    """
+    window_ms of a set_batch_window command, ClientError if it is not a number >= 0
+    (missing means 0, batching off)
+    """
+    if window_ms is None:
+        return 0
+    if type(window_ms) not in (int, float) or not math.isfinite(window_ms) or window_ms < 0:
+        # HTTPstatus 422
+        raise ClientError(422, "window_ms must be a number of milliseconds >= 0.")
+    return int(window_ms)
+
+
+class MessageBatchingMixin:
+    """
+    Optional micro-batching of the chat.message events of one connection.
+    A client sending {"command": "set_batch_window", "window_ms": 30} gets the new
+    messages arriving within the window in one messages_batch frame
+    (MSG_TYPE_MESSAGES_BATCH), the window starts with the first message and is
+    capped by CHAT_MESSAGE_BATCHING['MAX_WINDOW_MS']. window_ms 0 turns it off.
+    Every other frame goes out right away, after the pending batch (order is kept).
+    The frames are encoded once by the sender, a batch only joins them.
+    """
+    batch_window = 0
+    batch = None
+    batch_started = None
+    batch_timer = None
+    batch_flush_task = None
+    batches_sent = 0
+    batched_messages = 0
+    max_batch_delay = 0
+
+    async def set_batch_window(self, window_ms):
+        config = get_batching_config()
+        window_ms = min(parse_window_ms(window_ms), config['MAX_WINDOW_MS'])
+        await self.flush_batch()
+        self.batch_window = window_ms / 1000
+        self.batch_max_size = config['MAX_SIZE']
+        await self.send_json({"batch_window_ms": window_ms})
+
+    async def send_pre_encoded(self, event):
+        """
+        Send a chat.message event encoded by the sender, batched if the client asked for it
+        """
+        if not self.batch_window:
+            await self.send(**self.pre_encoded_frame(event))
+            return
+        if not self.batch:
+            self.batch = []
+            self.batch_started = time.monotonic()
+            self.batch_timer = asyncio.get_event_loop().call_later(self.batch_window, self.batch_window_closed)
+        self.batch.append(event)
+        if len(self.batch) >= self.batch_max_size:
+            await self.flush_batch()
+
+    def batch_window_closed(self):
+        self.batch_flush_task = asyncio.ensure_future(self.flush_batch())
+        self.batch_flush_task.add_done_callback(self.batch_flushed)
+
+    def batch_flushed(self, task):
+        if self.batch_flush_task is task:
+            self.batch_flush_task = None
+        if not task.cancelled() and task.exception() is not None:
+            log.error("message_batch_flush_failed", consumer=self.metrics_label, error=repr(task.exception()))
+
+    async def flush_batch(self):
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, None
+        self.batches_sent += 1
+        self.batched_messages += len(batch)
+        delay = time.monotonic() - self.batch_started
+        self.max_batch_delay = max(self.max_batch_delay, delay)
+        MESSAGE_BATCH_SIZE.observe(len(batch), consumer=self.metrics_label)
+        MESSAGE_BATCH_DELAY.observe(delay, consumer=self.metrics_label)
+        if len(batch) == 1:
+            await self.send(**self.pre_encoded_frame(batch[0]))
+        else:
+            await self.send(**self.pre_encoded_batch(batch))
+
+    def batch_stats(self):
+        return {
+            'batch_window_ms': int(self.batch_window * 1000),
+            'batches_sent': self.batches_sent,
+            'batched_messages': self.batched_messages,
+            'max_batch_delay_ms': self.max_batch_delay * 1000,
+        }
+
+    async def send_json(self, content, close=False, **kwargs):
+        await self.flush_batch()
+        await super().send_json(content, close=close, **kwargs)
+
+    async def websocket_disconnect(self, message):
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+        if self.batch_flush_task is not None:
+            # a batch going out when the window closed: let it finish first (a failure is logged by batch_flushed)
+            await asyncio.wait([self.batch_flush_task])
+        await super().websocket_disconnect(message)
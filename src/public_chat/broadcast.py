@@ -0,0 +1,108 @@
+import asyncio
+from functools import lru_cache, partial
+
+from django.conf import settings
+
+from codenames_api.log import get_logger
+from codenames_api.metrics import (
+    CONNECTED_USER_COUNT_PENDING_GROUPS,
+    CONNECTED_USER_COUNT_SENT,
+    CONNECTED_USER_COUNT_SUPPRESSED,
+)
+from public_chat.sharding import get_sharded_groups
+
+
+log = get_logger(__name__)
+
+
+DEFAULT_CONNECTED_USER_COUNT_BROADCAST_WINDOW = 0.5  # seconds
+
+
+class CoalescingGroupBroadcaster:
+    """
+    Send at most one event per group every `window` seconds.
+    - the first event of a quiet group goes out right away
+    - events published during the window replace each other, only the latest
+      one is sent when the window ends
+    Used for connected user count updates: during join/leave storms clients only
+    need the last value, not every intermediate one.
+    Windows are per process, each worker sends at most one event per window.
+    Events go to every sub-group of a sharded room (see ShardedGroups).
+    """
+
+    def __init__(self, window):
+        self.window = window
+        # group name -> latest event waiting for the end of the window (None: nothing waiting)
+        self.pending = {}
+        # group name -> task closing its window
+        self.windows = {}
+        self.sent = 0
+        self.suppressed = 0
+
+    async def publish(self, channel_layer, group_name, event):
+        if not self.window:
+            return await self.send(channel_layer, group_name, event)
+        if group_name in self.pending:
+            # window open: keep only the latest event
+            if self.pending[group_name] is not None:
+                self.suppressed += 1
+                CONNECTED_USER_COUNT_SUPPRESSED.inc()
+            self.pending[group_name] = event
+            return
+        self.pending[group_name] = None
+        try:
+            await self.send(channel_layer, group_name, event)
+        finally:
+            # the events published meanwhile still go out at the end of the window
+            task = self.windows[group_name] = asyncio.ensure_future(self.close_window(channel_layer, group_name))
+            task.add_done_callback(partial(self.window_closed, group_name))
+
+    async def close_window(self, channel_layer, group_name):
+        """
+        Flush the latest event at the end of each window until the group is quiet again.
+        """
+        try:
+            while True:
+                await asyncio.sleep(self.window)
+                event = self.pending.get(group_name)
+                if event is None:
+                    break
+                self.pending[group_name] = None
+                try:
+                    await self.send(channel_layer, group_name, event)
+                except Exception:
+                    # the next window sends the latest count again, if any
+                    log.exception("connected_user_count_send_failed", group=group_name)
+        finally:
+            self.pending.pop(group_name, None)
+
+    def window_closed(self, group_name, task):
+        if self.windows.get(group_name) is task:
+            del self.windows[group_name]
+        if not task.cancelled() and task.exception() is not None:
+            log.error("connected_user_count_window_failed", group=group_name, error=repr(task.exception()))
+
+    async def send(self, channel_layer, group_name, event):
+        self.sent += 1
+        CONNECTED_USER_COUNT_SENT.inc()
+        await get_sharded_groups().send(channel_layer, group_name, event)
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'suppressed': self.suppressed,
+            'pending_groups': len(self.pending),
+        }
+
+
+@lru_cache(maxsize=None)
+def get_connected_user_count_broadcaster():
+    """
+    Broadcaster for connected.user.count events, window from
+    settings.CONNECTED_USER_COUNT_BROADCAST_WINDOW (seconds, 0 disables coalescing)
+    """
+    window = getattr(settings, 'CONNECTED_USER_COUNT_BROADCAST_WINDOW', DEFAULT_CONNECTED_USER_COUNT_BROADCAST_WINDOW)
+    return CoalescingGroupBroadcaster(window)
+
+
+CONNECTED_USER_COUNT_PENDING_GROUPS.set_function(lambda: get_connected_user_count_broadcaster().stats()['pending_groups'])
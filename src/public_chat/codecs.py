@@ -0,0 +1,208 @@
+import json
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from public_chat.constants import MSG_TYPE_MESSAGES_BATCH, MSGPACK_FRAME_KEYS, MSGPACK_SUBPROTOCOL
+
+
+DEFAULT_WEBSOCKET_JSON_CODEC = 'public_chat.codecs.JsonCodec'
+
+
+class JsonCodec:
+    """
+    Standard library json, always available.
+    """
+
+    def dumps(self, content):
+        return json.dumps(content)
+
+    def loads(self, text_data):
+        return json.loads(text_data)
+
+
+class OrjsonCodec:
+    """
+    orjson (pip install orjson), several times faster than json.
+    """
+
+    def __init__(self):
+        try:
+            import orjson
+        except ImportError:
+            raise ImproperlyConfigured("OrjsonCodec requires the orjson package.")
+        self.orjson = orjson
+
+    def dumps(self, content):
+        # orjson returns bytes, websocket text frames are str
+        return self.orjson.dumps(content).decode()
+
+    def loads(self, text_data):
+        return self.orjson.loads(text_data)
+
+
+class UjsonCodec:
+    """
+    ujson (pip install ujson).
+    """
+
+    def __init__(self):
+        try:
+            import ujson
+        except ImportError:
+            raise ImproperlyConfigured("UjsonCodec requires the ujson package.")
+        self.ujson = ujson
+
+    def dumps(self, content):
+        return self.ujson.dumps(content, ensure_ascii=False)
+
+    def loads(self, text_data):
+        return self.ujson.loads(text_data)
+
+
+class MessagePackCodec:
+    """
+    Binary frames of the MSGPACK_SUBPROTOCOL: keys of MSGPACK_FRAME_KEYS are sent as
+    small integers (message types already are, MSG_TYPE_*) and profile images
+    without the MEDIA_URL prefix. Frames received are plain maps with string keys.
+    """
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            raise ImproperlyConfigured("MessagePackCodec requires the msgpack package.")
+        self.msgpack = msgpack
+        self.media_url = settings.MEDIA_URL
+
+    def dumps(self, content):
+        return self.msgpack.packb(self.compact(content), use_bin_type=True)
+
+    def dumps_batch(self, frames):
+        """
+        messages_batch frame of frames already encoded, without decoding them
+        """
+        packer = self.msgpack.Packer(use_bin_type=True)
+        return b"".join([
+            packer.pack_map_header(2),
+            packer.pack(MSGPACK_FRAME_KEYS["message_type"]),
+            packer.pack(MSG_TYPE_MESSAGES_BATCH),
+            packer.pack(MSGPACK_FRAME_KEYS["messages"]),
+            packer.pack_array_header(len(frames)),
+            *frames,
+        ])
+
+    def loads(self, bytes_data):
+        return self.msgpack.unpackb(bytes_data, raw=False)
+
+    def compact(self, content):
+        if type(content) is list:
+            return [self.compact(value) for value in content]
+        if type(content) is not dict:
+            return content
+        frame = {}
+        for key, value in content.items():
+            if type(value) is dict or type(value) is list:
+                value = self.compact(value)
+            elif key == "profile_image" and type(value) is str and value.startswith(self.media_url):
+                value = value[len(self.media_url):]
+            frame[MSGPACK_FRAME_KEYS.get(key, key)] = value
+        return frame
+
+
+@lru_cache(maxsize=None)
+def get_msgpack_codec():
+    return MessagePackCodec()
+
+
+@lru_cache(maxsize=None)
+def get_json_codec():
+    """
+    JSON codec of the chat websockets, settings.WEBSOCKET_JSON_CODEC (dotted path)
+    """
+    return import_string(getattr(settings, 'WEBSOCKET_JSON_CODEC', DEFAULT_WEBSOCKET_JSON_CODEC))()
+
+
+@lru_cache(maxsize=1024)
+def msgpack_from_json(text):
+    """
+    MessagePack frame of a JSON frame encoded by the sender, converted once per process
+    for all the binary sockets receiving the same group event.
+    """
+    return get_msgpack_codec().dumps(get_json_codec().loads(text))
+
+
+class JsonCodecMixin:
+    """
+    send_json / receive_json of the chat consumers through the configured codec.
+    """
+
+    @classmethod
+    async def decode_json(cls, text_data):
+        return get_json_codec().loads(text_data)
+
+    @classmethod
+    async def encode_json(cls, content):
+        return get_json_codec().dumps(content)
+
+    async def encode_frame(self, content):
+        """
+        send() kwargs of a frame
+        """
+        return {'text_data': await self.encode_json(content)}
+
+    def pre_encoded_frame(self, event):
+        """
+        send() kwargs of a frame encoded once by the sender (the 'text' of a group event)
+        """
+        return {'text_data': event['text']}
+
+    def pre_encoded_batch(self, events):
+        """
+        send() kwargs of a messages_batch frame of pre encoded events, joined as is
+        """
+        messages = ", ".join(event['text'] for event in events)
+        return {'text_data': f'{{"message_type": {MSG_TYPE_MESSAGES_BATCH}, "messages": [{messages}]}}'}
+
+
+class MessagePackProtocolMixin:
+    """
+    Negotiated binary protocol of the chat consumers. A client offering the
+    MSGPACK_SUBPROTOCOL gets MessagePack binary frames and may send its commands
+    as MessagePack, every other client keeps the JSON text frames.
+    Group events only carry the JSON 'text', the binary sockets convert it
+    (msgpack_from_json) so JSON-only rooms never pay for the second encoding.
+    """
+    binary_protocol = False
+
+    async def accept(self, subprotocol=None):
+        if subprotocol is None and MSGPACK_SUBPROTOCOL in self.scope.get('subprotocols', ()):
+            self.binary_protocol = True
+            subprotocol = MSGPACK_SUBPROTOCOL
+        await super().accept(subprotocol)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if bytes_data is not None:
+            await self.receive_json(get_msgpack_codec().loads(bytes_data), **kwargs)
+        else:
+            await super().receive(text_data=text_data, bytes_data=bytes_data, **kwargs)
+
+    async def send_json(self, content, close=False):
+        await self.send(close=close, **await self.encode_frame(content))
+
+    async def encode_frame(self, content):
+        if self.binary_protocol:
+            return {'bytes_data': get_msgpack_codec().dumps(content)}
+        return await super().encode_frame(content)
+
+    def pre_encoded_frame(self, event):
+        if self.binary_protocol:
+            return {'bytes_data': msgpack_from_json(event['text'])}
+        return super().pre_encoded_frame(event)
+
+    def pre_encoded_batch(self, events):
+        if self.binary_protocol:
+            return {'bytes_data': get_msgpack_codec().dumps_batch([msgpack_from_json(event['text']) for event in events])}
+        return super().pre_encoded_batch(events)
@@ -2,5 +2,40 @@ MSG_TYPE_NEW_MESSAGE = 0          # standard message type
 MSG_TYPE_CONNECTED_USER_COUNT = 1  # number of connected user message type
 MSG_TYPE_ENTER = 2
 MSG_TYPE_LEAVE = 3
+MSG_TYPE_MESSAGES_BATCH = 4  # messages_batch: several new messages in one frame
 
-DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE = 30
\ No newline at end of file
+DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE = 30
+
+# websocket commands of the chat consumers
+CHAT_COMMANDS = ("join", "leave", "send", "get_chatroom_messages", "set_batch_window", "get_user_info")
+
+# websocket subprotocol of the MessagePack binary frames (see public_chat.codecs.MessagePackCodec)
+MSGPACK_SUBPROTOCOL = "codenames.msgpack.v1"
+
+# short integer keys of the MessagePack frames, other keys are sent as is
+MSGPACK_FRAME_KEYS = {
+    "message_type": 0,
+    "user_id": 1,
+    "username": 2,
+    "message": 3,
+    "profile_image": 4,
+    "timestamp": 5,
+    "timestamp_ms": 6,
+    "connected_user_count": 7,
+    "messages_payload": 8,
+    "messages": 9,
+    "new_page_number": 10,
+    "next_cursor": 11,
+    "id": 12,
+    "error": 13,
+    "join": 14,
+    "leave": 15,
+    "room": 16,
+}
+
+# websocket close code of a client too slow to read its messages (see OutboundQueueMixin):
+# 1008 (policy violation) in the private range, Daphne (autobahn) only sends 1000 or 3000-4999
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+# columns read by the chat history (LazyRoomChatMessageEncoder), see by_room
+CHAT_HISTORY_FIELDS = ("id", "timestamp", "content", "user__id", "user__username", "user__profile_image")
\ No newline at end of file
@@ -1,11 +1,23 @@
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from channels.db import database_sync_to_async
+
+import logging
+import time
 
 from django.core.paginator import Paginator
-import json
-from public_chat.serializers import LazyRoomChatMessageEncoder, calculate_timestamp
+from public_chat.serializers import LazyRoomChatMessageEncoder, encode_new_message_event
+from public_chat.pagination import get_messages_page_before
+from public_chat.codecs import JsonCodecMixin, MessagePackProtocolMixin
+from public_chat.outbound import OutboundQueueMixin
+from public_chat.batching import MessageBatchingMixin
+from public_chat.archive import ArchivedRoomMessages, get_chat_archive, is_chat_archive_enabled
+from public_chat.recent_messages import append_recent_message, get_recent_chat_messages, is_first_page
+from public_chat.write_behind import get_write_behind_buffer, is_write_behind_enabled
+from public_chat.presence import get_presence_store
+from public_chat.broadcast import get_connected_user_count_broadcaster
+from public_chat.sharding import get_sharded_groups
+from codenames_api.log import get_logger
+from codenames_api.metrics import ConsumerMetricsMixin, COMMAND_DURATION, command_label, metered_database_sync_to_async
 
-from django.utils import timezone
 from public_chat.models import PublicChatRoom, PublicRoomChatMessage
 from public_chat.constants import (
     MSG_TYPE_CONNECTED_USER_COUNT,
@@ -15,22 +27,31 @@ from public_chat.constants import (
 from private_chat.exceptions import ClientError
 
 
+log = get_logger(__name__)
+
+
+class PublicChatConsumer(MessageBatchingMixin, OutboundQueueMixin, ConsumerMetricsMixin, MessagePackProtocolMixin, JsonCodecMixin, AsyncJsonWebsocketConsumer):
+
+    metrics_label = "public_chat"
 
-class PublicChatConsumer(AsyncJsonWebsocketConsumer):
+    def metrics_room_types(self):
+        return ('public',) if getattr(self, 'room_id', None) is not None else ()
 
     async def connect(self):
         """
         Called when the websocket is handshaking as part of initial connection
         """
-        print("[PublicChatConsumer] connect: " + str(self.scope['user']))
+        log.debug("connect", user_id=self.scope['user'].id)
         await self.accept()
         self.room_id = None
+        # room group name -> (sub-)group joined, see ShardedGroups
+        self.room_groups = {}
 
     async def disconnect(self, code):
         """
         Called when the websocket for any reason
         """
-        print("[PublicChatConsumer] disconnect")
+        log.debug("disconnect", user_id=self.scope['user'].id, room_id=self.room_id, code=code)
         try:
             if self.room_id != None:
                await self.leave_room(self.room_id) 
@@ -43,7 +64,7 @@ class PublicChatConsumer(AsyncJsonWebsocketConsumer):
         Channels will JSON-decode the payload and pass it as the first argiment.
         """
         command = content.get("command", None)
-        print("[PublicChatConsumer] recieve json: " + str(command))
+        start = time.perf_counter()
         try:
             if command == 'send':
                 if len(content['message'].lstrip()) == 0:
@@ -54,23 +75,42 @@ class PublicChatConsumer(AsyncJsonWebsocketConsumer):
                 await self.join_room(content['room_id'])
             elif command == 'leave':
                 await self.leave_room(content['room_id'])
+            elif command == 'set_batch_window':
+                await self.set_batch_window(content.get('window_ms'))
             elif command == 'get_chatroom_messages':
                 room = await get_room_or_error(content['room_id'])
-                payload = await get_room_chat_message(room, content['page_number'])
+                payload = None
+                if is_first_page(content):
+                    # opening the room: served from the room recent messages
+                    payload = await get_recent_chat_messages(room, PublicRoomChatMessage.objects, 'before' in content)
+                if payload == None and 'before' in content:
+                    # keyset pagination, 'before' is None for the most recent page
+                    payload = await get_room_chat_message_before(room, content['before'])
+                elif payload == None:
+                    payload = await get_room_chat_message(room, content['page_number'])
                 if payload != None:
-                    payload = json.loads(payload)
-                    await self.send_messages_payload(payload['messages'], payload['new_page_number'])
+                    await self.send_messages_payload(payload['messages'], payload['new_page_number'], payload.get('next_cursor'))
                 else:
                     raise ClientError(204, "Something went wrong retrieving chatroom messages.")
         except ClientError as e:
             await self.handle_client_error(e)
+        duration = time.perf_counter() - start
+        COMMAND_DURATION.observe(duration, consumer=self.metrics_label, command=command_label(command))
+        if log.is_enabled(logging.DEBUG):
+            log.debug(
+                "command",
+                command=command,
+                room_id=content.get('room_id'),
+                user_id=self.scope['user'].id,
+                duration_ms=duration * 1000,
+            )
         
 
     async def send_room(self, room_id, message):
         """
         Called by receive_json when someone send a message to a room
         """
-        print("[PublicChatConsumer][send_room] send a message to room " + str(room_id))
+        log.debug("send_room", room_id=room_id, user_id=self.scope['user'].id)
         if self.room_id != None:
             if str(room_id) != str(self.room_id):
                 raise ClientError(403, "Room acces denied.")
@@ -79,15 +119,20 @@ class PublicChatConsumer(AsyncJsonWebsocketConsumer):
         else:
             raise ClientError(403, "Room acces denied.")
         room = await get_room_or_error(room_id)
-        await create_public_room_chat_message(room, self.scope['user'], message)
-        await self.channel_layer.group_send(
+        if is_write_behind_enabled():
+            # broadcast right away, the message is saved with the next batch
+            chat_message = await get_write_behind_buffer(PublicRoomChatMessage).append(user=self.scope['user'], room=room, content=message)
+            await append_recent_message(room, self.scope['user'], message, chat_message)
+        else:
+            chat_message = await create_public_room_chat_message(room, self.scope['user'], message)
+            await append_recent_message(room, self.scope['user'], message, chat_message)
+        await get_sharded_groups().send(
+            self.channel_layer,
             room.group_name,
             {
                 "type": "chat.message", # relate to the method chat_message
-                "profile_image": self.scope['user'].profile_image.url,
-                "username": self.scope['user'].username,
                 "user_id": self.scope['user'].id,
-                "message": message
+                **encode_new_message_event(self.scope['user'], message, room.room_tag),
             }
         )
 
@@ -96,45 +141,41 @@ class PublicChatConsumer(AsyncJsonWebsocketConsumer):
         Called when someone has messaged our chat
         """
         # send a message down to the client
-        print("[PublicChatConsumer] chat_message from user #: " + str(event['user_id']))
-        timestamp = calculate_timestamp(timezone.now())
-        await self.send_json({
-            "message_type": MSG_TYPE_NEW_MESSAGE,
-            "profile_image": event['profile_image'],
-            "username": event['username'],
-            "user_id": event['user_id'],
-            "message": event['message'],
-            "timestamp": timestamp            
-        })
+        if log.is_enabled(logging.DEBUG):
+            log.debug("chat_message", room_id=self.room_id, from_user_id=event['user_id'], user_id=self.scope['user'].id)
+        # already encoded by the sender, nothing to do per recipient
+        await self.send_pre_encoded(event)
 
     async def join_room(self, room_id):
         """
         Called by receive_json when someone sent a JOIN command
         """
-        print("[PublicChatConsumer][join_room] room_id: " + str(room_id))
+        log.debug("join_room", room_id=room_id, user_id=self.scope['user'].id)
         is_auth = is_authenticated(self.scope['user'])
         try:
             room = await get_room_or_error(room_id)
         except ClientError as e:
             await self.handle_client_error(e)
-        # add user to the users list for room
+        # add user to the room presence
         if is_auth:
-            await connect_user(room, self.scope['user'])
+            await get_presence_store().add(room.group_name, self.scope['user'].id)
         # store that they're in the room
         self.room_id = room.id
-        # add them to the group so they get room messages
-        await self.channel_layer.group_add(room.group_name, self.channel_name)
+        # add them to the group (or its sub-group) so they get room messages
+        self.room_groups[room.group_name] = await get_sharded_groups().add(self.channel_layer, room.group_name, self.channel_name)
         # tell the client to finish opening the room
         await self.send_json({
             "join": str(room_id),
             "username": self.scope['user'].username
         })
-        # send the num of connected user to everyone
-        await self.channel_layer.group_send(
+        # send the num of connected user to everyone (coalesced during join/leave storms)
+        await get_connected_user_count_broadcaster().publish(
+            self.channel_layer,
             room.group_name,
             {
                 "type": "connected.user.count",
-                "connected_user_count": get_num_connected_users(room)
+                "room": room.room_tag,
+                "connected_user_count": await get_presence_store().count(room.group_name)
             }
         )
     
@@ -142,37 +183,41 @@ class PublicChatConsumer(AsyncJsonWebsocketConsumer):
         """
         Called by receive_json when someone sent a LEAVE command
         """
-        print("[PublicChatConsumer][leave_room] room_id: " + str(room_id))
+        log.debug("leave_room", room_id=room_id, user_id=self.scope['user'].id)
         is_auth = is_authenticated(self.scope['user'])
         try:
             room = await get_room_or_error(room_id)
         except ClientError as e:
             await self.handle_client_error(e)
-        # remove user from users list for room
-        await disconnect_user(room, self.scope['user'])
+        # remove user from the room presence
+        if is_auth:
+            await get_presence_store().remove(room.group_name, self.scope['user'].id)
         # Remove that they're in the room
         self.room_id = None
         # Remove them to the group so they no longer receive room messages
-        await self.channel_layer.group_discard(room.group_name, self.channel_name)
-        # send the num of connected user to everyone
-        await self.channel_layer.group_send(
+        await get_sharded_groups().discard(self.channel_layer, room.group_name, self.room_groups.pop(room.group_name, None), self.channel_name)
+        # send the num of connected user to everyone (coalesced during join/leave storms)
+        await get_connected_user_count_broadcaster().publish(
+            self.channel_layer,
             room.group_name,
             {
                 "type": "connected.user.count",
-                "connected_user_count": get_num_connected_users(room)
+                "room": room.room_tag,
+                "connected_user_count": await get_presence_store().count(room.group_name)
             }
         )
     
 
-    async def send_messages_payload(self, messages, new_page_number):
+    async def send_messages_payload(self, messages, new_page_number, next_cursor=None):
         """
         Send a payload of messages to the ui
         """
-        print("[PublicChatConsumer][send_messages_payload] sending...")
+        log.debug("send_messages_payload", room_id=self.room_id, count=len(messages or ()), user_id=self.scope['user'].id)
         await self.send_json({
             "messages_payload": "messages_payload",
             "messages": messages,
             "new_page_number": new_page_number,
+            "next_cursor": next_cursor,
         })
 
     async def handle_client_error(self, error):
@@ -191,11 +236,13 @@ class PublicChatConsumer(AsyncJsonWebsocketConsumer):
         """
         Called to send the number of connected users to the room.
         """
-        print("[PublicChatConsumer][connected_user_count] " + str(event['connected_user_count']))
+        if log.is_enabled(logging.DEBUG):
+            log.debug("connected_user_count", room_id=self.room_id, count=event['connected_user_count'], user_id=self.scope['user'].id)
+        # only the latest count matters to a client lagging behind
         await self.send_json({
             "message_type": MSG_TYPE_CONNECTED_USER_COUNT,
             "connected_user_count": event['connected_user_count']
-        })
+        }, coalesce_key=MSG_TYPE_CONNECTED_USER_COUNT)
 
 
 def is_authenticated(user):
@@ -203,15 +250,7 @@ def is_authenticated(user):
         return True
     return False
 
-@database_sync_to_async
-def connect_user(room, user):
-    return room.connect_user(user)
-
-@database_sync_to_async
-def disconnect_user(room, user):
-    return room.disconnect_user(user)
-
-@database_sync_to_async
+@metered_database_sync_to_async
 def get_room_or_error(room_id):
     """
     try do fetch a room
@@ -222,15 +261,18 @@ def get_room_or_error(room_id):
         raise ClientError(404, "Could not find this room.")
     return room
 
-@database_sync_to_async
+@metered_database_sync_to_async
 def create_public_room_chat_message(room, user, message):
     return PublicRoomChatMessage.objects.create(user=user, room=room, content=message)
 
 
-@database_sync_to_async
+@metered_database_sync_to_async
 def get_room_chat_message(room, page_number):
     try:
         qs = PublicRoomChatMessage.objects.by_room(room)
+        if is_chat_archive_enabled():
+            # pages go on into the archived months
+            qs = ArchivedRoomMessages(qs, get_chat_archive(PublicRoomChatMessage), room)
         p = Paginator(qs, DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE)
 
         payload = {}
@@ -242,13 +284,25 @@ def get_room_chat_message(room, page_number):
         else:
             payload['messages'] = None
         payload['new_page_number'] = new_page_number
-        return json.dumps(payload)
-    except Exception as e:
-        print(f"EXCEPTION: {str(e)}")
+        return payload
+    except Exception:
+        log.exception("get_room_chat_message", room_id=room.id)
         return None
 
-def get_num_connected_users(room):
-    if room.users:
-        return len(room.users.all())
-    return 0
+@metered_database_sync_to_async
+def get_room_chat_message_before(room, cursor):
+    """
+    Keyset page of messages older than cursor (None: most recent page)
+    """
+    try:
+        messages, next_cursor = get_messages_page_before(PublicRoomChatMessage.objects, room, cursor)
+        payload = {}
+        serializer = LazyRoomChatMessageEncoder()
+        payload['messages'] = serializer.serialize(messages)
+        payload['new_page_number'] = None
+        payload['next_cursor'] = next_cursor
+        return payload
+    except Exception:
+        log.exception("get_room_chat_message_before", room_id=room.id, cursor=cursor)
+        return None
 
@@ -0,0 +1,199 @@
+import asyncio
+
+from channels.layers import InMemoryChannelLayer
+from channels_redis.core import RedisChannelLayer
+
+from codenames_api.log import get_logger
+from codenames_api.metrics import LOCAL_FANOUT_DELIVERIES, LOCAL_FANOUT_REMOTE_SENDS
+
+
+log = get_logger(__name__)
+
+RELAY_EVENT_TYPE = "local.fanout"
+
+
+class LocalFanoutMixin:
+    """
+    Channel layer groups with a process local registry of their members.
+    - the sockets of this process joining a group are only registered locally, the
+      layer group gets one member for the whole process: its relay channel
+    - group_send sends the event once through the layer, wrapped: every process
+      (this one included) gets one copy on its relay and hands it to its own local
+      members
+    Every member gets each event exactly once, in the order its relay received them
+    from the layer: the order a plain layer gives, the same on every process, also
+    across senders. Local members wait for the layer round trip like the others.
+    With channels_redis a room of N sockets spread over W workers costs W messages
+    per send instead of N. Every process sharing the layer must use it (the relay
+    events are not chat events). Nothing changes in the consumers.
+    The registry belongs to the event loop of the process, see local_state.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.local_reset(None)
+
+    def local_reset(self, loop):
+        self.local_loop = loop
+        # channel of this process -> inbox
+        self.local_inboxes = {}
+        # group -> {local channel: None} (ordered)
+        self.local_groups = {}
+        # local channel -> pending receive on the layer itself (direct sends)
+        self.layer_receives = {}
+        self.relay_channel = None
+        self.relay_task = None
+
+    def local_state(self):
+        """
+        Bind the registry to the running event loop. It moves to another loop only
+        while empty (a test runs each async_to_sync in a new loop): local channels of
+        another loop would never be read again.
+        """
+        loop = asyncio.get_event_loop()
+        if loop is self.local_loop:
+            return
+        if self.local_inboxes or self.local_groups:
+            log.error("local_fanout_loop_changed", channels=len(self.local_inboxes), groups=len(self.local_groups))
+            raise RuntimeError("The local fan-out channels of this layer belong to another event loop.")
+        self.local_reset(loop)
+
+    async def new_channel(self, *args, **kwargs):
+        self.local_state()
+        channel = await super().new_channel(*args, **kwargs)
+        self.local_inboxes[channel] = asyncio.Queue()
+        return channel
+
+    async def ensure_relay(self):
+        if self.relay_channel is None:
+            self.relay_channel = await super().new_channel()
+            self.relay_task = asyncio.ensure_future(self.relay())
+        return self.relay_channel
+
+    async def group_add(self, group, channel):
+        self.local_state()
+        if channel not in self.local_inboxes:
+            return await super().group_add(group, channel)
+        self.local_groups.setdefault(group, {})[channel] = None
+        # added again on every join, refreshes the group expiry of the relay
+        await super().group_add(group, await self.ensure_relay())
+
+    async def group_discard(self, group, channel):
+        self.local_state()
+        if channel not in self.local_inboxes:
+            return await super().group_discard(group, channel)
+        members = self.local_groups.get(group)
+        if members is None:
+            return
+        members.pop(channel, None)
+        if not members:
+            del self.local_groups[group]
+            await super().group_discard(group, self.relay_channel)
+            if group in self.local_groups:
+                # joined again during the discard
+                await super().group_add(group, self.relay_channel)
+
+    async def group_send(self, group, message):
+        self.local_state()
+        LOCAL_FANOUT_REMOTE_SENDS.inc()
+        await super().group_send(group, {
+            "type": RELAY_EVENT_TYPE,
+            "origin": self.relay_channel,
+            "group": group,
+            "message": message,
+        })
+
+    def deliver_locally(self, group, message, source):
+        members = self.local_groups.get(group)
+        if not members:
+            return
+        for channel in members:
+            inbox = self.local_inboxes[channel]
+            if inbox.qsize() >= self.get_capacity(channel):
+                # same as a full channel of the layer: dropped
+                log.info("local_fanout_channel_full", channel=channel, group=group)
+                continue
+            inbox.put_nowait(dict(message))
+        LOCAL_FANOUT_DELIVERIES.inc(len(members), source=source)
+
+    async def relay(self):
+        """
+        Hand the events sent to the groups, by any process, to their local members
+        """
+        while True:
+            try:
+                event = await super().receive(self.relay_channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("local_fanout_relay", channel=self.relay_channel)
+                continue
+            if event.get("type") != RELAY_EVENT_TYPE:
+                continue
+            self.deliver_locally(event["group"], event["message"], 'local' if event["origin"] == self.relay_channel else 'relay')
+
+    async def receive(self, channel):
+        """
+        Next event of a local channel: from its inbox, or sent to it directly through the layer
+        """
+        self.local_state()
+        inbox = self.local_inboxes.get(channel)
+        if inbox is None:
+            return await super().receive(channel)
+        pending = self.layer_receives.get(channel)
+        if pending is not None and pending.done():
+            del self.layer_receives[channel]
+            return pending.result()
+        if not inbox.empty():
+            return inbox.get_nowait()
+        if pending is None:
+            # kept across calls: cancelling a channels_redis receive drops its buffer
+            pending = self.layer_receives[channel] = asyncio.ensure_future(super().receive(channel))
+        local = asyncio.ensure_future(inbox.get())
+        try:
+            await asyncio.wait([pending, local], return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            # the consumer is gone
+            local.cancel()
+            pending.cancel()
+            self.local_forget(channel)
+            raise
+        if local.done():
+            return local.result()
+        local.cancel()
+        del self.layer_receives[channel]
+        return pending.result()
+
+    def local_forget(self, channel):
+        self.local_inboxes.pop(channel, None)
+        self.layer_receives.pop(channel, None)
+        for group in [group for group, members in self.local_groups.items() if channel in members]:
+            del self.local_groups[group][channel]
+            if not self.local_groups[group]:
+                # the relay stays in the layer group until the next discard or its expiry
+                del self.local_groups[group]
+
+    def local_fanout_stats(self):
+        return {
+            'local_channels': len(self.local_inboxes),
+            'local_groups': len(self.local_groups),
+            'relay_channel': self.relay_channel,
+        }
+
+    async def flush(self):
+        if self.relay_task is not None:
+            self.relay_task.cancel()
+        self.local_reset(self.local_loop)
+        await super().flush()
+
+
+class LocalFanoutRedisChannelLayer(LocalFanoutMixin, RedisChannelLayer):
+    """
+    channels_redis.core.RedisChannelLayer with the process local fan-out, same CONFIG
+    """
+
+
+class LocalFanoutInMemoryChannelLayer(LocalFanoutMixin, InMemoryChannelLayer):
+    """
+    InMemoryChannelLayer with the process local fan-out, for tests and the load test
+    """
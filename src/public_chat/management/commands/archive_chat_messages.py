@@ -0,0 +1,55 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from public_chat.archive import ChatArchive, get_chat_archive_config
+from public_chat.models import PublicRoomChatMessage
+from private_chat.models import PrivateRoomChatMessage
+
+
+class Command(BaseCommand):
+    """
+    Move the chat messages of whole months older than CHAT_ARCHIVE['AFTER_DAYS']
+    out of the database into the archive segments, one room and month at a time:
+    the segment is written (and fsynced) before the rows are deleted, a run
+    interrupted in between only leaves duplicates that the archive drops when read.
+    """
+    help = "Archive the chat messages older than CHAT_ARCHIVE['AFTER_DAYS'] by month"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--after-days', type=int, default=None)
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        config = get_chat_archive_config()
+        if not config['ROOT']:
+            raise CommandError("settings.CHAT_ARCHIVE['ROOT'] is not set.")
+        after_days = options['after_days'] if options['after_days'] is not None else config['AFTER_DAYS']
+        # only whole months: everything before the first day of the cutoff month
+        cutoff = timezone.now() - timedelta(days=after_days)
+        cutoff = cutoff.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        for model in (PublicRoomChatMessage, PrivateRoomChatMessage):
+            archive = ChatArchive(model, config['ROOT'])
+            old_messages = model.objects.filter(timestamp__lt=cutoff)
+            segments = (
+                old_messages.annotate(month=TruncMonth('timestamp'))
+                .values_list('room_id', 'month').distinct().order_by('room_id', 'month')
+            )
+            for room_id, month in segments:
+                self.archive_month(archive, model, room_id, month, options['dry_run'])
+
+    def archive_month(self, archive, model, room_id, month, dry_run):
+        next_month = (month + timedelta(days=32)).replace(day=1)
+        with transaction.atomic():
+            qs = model.objects.select_for_update().filter(room_id=room_id, timestamp__gte=month, timestamp__lt=next_month)
+            messages = list(qs.order_by('-timestamp', 'id'))
+            label = f"{model._meta.label} room {room_id} {month:%Y-%m}"
+            if dry_run:
+                self.stdout.write(f"{label}: {len(messages)} messages would be archived")
+                return
+            archive.append(room_id, f"{month:%Y-%m}", messages)
+            model.objects.filter(id__in=[message.id for message in messages]).delete()
+        self.stdout.write(f"{label}: {len(messages)} messages archived")
@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from account.models import Account
+from public_chat.constants import MSG_TYPE_NEW_MESSAGE
+from public_chat.consumers import PublicChatConsumer
+from public_chat.serializers import calculate_timestamp, encode_new_message_frame
+
+
+class Command(BaseCommand):
+    """
+    CPU per message of the chat_message fan-out against the room size:
+    - per recipient: every socket formats the timestamp and encodes the frame (old behavior)
+    - encode once: the sender encodes the frame, every socket sends it as is
+    No channel layer and no database, only the consumer side work is measured.
+    """
+    help = "Benchmark the chat_message fan-out CPU cost per message against room size"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100, 1000])
+        parser.add_argument('--messages', type=int, default=200)
+
+    def handle(self, *args, **options):
+        user = Account(id=1, username="bench", email="bench@codenames.com")
+        self.stdout.write(f"{'room size':>10} {'per recipient (us/msg)':>24} {'encode once (us/msg)':>22} {'speedup':>8}")
+        for size in options['sizes']:
+            consumers = [self.make_consumer() for _ in range(size)]
+            per_recipient = asyncio.run(self.run(consumers, options['messages'], self.per_recipient_fanout, user))
+            encode_once = asyncio.run(self.run(consumers, options['messages'], self.encode_once_fanout, user))
+            self.stdout.write(f"{size:>10} {per_recipient:>24.1f} {encode_once:>22.1f} {per_recipient / encode_once:>7.1f}x")
+
+    def make_consumer(self):
+        consumer = PublicChatConsumer()
+
+        async def base_send(message):
+            pass
+        consumer.base_send = base_send
+        return consumer
+
+    async def run(self, consumers, messages, fanout, user):
+        start = time.process_time()
+        for i in range(messages):
+            await fanout(consumers, user, f"message number {i}")
+        elapsed = time.process_time() - start
+        return elapsed / messages * 1e6
+
+    async def per_recipient_fanout(self, consumers, user, message):
+        for consumer in consumers:
+            await consumer.send_json({
+                "message_type": MSG_TYPE_NEW_MESSAGE,
+                "profile_image": user.profile_image.url,
+                "username": user.username,
+                "user_id": user.id,
+                "message": message,
+                "timestamp": calculate_timestamp(timezone.now())
+            })
+
+    async def encode_once_fanout(self, consumers, user, message):
+        event = {
+            "type": "chat.message",
+            "user_id": user.id,
+            "text": encode_new_message_frame(user, message),
+        }
+        for consumer in consumers:
+            await consumer.chat_message(event)
@@ -0,0 +1,57 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from account.models import Account
+from public_chat.codecs import JsonCodec, get_json_codec, get_msgpack_codec
+from public_chat.constants import DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE, MSG_TYPE_CONNECTED_USER_COUNT
+from public_chat.serializers import new_message_frame, serialize_chat_message
+
+
+class Command(BaseCommand):
+    """
+    Size and encode time of the websocket frames, JSON text (today's frames)
+    against the MessagePack binary frames of the negotiated subprotocol.
+    No database: the frames are built from an unsaved account.
+    """
+    help = "Benchmark the size and encode time of the JSON and MessagePack chat frames"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        user = Account(id=42, username="codenames_player", email="bench@codenames.com")
+        message = "Are we going with blue or red this round?"
+        frames = {
+            'new message': new_message_frame(user, message),
+            'user count': {
+                "message_type": MSG_TYPE_CONNECTED_USER_COUNT,
+                "connected_user_count": 128,
+            },
+            'history page': {
+                "messages_payload": "messages_payload",
+                "messages": [
+                    serialize_chat_message(user.id, user.username, user.profile_image.url, message, timezone.now())
+                    for _ in range(DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE)
+                ],
+                "new_page_number": 2,
+                "next_cursor": None,
+            },
+        }
+        codecs = [
+            ('json', JsonCodec()),
+            (f'{type(get_json_codec()).__name__} (configured)', get_json_codec()),
+            ('msgpack', get_msgpack_codec()),
+        ]
+        self.stdout.write(f"{'frame':>14} {'codec':>28} {'bytes':>8} {'encode (us)':>12}")
+        for name, frame in frames.items():
+            for codec_name, codec in codecs:
+                size = len(codec.dumps(frame))
+                self.stdout.write(f"{name:>14} {codec_name:>28} {size:>8} {self.encode_time(codec, frame, options['iterations']):>12.2f}")
+
+    def encode_time(self, codec, frame, iterations):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            codec.dumps(frame)
+        return (time.perf_counter() - start) / iterations * 1e6
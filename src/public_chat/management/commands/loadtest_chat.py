@@ -0,0 +1,321 @@
+import asyncio
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+from account.models import Account
+from private_chat.consumers import PrivateChatConsumer
+from private_chat.models import PrivateChatRoom
+from public_chat.constants import MSG_TYPE_NEW_MESSAGE
+from public_chat.broadcast import get_connected_user_count_broadcaster
+from public_chat.consumers import PublicChatConsumer
+from public_chat.models import PublicChatRoom
+from public_chat.presence import get_presence_store
+from public_chat.recent_messages import get_recent_messages_cache
+from public_chat.sharding import get_sharded_groups
+from public_chat.write_behind import buffers, drain_all, get_write_behind_buffer
+
+
+# channel layer backend -> the same layer with the process local fan-out
+LOCAL_FANOUT_LAYERS = {
+    'channels.layers.InMemoryChannelLayer': 'public_chat.local_fanout.LocalFanoutInMemoryChannelLayer',
+    'channels_redis.core.RedisChannelLayer': 'public_chat.local_fanout.LocalFanoutRedisChannelLayer',
+}
+
+HERMETIC_DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}}
+
+# process wide singletons of the chat, rebuilt for every run
+CHAT_SINGLETONS = (
+    get_connected_user_count_broadcaster,
+    get_presence_store,
+    get_recent_messages_cache,
+    get_sharded_groups,
+    get_write_behind_buffer,
+)
+
+CONSUMERS = {
+    'public': (PublicChatConsumer, PublicChatRoom),
+    'private': (PrivateChatConsumer, PrivateChatRoom),
+}
+
+
+class Command(BaseCommand):
+    """
+    Load test of the chat consumers with simulated clients, in process
+    (channels.testing.WebsocketCommunicator, no Daphne, no JWT): for every room size,
+    `rooms` rooms of `size` clients join, `senders` clients per room send `messages`
+    messages and every client waits for all of them. Reports:
+    - join latency: join command -> join reply
+    - fan-out latency: send command -> new message frame, for every recipient
+    - frames per second received by the clients during the fan-out
+    - resident memory per connection (Linux /proc/self/statm)
+    - lost messages (dropped by a full outbound queue or not received before --timeout)
+    - sub-groups of the rooms with --group-sharding (fan-out time and round trips: /metrics)
+    Hermetic by default: an in-memory sqlite test database, the in-memory channel layer,
+    presence, recent messages and shard counts, whatever the settings say, and the chat
+    singletons (broadcaster, presence, rings, sub-groups, write-behind) rebuilt for the run.
+    --use-configured-backends runs on the configured DATABASES (a test database is
+    created there), CHANNEL_LAYERS, PRESENCE_STORE, RECENT_MESSAGES_CACHE and
+    CHAT_GROUP_SHARDING store instead.
+    """
+    help = "Load test the chat consumers with simulated websocket clients"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--consumer', choices=sorted(CONSUMERS), default='public')
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help="clients per room")
+        parser.add_argument('--rooms', type=int, default=1)
+        parser.add_argument('--senders', type=int, default=1, help="clients sending messages, per room")
+        parser.add_argument('--messages', type=int, default=20, help="messages per sender")
+        parser.add_argument('--rate', type=float, default=0, help="messages per second per sender, 0: as fast as possible")
+        parser.add_argument('--group-sharding', type=int, default=0, metavar='MEMBERS_PER_SHARD',
+                            help="split the public rooms fan-out in sub-groups of this many users, 0: one group")
+        parser.add_argument('--local-fanout', action='store_true', help="channel layer with the process local fan-out")
+        parser.add_argument('--use-configured-backends', action='store_true',
+                            help="run on the configured database, channel layer, presence, rings and shard counts")
+        parser.add_argument('--timeout', type=float, default=60, help="seconds to wait for the fan-out of a room size")
+        parser.add_argument('--json', action='store_true', help="print the results as JSON")
+
+    def handle(self, *args, **options):
+        configured = options['use_configured_backends']
+        if configured:
+            layer = dict(settings.CHANNEL_LAYERS['default'])
+            backends = {}
+            store = settings.CHAT_GROUP_SHARDING.get('STORE', {'BACKEND': 'public_chat.sharding.InMemoryShardCountStore'})
+        else:
+            layer = {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 10000}}
+            backends = {
+                'PRESENCE_STORE': {'BACKEND': 'public_chat.presence.InMemoryPresenceStore'},
+                'RECENT_MESSAGES_CACHE': {'BACKEND': 'public_chat.recent_messages.InMemoryRecentMessagesCache'},
+            }
+            store = {'BACKEND': 'public_chat.sharding.InMemoryShardCountStore'}
+        if options['local_fanout']:
+            if layer['BACKEND'] not in LOCAL_FANOUT_LAYERS:
+                raise CommandError(f"No local fan-out for the channel layer {layer['BACKEND']}.")
+            layer['BACKEND'] = LOCAL_FANOUT_LAYERS[layer['BACKEND']]
+        with override_settings(
+            CHANNEL_LAYERS={'default': layer},
+            CHAT_GROUP_SHARDING={
+                'ENABLED': bool(options['group_sharding']),
+                'MEMBERS_PER_SHARD': options['group_sharding'],
+                'STORE': store,
+            },
+            **backends
+        ), (configured_databases() if configured else hermetic_databases()):
+            reset_chat_singletons()
+            old_config = setup_databases(verbosity=0, interactive=False)
+            try:
+                fixtures = [self.create_rooms(options['consumer'], options['rooms'], size, run) for run, size in enumerate(options['sizes'])]
+                results = asyncio.run(self.run_all(fixtures, options))
+            finally:
+                teardown_databases(old_config, verbosity=0)
+                reset_chat_singletons()
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            self.report(results)
+
+    def create_rooms(self, consumer, rooms, size, run):
+        """
+        [(room, [users])] for one room size
+        """
+        room_model = CONSUMERS[consumer][1]
+        prefix = f"loadtest{run}_"
+        Account.objects.bulk_create([
+            Account(email=f"{prefix}{i}@codenames.com", username=f"{prefix}{i}")
+            for i in range(rooms * size)
+        ])
+        users = list(Account.objects.filter(username__startswith=prefix).order_by('id'))
+        fixtures = []
+        for i in range(rooms):
+            room = room_model.objects.create(title=f"{prefix}{i}")
+            room_users = users[i * size:(i + 1) * size]
+            if consumer == 'private':
+                room.users.add(*room_users)
+            fixtures.append((room, room_users))
+        return fixtures
+
+    async def run_all(self, fixtures, options):
+        results = []
+        try:
+            for rooms in fixtures:
+                results.append(await self.run_size(rooms, options))
+        finally:
+            # the buffers belong to this event loop
+            await drain_all()
+        return results
+
+    async def run_size(self, rooms, options):
+        consumer_class = CONSUMERS[options['consumer']][0]
+        application = consumer_class.as_asgi()
+        rss_before = resident_memory()
+        clients = [SimulatedClient(application, room, user) for room, users in rooms for user in users]
+        await asyncio.gather(*[client.connect() for client in clients])
+        join_latencies = await asyncio.gather(*[client.join() for client in clients])
+        memory_per_connection = (resident_memory() - rss_before) / len(clients)
+
+        expected = options['senders'] * options['messages']
+        senders = []
+        for room, users in rooms:
+            senders += [client for client in clients if client.room is room][:options['senders']]
+        readers = [asyncio.ensure_future(client.read_messages(expected)) for client in clients]
+        start = time.perf_counter()
+        await asyncio.gather(*[sender.send_messages(options['messages'], options['rate']) for sender in senders])
+        try:
+            await asyncio.wait_for(asyncio.gather(*readers), options['timeout'])
+        except asyncio.TimeoutError:
+            for reader in readers:
+                reader.cancel()
+        elapsed = time.perf_counter() - start
+        await asyncio.gather(*[client.disconnect() for client in clients])
+
+        latencies = sorted(latency for client in clients for latency in client.latencies)
+        frames = sum(client.fanout_frames for client in clients)
+        return {
+            'room_size': len(rooms[0][1]),
+            'rooms': len(rooms),
+            'clients': len(clients),
+            'messages_sent': len(senders) * options['messages'],
+            'join_ms': summary(sorted(join_latencies)),
+            'fanout_ms': summary(latencies),
+            'frames_per_second': frames / elapsed if elapsed else None,
+            'memory_per_connection_kib': memory_per_connection / 1024,
+            'lost_messages': len(clients) * expected - len(latencies),
+            'closed_clients': sum(client.closed for client in clients),
+            'sub_groups': get_sharded_groups().stats()['max_shards'] if get_sharded_groups().enabled else None,
+        }
+
+    def report(self, results):
+        self.stdout.write(
+            f"{'size':>6} {'clients':>8} {'join p50/p95 (ms)':>18} {'fan-out p50/p95/p99/max (ms)':>30}"
+            f" {'frames/s':>10} {'KiB/conn':>9} {'lost':>6} {'closed':>7}"
+        )
+        for r in results:
+            join = f"{r['join_ms']['p50']:.1f}/{r['join_ms']['p95']:.1f}"
+            fanout = r['fanout_ms']
+            fanout = f"{fanout['p50']:.1f}/{fanout['p95']:.1f}/{fanout['p99']:.1f}/{fanout['max']:.1f}" if fanout['count'] else "-"
+            self.stdout.write(
+                f"{r['room_size']:>6} {r['clients']:>8} {join:>18} {fanout:>30}"
+                f" {r['frames_per_second']:>10.0f} {r['memory_per_connection_kib']:>9.1f} {r['lost_messages']:>6} {r['closed_clients']:>7}"
+            )
+
+
+class SimulatedClient:
+    """
+    One websocket client: reads its frames straight from the communicator output
+    queue (receive_output with a timeout would cancel the consumer).
+    """
+
+    def __init__(self, application, room, user):
+        self.communicator = WebsocketCommunicator(application, "/loadtest/")
+        self.communicator.scope['user'] = user
+        self.room = room
+        self.latencies = []
+        self.fanout_frames = 0
+        self.closed = False
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise RuntimeError("Connection refused by the consumer.")
+
+    async def receive(self):
+        message = await self.communicator.output_queue.get()
+        if message['type'] == 'websocket.close':
+            self.closed = True
+            raise ConnectionError("Closed by the consumer.")
+        return json.loads(message['text'])
+
+    async def join(self):
+        start = time.perf_counter()
+        await self.communicator.send_json_to({'command': 'join', 'room_id': self.room.id})
+        while 'join' not in await self.receive():
+            pass
+        return time.perf_counter() - start
+
+    async def send_messages(self, messages, rate):
+        for i in range(messages):
+            # the send time travels in the message
+            await self.communicator.send_json_to({
+                'command': 'send',
+                'room_id': self.room.id,
+                'message': f"{time.perf_counter()} loadtest message {i}",
+            })
+            await asyncio.sleep(1 / rate if rate else 0)
+
+    async def read_messages(self, expected):
+        try:
+            while len(self.latencies) < expected:
+                frame = await self.receive()
+                self.fanout_frames += 1
+                if frame.get('message_type') == MSG_TYPE_NEW_MESSAGE:
+                    self.latencies.append(time.perf_counter() - float(frame['message'].split(' ', 1)[0]))
+        except ConnectionError:
+            pass
+
+    async def disconnect(self):
+        if not self.closed:
+            await self.communicator.disconnect(timeout=30)
+
+
+def reset_chat_singletons():
+    for get_singleton in CHAT_SINGLETONS:
+        get_singleton.cache_clear()
+    buffers.clear()
+
+
+@contextmanager
+def configured_databases():
+    yield
+
+
+@contextmanager
+def hermetic_databases():
+    """
+    Every connection on an in-memory sqlite database (its test database is shared
+    by the threads of database_sync_to_async), whatever DATABASES says
+    """
+    for connection in connections.all():
+        connection.close()
+    saved = connections._databases, connections.__dict__.pop('databases', None), connections._connections
+    connections._databases = HERMETIC_DATABASES
+    connections._connections = threading.local()
+    try:
+        yield
+    finally:
+        for connection in connections.all():
+            connection.close()
+        connections._databases, databases, connections._connections = saved
+        if databases is not None:
+            connections.__dict__['databases'] = databases
+
+
+def summary(values):
+    """
+    count and percentiles of durations in seconds, in milliseconds
+    """
+    def percentile(p):
+        return values[max(math.ceil(p / 100 * len(values)) - 1, 0)] * 1000 if values else None
+    return {
+        'count': len(values),
+        'p50': percentile(50),
+        'p95': percentile(95),
+        'p99': percentile(99),
+        'max': values[-1] * 1000 if values else None,
+    }
+
+
+def resident_memory():
+    """
+    Resident memory of the process in bytes (Linux)
+    """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.15 on 2026-10-18 09:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('public_chat', '0002_auto_20201217_0125'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='publicroomchatmessage',
+            index=models.Index(fields=['room', '-timestamp', 'id'], name='public_msg_room_ts_id_idx'),
+        ),
+    ]
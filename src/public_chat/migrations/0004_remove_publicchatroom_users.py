@@ -0,0 +1,17 @@
+# Generated by Django 2.2.15 on 2026-10-18 10:30
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('public_chat', '0003_auto_20261018_0948'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='publicchatroom',
+            name='users',
+        ),
+    ]
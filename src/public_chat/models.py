@@ -1,39 +1,18 @@
 from django.db import models
+from django.db.models.query_utils import Q
 from django.conf import settings
+from django.utils import timezone
+
+from public_chat.constants import CHAT_HISTORY_FIELDS
 
 
 class PublicChatRoom(models.Model):
 
     title = models.CharField(max_length=255, unique=True, blank=False)
-    users = models.ManyToManyField(settings.AUTH_USER_MODEL, blank=True, help_text="users connected to the chat")
 
     def __str__(self):
         return self.title
 
-    def connect_user(self, user):
-        """
-        return True if the user is added to the users list
-        """
-        is_user_added = False
-        if not user in self.users.all():
-            self.users.add(user)
-            self.save()
-            is_user_added = True
-        elif user in self.users.all():
-            is_user_added = True
-        return is_user_added
-
-    def disconnect_user(self, user):
-        """
-        return True if user is removed from the users list
-        """
-        is_user_removed = False
-        if user in self.users.all():
-            self.users.remove(user)
-            self.save()
-            is_user_removed = True
-        return is_user_removed
-        
     @property
     def group_name(self):
         """
@@ -42,14 +21,34 @@ class PublicChatRoom(models.Model):
         """
         return f"PublicChatRoom-{self.id}"
 
+    @property
+    def room_tag(self):
+        """
+        the room in the frames of the multiplexed chat socket
+        """
+        return f"public:{self.id}"
+
 
 class PublicRoomChatMessageManager(models.Manager):
     
     def by_room(self, room):
         """
         messages for a specific room, ordered by minus timestamp (most recent first)
+        with their author in the same query, only the columns the chat history needs
         """
-        qs = PublicRoomChatMessage.objects.filter(room=room).order_by("-timestamp")
+        qs = PublicRoomChatMessage.objects.filter(room=room).select_related("user").only(
+            *CHAT_HISTORY_FIELDS
+        ).order_by("-timestamp", "id")
+        return qs
+
+    def by_room_before(self, room, timestamp, message_id):
+        """
+        messages of a room older than the (timestamp, id) cursor, same order as by_room.
+        Range scan on the (room, -timestamp, id) index, no OFFSET.
+        """
+        qs = self.by_room(room).filter(
+            Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__gt=message_id)
+        )
         return qs
 
 
@@ -59,11 +58,17 @@ class PublicRoomChatMessage(models.Model):
     """
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     room = models.ForeignKey(PublicChatRoom, on_delete=models.CASCADE)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # set when the message is sent, write-behind inserts it later
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
     content = models.TextField(unique=False, blank=False)
 
     objects = PublicRoomChatMessageManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', '-timestamp', 'id'], name='public_msg_room_ts_id_idx'),
+        ]
+
     def __str__(self):
         return self.content
 
@@ -0,0 +1,311 @@
+import logging
+import time
+
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
+
+from codenames_api.log import get_logger
+from codenames_api.metrics import ConsumerMetricsMixin, COMMAND_DURATION, command_label, group_send
+from public_chat import consumers as public_consumers
+from public_chat.batching import MessageBatchingMixin
+from public_chat.broadcast import get_connected_user_count_broadcaster
+from public_chat.codecs import JsonCodecMixin, MessagePackProtocolMixin
+from public_chat.constants import MSG_TYPE_CONNECTED_USER_COUNT
+from public_chat.models import PublicRoomChatMessage
+from public_chat.outbound import OutboundQueueMixin
+from public_chat.presence import get_presence_store
+from public_chat.recent_messages import append_recent_message, get_recent_chat_messages, is_first_page
+from public_chat.serializers import encode_new_message_event
+from public_chat.sharding import get_sharded_groups
+from public_chat.write_behind import get_write_behind_buffer, is_write_behind_enabled
+from private_chat import consumers as private_consumers
+from private_chat.exceptions import ClientError
+from private_chat.models import PrivateRoomChatMessage
+
+
+log = get_logger(__name__)
+
+DEFAULT_CHAT_MULTIPLEX_MAX_ROOMS = 20
+
+
+class PublicRooms:
+    """
+    Public rooms of the multiplexed socket: anyone can read, presence is counted
+    """
+    tag = 'public'
+    message_model = PublicRoomChatMessage
+    presence = True
+    sharded = True
+    get_room_chat_message = staticmethod(public_consumers.get_room_chat_message)
+    get_room_chat_message_before = staticmethod(public_consumers.get_room_chat_message_before)
+    create_room_chat_message = staticmethod(public_consumers.create_public_room_chat_message)
+
+    @staticmethod
+    async def get_room_or_error(room_id, user):
+        return await public_consumers.get_room_or_error(room_id)
+
+
+class PrivateRooms:
+    """
+    Private rooms of the multiplexed socket: members only, checked as in PrivateChatConsumer
+    """
+    tag = 'private'
+    message_model = PrivateRoomChatMessage
+    presence = False
+    sharded = False
+    get_room_chat_message = staticmethod(private_consumers.get_room_chat_message)
+    get_room_chat_message_before = staticmethod(private_consumers.get_room_chat_message_before)
+    create_room_chat_message = staticmethod(private_consumers.create_room_chat_message)
+    get_room_or_error = staticmethod(private_consumers.get_room_or_error)
+
+
+# room tag prefix (see the room_tag of the room models) -> kind of room
+ROOM_KINDS = {kind.tag: kind for kind in (PublicRooms, PrivateRooms)}
+
+
+def parse_room_tag(room_tag):
+    """
+    (kind of room, room id, room tag as in room_tag) of a "public:<id>" / "private:<id>" tag,
+    ClientError if invalid
+    """
+    kind, _, room_id = str(room_tag).partition(':')
+    if kind not in ROOM_KINDS or not room_id.isdigit():
+        raise ClientError(400, "Invalid room. ")
+    return ROOM_KINDS[kind], int(room_id), f"{kind}:{int(room_id)}"
+
+
+class MultiplexChatConsumer(MessageBatchingMixin, OutboundQueueMixin, ConsumerMetricsMixin, MessagePackProtocolMixin, JsonCodecMixin, AsyncJsonWebsocketConsumer):
+    """
+    One socket for all the chat rooms of a user, public and private.
+    Same commands as the one room consumers, with a "room" tag instead of the room_id:
+        {"command": "join", "room": "private:12"}
+        {"command": "send", "room": "public:1", "message": "hello"}
+    and every frame sent back carries the "room" it is about (errors too, when known).
+    New message frames are tagged by the sender (encode_new_message_event), so they
+    are still encoded once per room and batched across rooms.
+    Room permissions are the ones of PublicChatConsumer / PrivateChatConsumer.
+    """
+
+    metrics_label = "multiplex_chat"
+
+    def metrics_room_types(self):
+        # kind of each joined room, from its tag: 'public' or 'private'
+        return sorted({room_tag.partition(':')[0] for room_tag in getattr(self, 'rooms', {})})
+
+    async def connect(self):
+        log.debug("connect", user_id=self.scope['user'].id)
+        await self.accept()
+        # room tag -> room joined by this socket
+        self.rooms = {}
+        # room tag -> (sub-)group joined, see ShardedGroups
+        self.room_groups = {}
+
+    async def disconnect(self, code):
+        log.debug("disconnect", user_id=self.scope['user'].id, rooms=list(self.rooms), code=code)
+        for room_tag in list(self.rooms):
+            try:
+                await self.leave_room(room_tag, reply=False)
+            except Exception:
+                log.exception("disconnect_leave_room", room=room_tag, user_id=self.scope['user'].id)
+
+    async def receive_json(self, content):
+        command = content.get("command", None)
+        room_tag = content.get("room")
+        start = time.perf_counter()
+        try:
+            if command == "join":
+                await self.join_room(room_tag)
+            elif command == "leave":
+                await self.leave_room(room_tag)
+            elif command == "send":
+                if len(content['message'].lstrip()) == 0:
+                    # HTTPstatus 422
+                    raise ClientError(422, "You can not send an empty message.")
+                await self.send_room(room_tag, content['message'])
+            elif command == "set_batch_window":
+                await self.set_batch_window(content.get('window_ms'))
+            elif command == "get_chatroom_messages":
+                await self.send_room_messages(room_tag, content)
+        except ClientError as e:
+            await self.handle_client_error(e, room_tag)
+        duration = time.perf_counter() - start
+        COMMAND_DURATION.observe(duration, consumer=self.metrics_label, command=command_label(command))
+        if log.is_enabled(logging.DEBUG):
+            log.debug("command", command=command, room=room_tag, user_id=self.scope['user'].id, duration_ms=duration * 1000)
+
+    async def get_room(self, room_tag):
+        """
+        (kind, room): a joined room without any query, other rooms fetched and checked
+        """
+        kind, room_id, room_tag = parse_room_tag(room_tag)
+        room = self.rooms.get(room_tag)
+        if room is None:
+            room = await kind.get_room_or_error(room_id, self.scope['user'])
+        return kind, room
+
+    async def join_room(self, room_tag):
+        log.debug("join_room", room=room_tag, user_id=self.scope['user'].id)
+        kind, room = await self.get_room(room_tag)
+        room_tag = room.room_tag
+        if room_tag not in self.rooms:
+            if len(self.rooms) >= getattr(settings, 'CHAT_MULTIPLEX_MAX_ROOMS', DEFAULT_CHAT_MULTIPLEX_MAX_ROOMS):
+                raise ClientError(429, "Too many rooms open on this connection. ")
+            self.rooms[room_tag] = room
+            if kind.presence and is_authenticated(self.scope['user']):
+                await get_presence_store().add(room.group_name, self.scope['user'].id)
+            if kind.sharded:
+                self.room_groups[room_tag] = await get_sharded_groups().add(self.channel_layer, room.group_name, self.channel_name)
+            else:
+                await self.channel_layer.group_add(room.group_name, self.channel_name)
+        await self.send_json({
+            "join": str(room.id),
+            "room": room_tag,
+            "username": self.scope['user'].username,
+        })
+        if kind.presence:
+            await self.publish_connected_user_count(room)
+
+    async def leave_room(self, room_tag, reply=True):
+        log.debug("leave_room", room=room_tag, user_id=self.scope['user'].id)
+        kind, _, room_tag = parse_room_tag(room_tag)
+        room = self.rooms.pop(room_tag, None)
+        if room is None:
+            raise ClientError(403, "Room acces denied. ")
+        await get_sharded_groups().discard(self.channel_layer, room.group_name, self.room_groups.pop(room_tag, None), self.channel_name)
+        if kind.presence:
+            if is_authenticated(self.scope['user']):
+                await get_presence_store().remove(room.group_name, self.scope['user'].id)
+            await self.publish_connected_user_count(room)
+        else:
+            await group_send(
+                self.channel_layer,
+                room.group_name,
+                {
+                    "type": "chat.leave",
+                    "room_id": room.id,
+                    "username": self.scope['user'].username,
+                    "user_id": self.scope['user'].id,
+                    "profile_image": self.scope['user'].profile_image.url
+                }
+            )
+        if reply:
+            await self.send_json({
+                "leave": str(room.id),
+                "room": room_tag,
+            })
+
+    async def publish_connected_user_count(self, room):
+        # coalesced during join/leave storms
+        await get_connected_user_count_broadcaster().publish(
+            self.channel_layer,
+            room.group_name,
+            {
+                "type": "connected.user.count",
+                "room": room.room_tag,
+                "connected_user_count": await get_presence_store().count(room.group_name)
+            }
+        )
+
+    async def send_room(self, room_tag, message):
+        log.debug("send_room", room=room_tag, user_id=self.scope['user'].id)
+        kind, _, room_tag = parse_room_tag(room_tag)
+        room = self.rooms.get(room_tag)
+        if room is None:
+            raise ClientError(403, "Room acces denied. ")
+        if not is_authenticated(self.scope['user']):
+            raise ClientError(403, "You must be authenticated to chat.")
+        if is_write_behind_enabled():
+            # broadcast right away, the message is saved with the next batch
+            chat_message = await get_write_behind_buffer(kind.message_model).append(user=self.scope['user'], room=room, content=message)
+            await append_recent_message(room, self.scope['user'], message, chat_message)
+        else:
+            chat_message = await kind.create_room_chat_message(room, self.scope['user'], message)
+            await append_recent_message(room, self.scope['user'], message, chat_message)
+        send = get_sharded_groups().send if kind.sharded else group_send
+        await send(
+            self.channel_layer,
+            room.group_name,
+            {
+                "type": "chat.message",
+                "user_id": self.scope['user'].id,
+                **encode_new_message_event(self.scope['user'], message, room_tag),
+            }
+        )
+
+    async def send_room_messages(self, room_tag, content):
+        """
+        get_chatroom_messages of a room, joined or not (permission checked)
+        """
+        kind, room = await self.get_room(room_tag)
+        payload = None
+        if is_first_page(content):
+            # opening the room: served from the room recent messages
+            payload = await get_recent_chat_messages(room, kind.message_model.objects, 'before' in content)
+        if payload == None and 'before' in content:
+            # keyset pagination, 'before' is None for the most recent page
+            payload = await kind.get_room_chat_message_before(room, content['before'])
+        elif payload == None:
+            payload = await kind.get_room_chat_message(room, content['page_number'])
+        if payload == None:
+            raise ClientError(204, "Something went wrong retrieving chatroom messages.")
+        log.debug("send_messages_payload", room=room.room_tag, count=len(payload['messages'] or ()), user_id=self.scope['user'].id)
+        await self.send_json({
+            "messages_payload": "messages_payload",
+            "room": room.room_tag,
+            "messages": payload['messages'],
+            "new_page_number": payload['new_page_number'],
+            "next_cursor": payload.get('next_cursor'),
+        })
+
+    async def chat_message(self, event):
+        """
+        Called when someone has messaged one of our rooms, the frame is already tagged
+        """
+        if log.is_enabled(logging.DEBUG):
+            log.debug("chat_message", from_user_id=event['user_id'], user_id=self.scope['user'].id)
+        await self.send_pre_encoded(event)
+
+    async def chat_leave(self, event):
+        log.debug("chat_leave", room_id=event['room_id'], user_id=self.scope['user'].id)
+
+    async def connected_user_count(self, event):
+        if log.is_enabled(logging.DEBUG):
+            log.debug("connected_user_count", room=event['room'], count=event['connected_user_count'], user_id=self.scope['user'].id)
+        # only the latest count of each room matters to a client lagging behind
+        await self.send_json({
+            "message_type": MSG_TYPE_CONNECTED_USER_COUNT,
+            "room": event['room'],
+            "connected_user_count": event['connected_user_count']
+        }, coalesce_key=(MSG_TYPE_CONNECTED_USER_COUNT, event['room']))
+
+    async def room_invalidate(self, event):
+        """
+        A private room or its members changed: check again that we are still allowed in it
+        """
+        room_tag = f"private:{event['room_id']}"
+        log.debug("room_invalidate", room=room_tag, user_id=self.scope['user'].id)
+        room = self.rooms.pop(room_tag, None)
+        if room is None:
+            return
+        try:
+            self.rooms[room_tag] = await PrivateRooms.get_room_or_error(event['room_id'], self.scope['user'])
+        except ClientError as e:
+            # not allowed anymore: leave the room
+            await self.channel_layer.group_discard(room.group_name, self.channel_name)
+            await self.handle_client_error(e, room_tag)
+
+    async def handle_client_error(self, error, room_tag=None):
+        """
+        Send the error to the client, tagged with the room of the command
+        """
+        if error.message:
+            errorData = {'error': error.code, 'message': error.message}
+            if room_tag is not None:
+                errorData['room'] = room_tag
+            await self.send_json(errorData)
+
+
+def is_authenticated(user):
+    if user.is_authenticated:
+        return True
+    return False
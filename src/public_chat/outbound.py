@@ -0,0 +1,324 @@
+import asyncio
+import weakref
+from collections import deque
+
+from django.conf import settings
+
+from codenames_api.log import get_logger
+from codenames_api.metrics import (
+    OUTBOUND_COALESCED,
+    OUTBOUND_DEEPEST_QUEUE,
+    OUTBOUND_DROPPED,
+    OUTBOUND_PAUSED_SOCKETS,
+    OUTBOUND_QUEUED_FRAMES,
+    OUTBOUND_SLOW_DISCONNECTS,
+    OUTBOUND_TRANSPORT_PAUSES,
+)
+from public_chat.constants import SLOW_CONSUMER_CLOSE_CODE
+
+
+log = get_logger(__name__)
+
+DEFAULT_WEBSOCKET_OUTBOUND_QUEUE = {
+    'MAX_SIZE': 256,            # frames waiting to be written to one socket
+    'MAX_BYTES': 1024 * 1024,   # bytes of the frames waiting to be written to one socket
+    'POLICY': 'drop_oldest',    # when the queue is full: 'drop_oldest' or 'disconnect'
+    'COALESCE': True,           # a frame with a coalesce_key replaces the pending one with the same key
+    'TRANSPORT_PRESSURE': True, # also wait for the socket buffer to drain, Daphne 3.0 only (see watch_transport)
+}
+
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_DISCONNECT = 'disconnect'
+
+# Daphne releases whose websocket send callable and Twisted transport watch_transport knows
+TRANSPORT_PRESSURE_DAPHNE_VERSIONS = ('3.0.',)
+
+# every consumer with an outbound queue, to find the slow ones
+open_connections = weakref.WeakSet()
+
+
+def get_outbound_queue_config():
+    config = dict(DEFAULT_WEBSOCKET_OUTBOUND_QUEUE)
+    config.update(getattr(settings, 'WEBSOCKET_OUTBOUND_QUEUE', {}))
+    return config
+
+
+class TransportPressure:
+    """
+    Twisted streaming producer of the transport of a Daphne connection, in front of
+    the producer Daphne registered (its HTTPChannel, which pauses reading the socket
+    while the writes pile up): every call is passed on to it, its flow control is kept.
+    Twisted pauses it while the bytes written to the client and not sent yet exceed
+    the transport buffer (bufferSize, 64 KiB), and resumes it once they are sent:
+    `writable` is the real back-pressure of the socket.
+    Twisted calls it from the reactor, which is the asyncio event loop under Daphne.
+    """
+
+    def __init__(self, previous):
+        self.previous = previous
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.pauses = 0
+
+    def pauseProducing(self):
+        self.pauses += 1
+        self.writable.clear()
+        if self.previous is not None:
+            self.previous.pauseProducing()
+
+    def resumeProducing(self):
+        self.writable.set()
+        if self.previous is not None:
+            self.previous.resumeProducing()
+
+    def stopProducing(self):
+        # connection lost: never wait again
+        self.writable.set()
+        if self.previous is not None:
+            self.previous.stopProducing()
+
+
+# reason transport pressure is unavailable -> logged once per process
+unavailable_logged = set()
+
+
+def transport_pressure_unavailable(reason, **fields):
+    if reason not in unavailable_logged:
+        unavailable_logged.add(reason)
+        log.warning("outbound_transport_pressure_unavailable", reason=reason, **fields)
+    return None
+
+
+def watch_transport(send):
+    """
+    TransportPressure of the connection of send, or None: the queue is then only
+    bounded by what it holds (MAX_SIZE / MAX_BYTES), logged once per process.
+    Relies on Daphne internals, checked first: the send callable is
+    `lambda message: self.handle_reply(protocol, message)` (protocol: the autobahn
+    WebSocketServerProtocol) and the Twisted transport keeps its `producer`.
+    """
+    code = getattr(send, '__code__', None)
+    if code is None or 'daphne' not in code.co_filename:
+        return transport_pressure_unavailable('not_daphne')
+    import daphne
+    if not daphne.__version__.startswith(TRANSPORT_PRESSURE_DAPHNE_VERSIONS):
+        return transport_pressure_unavailable('daphne_version', version=daphne.__version__)
+    free_variables = dict(zip(code.co_freevars, (cell.cell_contents for cell in send.__closure__ or ())))
+    transport = getattr(free_variables.get('protocol'), 'transport', None)
+    if transport is None or not hasattr(transport, 'producer') or not hasattr(transport, 'registerProducer'):
+        return transport_pressure_unavailable('daphne_internals', version=daphne.__version__)
+    previous = transport.producer
+    if previous is not None and not transport.streamingProducer:
+        return transport_pressure_unavailable('pull_producer', version=daphne.__version__)
+    pressure = TransportPressure(previous)
+    try:
+        if previous is not None:
+            transport.unregisterProducer()
+        transport.registerProducer(pressure, True)
+    except Exception:
+        # the connection is already gone
+        log.exception("outbound_watch_transport")
+        return None
+    return pressure
+
+
+def frame_size(frame):
+    # characters of a text frame, bytes of a binary one
+    data = frame.get('text_data')
+    if data is None:
+        data = frame.get('bytes_data')
+    return len(data) if data is not None else 0
+
+
+def outbound_queue_stats():
+    """
+    Stats of every open connection of this process, deepest queue first
+    """
+    return sorted((consumer.outbound_stats() for consumer in open_connections_snapshot()), key=lambda s: s['depth'], reverse=True)
+
+
+def open_connections_snapshot():
+    # scraped from a thread while the event loop adds connections
+    while True:
+        try:
+            return list(open_connections)
+        except RuntimeError:
+            pass
+
+
+def per_consumer(value, aggregate=sum):
+    """
+    Gauge function: value(connection) of the open connections, aggregated per consumer
+    """
+    def collect():
+        values = {}
+        for consumer in open_connections_snapshot():
+            values.setdefault((consumer.metrics_label,), []).append(value(consumer))
+        return {key: aggregate(consumer_values) for key, consumer_values in values.items()}
+    return collect
+
+
+OUTBOUND_QUEUED_FRAMES.set_function(per_consumer(lambda consumer: consumer.outbound_depth))
+OUTBOUND_DEEPEST_QUEUE.set_function(per_consumer(lambda consumer: consumer.outbound_depth, max))
+OUTBOUND_PAUSED_SOCKETS.set_function(per_consumer(
+    lambda consumer: int(consumer.outbound_pressure is not None and not consumer.outbound_pressure.writable.is_set())))
+
+
+class OutboundQueueMixin:
+    """
+    Bounded outbound queue for the chat consumers.
+    send / send_json only queue the frame, a writer task writes them to the socket
+    in order, so a slow client never blocks the consumer (and its channel layer
+    inbox keeps being read).
+    The bound is kept at the ASGI level: a frame counts (MAX_SIZE frames, MAX_BYTES
+    bytes) from send until the ASGI send awaited for it returns, so a server applying
+    back-pressure in send fills the queue. When it is full:
+    - 'drop_oldest': the oldest frames waiting are dropped
+    - 'disconnect': the socket is closed with SLOW_CONSUMER_CLOSE_CODE
+    Daphne's send never waits (the frame goes to the Twisted transport buffer): with
+    TRANSPORT_PRESSURE the writer also waits while the transport is paused
+    (watch_transport), a warning is logged when that is not possible.
+    Frames sent with a coalesce_key (the connected user count) replace the frame
+    waiting with the same key instead of taking another slot.
+    accept() and close() are not queued.
+    """
+    outbound = None
+    outbound_sent = 0
+    outbound_dropped = 0
+    outbound_coalesced = 0
+    outbound_max_depth = 0
+
+    def outbound_init(self):
+        config = get_outbound_queue_config()
+        self.outbound_max_size = config['MAX_SIZE']
+        self.outbound_max_bytes = config['MAX_BYTES']
+        self.outbound_policy = config['POLICY']
+        self.outbound_coalesce = config['COALESCE']
+        # [coalesce_key, send kwargs], oldest first
+        self.outbound = deque()
+        self.outbound_keys = {}
+        # frame whose ASGI send is being awaited, and the bytes of every pending frame
+        self.outbound_inflight = 0
+        self.outbound_bytes = 0
+        self.outbound_task = None
+        self.outbound_closed = False
+        self.outbound_pressure = watch_transport(self.base_send) if config['TRANSPORT_PRESSURE'] else None
+        open_connections.add(self)
+
+    @property
+    def outbound_depth(self):
+        return len(self.outbound) + self.outbound_inflight
+
+    def outbound_full(self, size):
+        if not self.outbound_depth:
+            # a frame bigger than MAX_BYTES still goes out alone
+            return False
+        return self.outbound_depth >= self.outbound_max_size or self.outbound_bytes + size > self.outbound_max_bytes
+
+    def outbound_drop_oldest(self):
+        key, frame = self.outbound.popleft()
+        self.outbound_keys.pop(key, None)
+        self.outbound_bytes -= frame_size(frame)
+        self.outbound_dropped += 1
+        OUTBOUND_DROPPED.inc(consumer=self.metrics_label)
+        if self.outbound_dropped == 1 or self.outbound_dropped % 100 == 0:
+            log.warning("slow_consumer_dropping", channel=getattr(self, 'channel_name', None), user=str(self.scope.get('user')), dropped=self.outbound_dropped)
+
+    def outbound_stats(self):
+        return {
+            'channel_name': getattr(self, 'channel_name', None),
+            'user': str(self.scope.get('user')),
+            'depth': self.outbound_depth if self.outbound is not None else 0,
+            'bytes': self.outbound_bytes if self.outbound is not None else 0,
+            'max_depth': self.outbound_max_depth,
+            'sent': self.outbound_sent,
+            'dropped': self.outbound_dropped,
+            'coalesced': self.outbound_coalesced,
+            'transport_paused': self.outbound_pressure is not None and not self.outbound_pressure.writable.is_set(),
+            'transport_pauses': self.outbound_pressure.pauses if self.outbound_pressure is not None else None,
+        }
+
+    async def send(self, text_data=None, bytes_data=None, close=False, coalesce_key=None):
+        await self.enqueue({'text_data': text_data, 'bytes_data': bytes_data, 'close': close}, coalesce_key)
+
+    async def send_json(self, content, close=False, coalesce_key=None):
+        await self.enqueue(dict(await self.encode_frame(content), close=close), coalesce_key)
+
+    async def enqueue(self, frame, coalesce_key=None):
+        if self.outbound is None:
+            self.outbound_init()
+        if self.outbound_closed:
+            return
+        if coalesce_key is not None and self.outbound_coalesce:
+            pending = self.outbound_keys.get(coalesce_key)
+            if pending is not None:
+                # still waiting: send the latest value in its place
+                self.outbound_bytes += frame_size(frame) - frame_size(pending[1])
+                pending[1] = frame
+                self.outbound_coalesced += 1
+                OUTBOUND_COALESCED.inc(consumer=self.metrics_label)
+                return
+        size = frame_size(frame)
+        if self.outbound_full(size):
+            if self.outbound_policy == POLICY_DISCONNECT:
+                log.warning("slow_consumer_disconnected", channel=getattr(self, 'channel_name', None), user=str(self.scope.get('user')), depth=self.outbound_depth, bytes=self.outbound_bytes)
+                OUTBOUND_SLOW_DISCONNECTS.inc(consumer=self.metrics_label)
+                await self.outbound_close()
+                return
+            while self.outbound and self.outbound_full(size):
+                self.outbound_drop_oldest()
+        entry = [coalesce_key, frame]
+        self.outbound.append(entry)
+        self.outbound_bytes += size
+        if coalesce_key is not None:
+            self.outbound_keys[coalesce_key] = entry
+        self.outbound_max_depth = max(self.outbound_max_depth, self.outbound_depth)
+        if self.outbound_task is None or self.outbound_task.done():
+            self.outbound_task = asyncio.ensure_future(self.write_outbound())
+
+    async def write_outbound(self):
+        """
+        Write the queued frames until the queue is empty
+        """
+        while self.outbound:
+            pressure = self.outbound_pressure
+            if pressure is not None and not pressure.writable.is_set():
+                # the client does not read fast enough: wait for Twisted to send what it holds
+                OUTBOUND_TRANSPORT_PAUSES.inc(consumer=self.metrics_label)
+                await pressure.writable.wait()
+                continue
+            key, frame = self.outbound.popleft()
+            self.outbound_keys.pop(key, None)
+            # still pending until the server took it
+            self.outbound_inflight = 1
+            try:
+                await super().send(**frame)
+                self.outbound_sent += 1
+            except Exception:
+                log.exception("outbound_send", channel=getattr(self, 'channel_name', None))
+            finally:
+                self.outbound_inflight = 0
+                self.outbound_bytes -= frame_size(frame)
+
+    async def outbound_close(self):
+        """
+        Close the socket now, dropping what is still waiting
+        """
+        self.outbound_closed = True
+        self.outbound_dropped += len(self.outbound)
+        OUTBOUND_DROPPED.inc(len(self.outbound), consumer=self.metrics_label)
+        self.outbound.clear()
+        self.outbound_keys.clear()
+        self.outbound_bytes = 0
+        if self.outbound_task is not None:
+            self.outbound_task.cancel()
+        await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    async def websocket_disconnect(self, message):
+        try:
+            await super().websocket_disconnect(message)
+        finally:
+            if self.outbound is not None:
+                if self.outbound_task is not None:
+                    self.outbound_task.cancel()
+                open_connections.discard(self)
@@ -0,0 +1,57 @@
+from django.utils.dateparse import parse_datetime
+
+from public_chat.archive import get_chat_archive, is_chat_archive_enabled
+from public_chat.constants import DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE
+
+
+def encode_cursor(message):
+    """
+    Cursor pointing right after a message: its timestamp and id.
+    """
+    return {
+        'timestamp': message.timestamp.isoformat(),
+        'id': message.id,
+    }
+
+
+def decode_cursor(cursor):
+    """
+    return (timestamp, id) from a cursor sent by the client.
+    Raise ValueError if the cursor is malformed.
+    """
+    try:
+        timestamp = parse_datetime(cursor['timestamp'])
+        message_id = int(cursor['id'])
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if timestamp is None:
+        raise ValueError(f"Invalid cursor timestamp: {cursor['timestamp']}")
+    return timestamp, message_id
+
+
+def get_messages_page_before(manager, room, cursor, page_size=DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE):
+    """
+    Keyset pagination over a room chat messages manager (by_room / by_room_before).
+    - cursor = None: most recent page
+    - otherwise: the page right after the cursor
+    return (messages, next_cursor), next_cursor is None when there is nothing left.
+    One query: fetch page_size + 1 rows to know if another page exists, no COUNT(*).
+    """
+    if cursor is None:
+        timestamp, message_id = None, None
+        qs = manager.by_room(room)
+    else:
+        timestamp, message_id = decode_cursor(cursor)
+        qs = manager.by_room_before(room, timestamp, message_id)
+    messages = list(qs[:page_size + 1])
+    if len(messages) < page_size + 1 and is_chat_archive_enabled():
+        # the database is exhausted, go on in the archive (older than every database message)
+        if messages:
+            timestamp, message_id = messages[-1].timestamp, messages[-1].id
+        archive = get_chat_archive(manager.model)
+        messages += archive.before(room.id, timestamp, message_id, page_size + 1 - len(messages))
+    next_cursor = None
+    if len(messages) > page_size:
+        messages = messages[:page_size]
+        next_cursor = encode_cursor(messages[-1])
+    return messages, next_cursor
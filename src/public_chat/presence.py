@@ -0,0 +1,228 @@
+import asyncio
+import os
+import socket
+import time
+import uuid
+from collections import defaultdict
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from codenames_api.log import get_logger
+from public_chat.redis_pool import RedisPool
+
+
+log = get_logger(__name__)
+
+DEFAULT_PRESENCE_STORE = {
+    'BACKEND': 'public_chat.presence.InMemoryPresenceStore',
+}
+
+# Count one more connection of the user in the room hash (KEYS[1]) and in the
+# contributions of this worker (KEYS[2], field ARGV[2]), in one round trip.
+ADD_SCRIPT = """
+local n = redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+redis.call('HINCRBY', KEYS[2], ARGV[2], 1)
+return n
+"""
+
+# Count one less connection, in the room hash and in the contributions of this worker.
+# Drop the user from the room when it reaches 0. A connection already reaped (the
+# worker missed its heartbeat) is not taken out of the room twice.
+REMOVE_SCRIPT = """
+local w = redis.call('HINCRBY', KEYS[2], ARGV[2], -1)
+if w <= 0 then
+    redis.call('HDEL', KEYS[2], ARGV[2])
+    if w < 0 then
+        return 0
+    end
+end
+local n = redis.call('HINCRBY', KEYS[1], ARGV[1], -1)
+if n <= 0 then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+# Take back the connections of the workers whose heartbeat expired (crashed, killed):
+# KEYS[1] the workers sorted set (worker -> heartbeat deadline), ARGV[1] now,
+# ARGV[2] the key prefix. Return the number of workers reaped.
+REAP_SCRIPT = """
+local dead = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, worker in ipairs(dead) do
+    local worker_key = ARGV[2] .. ':worker:' .. worker
+    local contributions = redis.call('HGETALL', worker_key)
+    for i = 1, #contributions, 2 do
+        local sep = string.find(contributions[i], '|', 1, true)
+        local room = ARGV[2] .. ':' .. string.sub(contributions[i], 1, sep - 1)
+        local user = string.sub(contributions[i], sep + 1)
+        if redis.call('HINCRBY', room, user, -tonumber(contributions[i + 1])) <= 0 then
+            redis.call('HDEL', room, user)
+        end
+    end
+    redis.call('DEL', worker_key)
+    redis.call('ZREM', KEYS[1], worker)
+end
+return #dead
+"""
+
+
+class InMemoryPresenceStore:
+    """
+    Process local presence store, for development and tests.
+    Same semantics as RedisPresenceStore but only sees this process connections.
+    """
+
+    def __init__(self, **kwargs):
+        # room key -> {user_id: number of open connections}
+        self.rooms = defaultdict(dict)
+
+    async def add(self, room_key, user_id):
+        """
+        Count one more connection for the user in the room.
+        return True if it is the first connection of this user in the room
+        """
+        members = self.rooms[room_key]
+        members[user_id] = members.get(user_id, 0) + 1
+        return members[user_id] == 1
+
+    async def remove(self, room_key, user_id):
+        """
+        Count one less connection for the user in the room.
+        return True if it was the last connection of this user in the room
+        """
+        members = self.rooms[room_key]
+        if user_id not in members:
+            return False
+        members[user_id] -= 1
+        if members[user_id] <= 0:
+            del members[user_id]
+            return True
+        return False
+
+    async def count(self, room_key):
+        """
+        Number of distinct users connected to the room
+        """
+        return len(self.rooms.get(room_key, ()))
+
+
+class RedisPresenceStore:
+    """
+    Presence store shared by every worker.
+    One redis hash per room: user_id -> number of open connections (tabs).
+    add / remove / count are single O(1) redis commands, a user with several
+    tabs open is counted once.
+    Each worker also records its own connections (one hash per worker) and refreshes
+    a heartbeat every worker_ttl / 3 seconds while it has some. The connections of a
+    worker missing its heartbeat (crashed without calling remove) are taken back out
+    of the room counts by the heartbeat of any other worker.
+    The reaping touches keys of several rooms in one script: one redis host, no cluster.
+    """
+
+    def __init__(self, hosts=None, prefix="presence", worker_ttl=60):
+        self.prefix = prefix
+        self.worker_ttl = worker_ttl
+        self.worker = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.redis = RedisPool(hosts)
+        self.heartbeat_task = None
+        self.first_heartbeat = None
+        # connections of this worker being counted or counted, the heartbeat runs while > 0
+        self.local_connections = 0
+
+    def key(self, room_key):
+        return f"{self.prefix}:{room_key}"
+
+    @property
+    def workers_key(self):
+        return f"{self.prefix}:workers"
+
+    @property
+    def worker_key(self):
+        return f"{self.prefix}:worker:{self.worker}"
+
+    async def add(self, room_key, user_id):
+        """
+        Count one more connection for the user in the room.
+        return True if it is the first connection of this user in the room
+        """
+        # counted before any await: a concurrent remove of the last connection keeps the heartbeat
+        self.local_connections += 1
+        try:
+            await self.ensure_heartbeat()
+            async with self.redis.connection() as conn:
+                n = await conn.eval(ADD_SCRIPT, keys=[self.key(room_key), self.worker_key], args=[user_id, f"{room_key}|{user_id}"])
+        except BaseException:
+            self.connection_gone()
+            raise
+        return n == 1
+
+    async def remove(self, room_key, user_id):
+        """
+        Count one less connection for the user in the room.
+        return True if it was the last connection of this user in the room
+        """
+        try:
+            async with self.redis.connection() as conn:
+                removed = await conn.eval(REMOVE_SCRIPT, keys=[self.key(room_key), self.worker_key], args=[user_id, f"{room_key}|{user_id}"])
+        finally:
+            self.connection_gone()
+        return removed == 1
+
+    async def count(self, room_key):
+        """
+        Number of distinct users connected to the room
+        """
+        async with self.redis.connection() as conn:
+            return await conn.hlen(self.key(room_key))
+
+    async def ensure_heartbeat(self):
+        # checked and started without an await in between: one heartbeat per worker
+        if self.heartbeat_task is None or self.heartbeat_task.done():
+            self.heartbeat_task = asyncio.ensure_future(self.beat())
+        if self.first_heartbeat is None or (self.first_heartbeat.done() and self.first_heartbeat.exception() is not None):
+            self.first_heartbeat = asyncio.ensure_future(self.heartbeat())
+        # first beat before the first connection is counted, awaited by every connection meanwhile
+        await asyncio.shield(self.first_heartbeat)
+
+    def connection_gone(self):
+        self.local_connections -= 1
+        if self.local_connections <= 0:
+            self.local_connections = 0
+            # no connection left to keep alive, the next one starts a heartbeat again
+            if self.heartbeat_task is not None:
+                self.heartbeat_task.cancel()
+            self.heartbeat_task = self.first_heartbeat = None
+
+    async def beat(self):
+        while True:
+            await asyncio.sleep(self.worker_ttl / 3)
+            try:
+                await self.heartbeat()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("presence_heartbeat", worker=self.worker)
+
+    async def heartbeat(self):
+        """
+        Push the deadline of this worker, reap the workers past theirs
+        """
+        now = time.time()
+        async with self.redis.connection() as conn:
+            await conn.zadd(self.workers_key, now + self.worker_ttl, self.worker)
+            reaped = await conn.eval(REAP_SCRIPT, keys=[self.workers_key], args=[now, self.prefix])
+        if reaped:
+            log.warning("presence_workers_reaped", count=reaped, worker=self.worker)
+
+
+@lru_cache(maxsize=None)
+def get_presence_store():
+    """
+    Presence store configured by settings.PRESENCE_STORE (same shape as CHANNEL_LAYERS entries)
+    """
+    config = getattr(settings, 'PRESENCE_STORE', DEFAULT_PRESENCE_STORE)
+    backend = import_string(config['BACKEND'])
+    return backend(**config.get('CONFIG', {}))
@@ -0,0 +1,285 @@
+import json
+from collections import OrderedDict, deque
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.module_loading import import_string
+
+from codenames_api.log import get_logger
+from codenames_api.metrics import RECENT_MESSAGES_LOOKUPS, RECENT_MESSAGES_REBUILDS_SKIPPED, metered_database_sync_to_async
+from public_chat.archive import is_chat_archive_enabled
+from public_chat.constants import DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE
+from public_chat.redis_pool import RedisPool
+from public_chat.serializers import serialize_chat_message
+
+
+log = get_logger(__name__)
+
+DEFAULT_RECENT_MESSAGES_CACHE = {
+    'BACKEND': 'public_chat.recent_messages.InMemoryRecentMessagesCache',
+}
+
+# one more than a page, to know if there is a next page
+RECENT_MESSAGES_SIZE = DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE + 1
+
+# marks a ring rebuilt from a room with less than RECENT_MESSAGES_SIZE messages
+# (an empty room is still a hit), trimmed away once the ring is full
+SENTINEL = ""
+
+# Rebuild the ring (KEYS[1]) with the entries ARGV[4..] read from the database, unless
+# a message was appended since the read (the room version KEYS[2] is not ARGV[1] anymore):
+# the message could be missing from both. ARGV[2] expiry, ARGV[3] size. return 1 if set.
+SET_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+for i = 4, #ARGV do
+    redis.call('RPUSH', KEYS[1], ARGV[i])
+end
+redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[3]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+class InMemoryRecentMessagesCache:
+    """
+    Process local ring buffers, for development and tests.
+    Only sees the messages sent through this process.
+    """
+
+    def __init__(self, size=RECENT_MESSAGES_SIZE, max_rooms=1000, **kwargs):
+        self.size = size
+        self.max_rooms = max_rooms
+        # room key -> deque of entries, most recent first
+        self.rooms = OrderedDict()
+        # room key -> number of messages appended, see set
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, room_key):
+        """
+        return the entries of the room (most recent first), None if the ring is not built
+        """
+        entries = self.rooms.get(room_key)
+        if entries is None:
+            record_lookup(self, False)
+            return None
+        record_lookup(self, True)
+        self.rooms.move_to_end(room_key)
+        return list(entries)
+
+    async def version(self, room_key):
+        """
+        Version of the room to give to set, read before the entries
+        """
+        return self.versions.get(room_key, 0)
+
+    async def set(self, room_key, entries, version):
+        """
+        Build the ring, unless a message was appended since `version` was read.
+        return True if it is built
+        """
+        if self.versions.get(room_key, 0) != version:
+            return False
+        self.rooms[room_key] = deque(entries[:self.size], maxlen=self.size)
+        self.rooms.move_to_end(room_key)
+        while len(self.rooms) > self.max_rooms:
+            self.versions.pop(self.rooms.popitem(last=False)[0], None)
+        return True
+
+    async def append(self, room_key, entry):
+        """
+        Add a new message to the ring if it is built
+        """
+        self.versions[room_key] = self.versions.get(room_key, 0) + 1
+        entries = self.rooms.get(room_key)
+        if entries is not None:
+            entries.appendleft(entry)
+
+    def stats(self):
+        return recent_messages_stats(self)
+
+
+class RedisRecentMessagesCache:
+    """
+    One redis list per room, most recent first, trimmed to `size` entries.
+    New messages are only pushed to rings already built (LPUSHX), a ring is
+    rebuilt from the database on a miss and expires after `expiry` seconds.
+    Every append increments the version of the room: a rebuild racing with a new
+    message is skipped (SET_SCRIPT) instead of leaving the message out of the ring.
+    """
+
+    def __init__(self, hosts=None, prefix="recent-messages", size=RECENT_MESSAGES_SIZE, expiry=3600):
+        self.prefix = prefix
+        self.size = size
+        self.expiry = expiry
+        self.redis = RedisPool(hosts)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, room_key):
+        return f"{self.prefix}:{room_key}"
+
+    def version_key(self, room_key):
+        return f"{self.prefix}:{room_key}:version"
+
+    async def get(self, room_key):
+        """
+        return the entries of the room (most recent first), None if the ring is not built
+        """
+        async with self.redis.connection() as conn:
+            values = await conn.lrange(self.key(room_key), 0, self.size - 1, encoding="utf-8")
+        if not values:
+            record_lookup(self, False)
+            return None
+        record_lookup(self, True)
+        return [json.loads(value) for value in values if value != SENTINEL]
+
+    async def version(self, room_key):
+        """
+        Version of the room to give to set, read before the entries
+        """
+        async with self.redis.connection() as conn:
+            return (await conn.get(self.version_key(room_key), encoding="utf-8")) or '0'
+
+    async def set(self, room_key, entries, version):
+        """
+        Build the ring, unless a message was appended since `version` was read.
+        return True if it is built
+        """
+        values = [json.dumps(entry) for entry in entries[:self.size]] + [SENTINEL]
+        async with self.redis.connection() as conn:
+            built = await conn.eval(
+                SET_SCRIPT,
+                keys=[self.key(room_key), self.version_key(room_key)],
+                args=[version, self.expiry, self.size, *values],
+            )
+        return built == 1
+
+    async def append(self, room_key, entry):
+        """
+        Add a new message to the ring if it is built
+        """
+        key = self.key(room_key)
+        version_key = self.version_key(room_key)
+        async with self.redis.connection() as conn:
+            tr = conn.multi_exec()
+            tr.incr(version_key)
+            tr.expire(version_key, self.expiry)
+            tr.lpushx(key, json.dumps(entry))
+            tr.ltrim(key, 0, self.size - 1)
+            await tr.execute()
+
+    def stats(self):
+        return recent_messages_stats(self)
+
+
+def record_lookup(cache, hit):
+    if hit:
+        cache.hits += 1
+    else:
+        cache.misses += 1
+    RECENT_MESSAGES_LOOKUPS.inc(result='hit' if hit else 'miss')
+
+
+def recent_messages_stats(cache):
+    lookups = cache.hits + cache.misses
+    return {
+        'hits': cache.hits,
+        'misses': cache.misses,
+        'hit_rate': cache.hits / lookups if lookups else None,
+    }
+
+
+@lru_cache(maxsize=None)
+def get_recent_messages_cache():
+    """
+    Recent messages ring buffers configured by settings.RECENT_MESSAGES_CACHE
+    """
+    config = getattr(settings, 'RECENT_MESSAGES_CACHE', DEFAULT_RECENT_MESSAGES_CACHE)
+    backend = import_string(config['BACKEND'])
+    return backend(**config.get('CONFIG', {}))
+
+
+def message_entry(user, content, message=None):
+    """
+    Ring entry of a message. The timestamp is kept raw and formatted when read
+    ('today' becomes 'yesterday'). message is None when the message is not saved
+    yet (write-behind), the entry then has no id and can not be used as a cursor.
+    """
+    return {
+        'id': message.id if message else None,
+        'user_id': user.id,
+        'username': user.username,
+        'profile_image': user.profile_image.url,
+        'message': content,
+        'timestamp': (message.timestamp if message else timezone.now()).isoformat(),
+    }
+
+
+async def append_recent_message(room, user, content, message=None):
+    try:
+        await get_recent_messages_cache().append(room.group_name, message_entry(user, content, message))
+    except Exception:
+        log.exception("append_recent_message", room=room.group_name)
+
+
+def is_first_page(content):
+    """
+    Is this get_chatroom_messages command asking for the most recent messages
+    """
+    if 'before' in content:
+        return content['before'] is None
+    return str(content.get('page_number')) == '1'
+
+
+@metered_database_sync_to_async
+def get_recent_entries_from_db(manager, room):
+    return [message_entry(message.user, message.content, message) for message in manager.by_room(room)[:RECENT_MESSAGES_SIZE]]
+
+
+async def get_recent_chat_messages(room, manager, cursor_mode):
+    """
+    First page of the chat history from the room ring buffer, rebuilt from by_room on a miss.
+    Same payload as get_room_chat_message(room, 1) / get_room_chat_message_before(room, None),
+    None if the page can not be answered from the ring (fall back to the database).
+    """
+    cache = get_recent_messages_cache()
+    try:
+        entries = await cache.get(room.group_name)
+        if entries is None:
+            version = await cache.version(room.group_name)
+            entries = await get_recent_entries_from_db(manager, room)
+            if not await cache.set(room.group_name, entries, version):
+                # a message came in meanwhile: the next request rebuilds the ring
+                RECENT_MESSAGES_REBUILDS_SKIPPED.inc()
+    except Exception:
+        log.exception("get_recent_chat_messages", room=room.group_name)
+        return None
+    page = entries[:DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE]
+    payload = {}
+    payload['messages'] = [
+        serialize_chat_message(entry['user_id'], entry['username'], entry['profile_image'], entry['message'], parse_datetime(entry['timestamp']))
+        for entry in page
+    ]
+    if cursor_mode:
+        next_cursor = None
+        if len(entries) <= DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE and is_chat_archive_enabled():
+            # every database message fits in the page, the next ones may be archived:
+            # get_room_chat_message_before goes on into the archive
+            return None
+        if len(entries) > DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE:
+            if page[-1]['id'] is None:
+                # not saved yet, no cursor
+                return None
+            next_cursor = {'timestamp': page[-1]['timestamp'], 'id': page[-1]['id']}
+        payload['new_page_number'] = None
+        payload['next_cursor'] = next_cursor
+    else:
+        payload['new_page_number'] = 2
+    return payload
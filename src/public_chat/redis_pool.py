@@ -0,0 +1,27 @@
+from contextlib import asynccontextmanager
+
+from channels_redis.core import ConnectionPool
+
+
+class RedisPool:
+    """
+    Redis connections for the chat stores, one pool per event loop
+    (same connection handling as channels_redis).
+    """
+
+    def __init__(self, hosts=None):
+        if not hosts:
+            hosts = [("localhost", 6379)]
+        host = hosts[0]
+        self.pool = ConnectionPool(host if isinstance(host, dict) else {"address": host})
+
+    @asynccontextmanager
+    async def connection(self):
+        conn = await self.pool.pop()
+        try:
+            yield conn
+        except Exception:
+            self.pool.conn_error(conn)
+            raise
+        else:
+            self.pool.push(conn)
@@ -1,20 +1,46 @@
 from public_chat.constants import MSG_TYPE_NEW_MESSAGE
-from django.core.serializers.python import Serializer
+from public_chat.codecs import get_json_codec
 from django.contrib.humanize.templatetags.humanize import naturalday
-from datetime import datetime
+from django.conf import settings
+from django.utils import timezone
+from django.utils.translation import gettext, get_language
+from datetime import datetime, timedelta
+from functools import lru_cache
+import time
 
 
-class LazyRoomChatMessageEncoder(Serializer):
+SECONDS_PER_DAY = 86400
+ZERO_OFFSET = timedelta(0)
+
+
+class LazyRoomChatMessageEncoder:
+    """
+    Chat history messages to dicts.
+    Built directly from the messages of by_room (author already joined),
+    no django serializer machinery and no query per message.
+    """
+
+    def serialize(self, messages):
+        return [self.get_dump_object(obj) for obj in messages]
 
     def get_dump_object(self, obj):
-        dumped_obj = {}
-        dumped_obj.update({'message_type': MSG_TYPE_NEW_MESSAGE})
-        dumped_obj.update({'user_id': obj.user.id})
-        dumped_obj.update({'username': obj.user.username})
-        dumped_obj.update({'message': obj.content})
-        dumped_obj.update({'profile_image': obj.user.profile_image.url})
-        dumped_obj.update({'timestamp': calculate_timestamp(obj.timestamp)})
-        return dumped_obj
+        return serialize_chat_message(obj.user.id, obj.user.username, obj.user.profile_image.url, obj.content, obj.timestamp)
+
+
+def serialize_chat_message(user_id, username, profile_image, content, timestamp):
+    """
+    A chat history message, as sent to the ui
+    """
+    dumped_obj = {}
+    dumped_obj.update({'message_type': MSG_TYPE_NEW_MESSAGE})
+    dumped_obj.update({'user_id': user_id})
+    dumped_obj.update({'username': username})
+    dumped_obj.update({'message': content})
+    dumped_obj.update({'profile_image': profile_image})
+    dumped_obj.update({'timestamp': calculate_timestamp(timestamp)})
+    if getattr(settings, 'CHAT_TIMESTAMP_EPOCH_MS', False):
+        dumped_obj.update({'timestamp_ms': timestamp_epoch_ms(timestamp)})
+    return dumped_obj
 
 
 def calculate_timestamp(timestamp):
@@ -24,6 +50,20 @@ def calculate_timestamp(timestamp):
         - ex: 'yesterday at 5:19 PM'
     2. other:
         - ex: '05/06/2020'
+    Same output as calculate_naturalday_timestamp, without the naturalday calls:
+    the day of the timestamp is found by comparing its epoch seconds with today's
+    boundaries (computed once per day) and formatted minutes / days are cached.
+    """
+    offset = timestamp.utcoffset()
+    if offset is None or offset != ZERO_OFFSET:
+        # naive or non UTC datetimes: let naturalday deal with the timezone
+        return calculate_naturalday_timestamp(timestamp)
+    return timestamp_formatter.format(int(timestamp.timestamp()))
+
+
+def calculate_naturalday_timestamp(timestamp):
+    """
+    Reference implementation of calculate_timestamp, using naturalday.
     """
     # Today or yesterday
     if (naturalday(timestamp) == "today" or naturalday(timestamp) == "yesterday"):
@@ -34,4 +74,105 @@ def calculate_timestamp(timestamp):
     else:
         str_time = datetime.strftime(timestamp, "%m/%d/%Y")
         ts = f"{str_time}"
-    return ts
\ No newline at end of file
+    return ts
+
+
+class TimestampFormatter:
+    """
+    calculate_timestamp for UTC timestamps given as epoch seconds.
+    """
+
+    def __init__(self):
+        self.today_start = None
+        self.tomorrow_start = None
+
+    def refresh_day(self, now):
+        """
+        Compute today's boundaries (UTC), once per day.
+        """
+        self.today_start = now - now % SECONDS_PER_DAY
+        self.tomorrow_start = self.today_start + SECONDS_PER_DAY
+
+    def format(self, epoch_seconds):
+        now = int(time.time())
+        if self.tomorrow_start is None or now >= self.tomorrow_start:
+            self.refresh_day(now)
+        if self.today_start <= epoch_seconds < self.tomorrow_start:
+            label = 'today'
+        elif self.today_start - SECONDS_PER_DAY <= epoch_seconds < self.today_start:
+            label = 'yesterday'
+        else:
+            return format_day(epoch_seconds // SECONDS_PER_DAY)
+        if not is_untranslated(get_language(), label):
+            # a translated naturalday never matches 'today' / 'yesterday' in calculate_naturalday_timestamp
+            return format_day(epoch_seconds // SECONDS_PER_DAY)
+        return format_minute(label, epoch_seconds // 60)
+
+
+@lru_cache(maxsize=None)
+def is_untranslated(language, label):
+    """
+    True if naturalday returns label as is in this language, checked once per language
+    """
+    return gettext(label) == label
+
+
+@lru_cache(maxsize=4096)
+def format_minute(label, epoch_minute):
+    """
+    ex: 'today at 10:56 AM', for the minute bucket epoch_minute (UTC)
+    """
+    str_time = datetime.utcfromtimestamp(epoch_minute * 60).strftime("%I:%M %p").strip("0")
+    return f"{label} at {str_time}"
+
+
+@lru_cache(maxsize=1024)
+def format_day(epoch_day):
+    """
+    ex: '05/06/2020', for the day bucket epoch_day (UTC)
+    """
+    return datetime.utcfromtimestamp(epoch_day * SECONDS_PER_DAY).strftime("%m/%d/%Y")
+
+
+timestamp_formatter = TimestampFormatter()
+
+
+def timestamp_epoch_ms(timestamp):
+    """
+    Raw timestamp for the clients formatting dates themselves (settings.CHAT_TIMESTAMP_EPOCH_MS)
+    """
+    return int(timestamp.timestamp() * 1000)
+
+
+def encode_new_message_frame(user, message, room=None):
+    """
+    Websocket frame for a new message, built once by the sender and
+    sent as is to every socket of the room (same timestamp for everyone).
+    """
+    return get_json_codec().dumps(new_message_frame(user, message, room))
+
+
+def encode_new_message_event(user, message, room=None):
+    """
+    The new message frame for the chat.message group event, as JSON 'text'
+    (the binary sockets convert it, see MessagePackProtocolMixin).
+    room: room_tag of the room, tags the frame for the multiplexed sockets
+    """
+    return {"text": encode_new_message_frame(user, message, room)}
+
+
+def new_message_frame(user, message, room=None):
+    now = timezone.now()
+    frame = {
+        "message_type": MSG_TYPE_NEW_MESSAGE,
+        "profile_image": user.profile_image.url,
+        "username": user.username,
+        "user_id": user.id,
+        "message": message,
+        "timestamp": calculate_timestamp(now)
+    }
+    if getattr(settings, 'CHAT_TIMESTAMP_EPOCH_MS', False):
+        frame["timestamp_ms"] = timestamp_epoch_ms(now)
+    if room is not None:
+        frame["room"] = room
+    return frame
\ No newline at end of file
@@ -0,0 +1,218 @@
+import asyncio
+import time
+import zlib
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from codenames_api.log import get_logger
+from codenames_api.metrics import GROUP_FANOUT_DURATION, GROUP_FANOUT_ROUND_TRIPS, group_send
+from public_chat.presence import get_presence_store
+from public_chat.redis_pool import RedisPool
+
+
+log = get_logger(__name__)
+
+DEFAULT_CHAT_GROUP_SHARDING = {
+    'ENABLED': False,
+    'MEMBERS_PER_SHARD': 200,   # connected users per sub-group before the room doubles its sub-groups
+    'MAX_SHARDS': 32,
+    'STORE': {
+        'BACKEND': 'public_chat.sharding.InMemoryShardCountStore',
+    },
+}
+
+# A socket joins: raise the shard count of the room to ARGV[1] if it is lower,
+# count the socket, return the shard count.
+JOIN_SCRIPT = """
+local n = tonumber(redis.call('GET', KEYS[1]) or '1')
+if tonumber(ARGV[1]) > n then
+    n = tonumber(ARGV[1])
+end
+redis.call('SET', KEYS[1], n)
+redis.call('INCR', KEYS[2])
+return n
+"""
+
+# A socket leaves: the last one deletes the shard count, the room goes back to one group.
+LEAVE_SCRIPT = """
+local members = redis.call('DECR', KEYS[2])
+if members <= 0 then
+    redis.call('DEL', KEYS[1], KEYS[2])
+end
+return members
+"""
+
+
+def get_group_sharding_config():
+    config = dict(DEFAULT_CHAT_GROUP_SHARDING)
+    config.update(getattr(settings, 'CHAT_GROUP_SHARDING', {}))
+    return config
+
+
+class InMemoryShardCountStore:
+    """
+    Process local shard counts, for development and tests.
+    """
+
+    def __init__(self, **kwargs):
+        self.counts = {}
+        self.members = {}
+
+    async def get(self, group_name):
+        return self.counts.get(group_name, 1)
+
+    async def join(self, group_name, shards):
+        """
+        A socket joins the group: raise its shard count to `shards`, return the count
+        (never lowered while the group has members)
+        """
+        self.counts[group_name] = max(self.counts.get(group_name, 1), shards)
+        self.members[group_name] = self.members.get(group_name, 0) + 1
+        return self.counts[group_name]
+
+    async def leave(self, group_name):
+        """
+        A socket leaves the group, the last one resets its shard count
+        """
+        self.members[group_name] = self.members.get(group_name, 0) - 1
+        if self.members[group_name] <= 0:
+            del self.members[group_name]
+            self.counts.pop(group_name, None)
+
+
+class RedisShardCountStore:
+    """
+    Shard counts shared by every worker, one redis key per sharded room and a count
+    of its sockets. No expiry: the count must outlive the quietest room still used,
+    it is deleted when the last socket leaves. The sockets of a crashed worker are
+    never counted out, the room then keeps its shard count (more sub-groups than
+    needed, never fewer).
+    """
+
+    def __init__(self, hosts=None, prefix="group_shards"):
+        self.prefix = prefix
+        self.redis = RedisPool(hosts)
+
+    def key(self, group_name):
+        return f"{self.prefix}:{group_name}"
+
+    def members_key(self, group_name):
+        return f"{self.prefix}:{group_name}:members"
+
+    async def get(self, group_name):
+        async with self.redis.connection() as conn:
+            n = await conn.get(self.key(group_name))
+        return int(n) if n else 1
+
+    async def join(self, group_name, shards):
+        async with self.redis.connection() as conn:
+            return int(await conn.eval(JOIN_SCRIPT, keys=[self.key(group_name), self.members_key(group_name)], args=[shards]))
+
+    async def leave(self, group_name):
+        async with self.redis.connection() as conn:
+            await conn.eval(LEAVE_SCRIPT, keys=[self.key(group_name), self.members_key(group_name)])
+
+
+def shard_group_name(group_name, shard):
+    """
+    Sub-group `shard` of a group, shard 0 is the group itself
+    """
+    return group_name if shard == 0 else f"{group_name}.{shard}"
+
+
+def shard_of(channel_name, shards):
+    return zlib.crc32(channel_name.encode()) % shards
+
+
+class ShardedGroups:
+    """
+    Fan-out of the big public rooms split over sub-groups.
+    A channels_redis group_send reads every member of the group then writes to their
+    inboxes, one group at a time: with sub-groups the sends run in parallel.
+    - a socket joins the sub-group of its channel name (crc32 % shard count) and
+      leaves the sub-group it joined (see add / discard)
+    - the shard count of a room is a power of two growing with its connected users
+      (MEMBERS_PER_SHARD users per sub-group, MAX_SHARDS at most). It never shrinks
+      while the room has sockets, so the members of every sub-group keep receiving
+    - a send reads the shard count (one round trip) and sends to every sub-group
+    Disabled (the default), every call is the plain channel layer one on the room group.
+    """
+
+    def __init__(self, enabled, members_per_shard, max_shards, store):
+        self.enabled = enabled
+        self.members_per_shard = members_per_shard
+        self.max_shards = max_shards
+        self.store = store
+        self.sends = 0
+        self.sub_group_sends = 0
+        self.max_shards_used = 1
+
+    def shards_for(self, members):
+        shards = 1
+        while shards < self.max_shards and members > shards * self.members_per_shard:
+            shards *= 2
+        return shards
+
+    async def add(self, channel_layer, group_name, channel_name):
+        """
+        group_add to the sub-group of the channel, return the group joined (to discard it later)
+        """
+        if not self.enabled:
+            await channel_layer.group_add(group_name, channel_name)
+            return group_name
+        members = await get_presence_store().count(group_name)
+        shards = await self.store.join(group_name, self.shards_for(members))
+        group = shard_group_name(group_name, shard_of(channel_name, shards))
+        await channel_layer.group_add(group, channel_name)
+        return group
+
+    async def discard(self, channel_layer, group_name, group, channel_name):
+        """
+        group_discard from `group`, returned by add (None: never added, the room group)
+        """
+        if group is None:
+            await channel_layer.group_discard(group_name, channel_name)
+            return
+        await channel_layer.group_discard(group, channel_name)
+        if self.enabled:
+            await self.store.leave(group_name)
+
+    async def send(self, channel_layer, group_name, event):
+        """
+        group_send to every sub-group of the room, in parallel
+        """
+        if not self.enabled:
+            return await group_send(channel_layer, group_name, event)
+        start = time.perf_counter()
+        shards = await self.store.get(group_name)
+        await asyncio.gather(*[
+            group_send(channel_layer, shard_group_name(group_name, shard), event)
+            for shard in range(shards)
+        ])
+        self.sends += 1
+        self.sub_group_sends += shards
+        self.max_shards_used = max(self.max_shards_used, shards)
+        GROUP_FANOUT_DURATION.observe(time.perf_counter() - start, shards=shards)
+        # shard count read + one group_send round trip sequence per sub-group
+        GROUP_FANOUT_ROUND_TRIPS.observe(1 + shards, shards=shards)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'sends': self.sends,
+            'sub_group_sends': self.sub_group_sends,
+            'max_shards': self.max_shards_used,
+        }
+
+
+@lru_cache(maxsize=None)
+def get_sharded_groups():
+    """
+    Sub-groups of the public rooms, settings.CHAT_GROUP_SHARDING
+    (STORE has the same shape as the CHANNEL_LAYERS entries)
+    """
+    config = get_group_sharding_config()
+    store = import_string(config['STORE']['BACKEND'])(**config['STORE'].get('CONFIG', {}))
+    return ShardedGroups(config['ENABLED'], config['MEMBERS_PER_SHARD'], config['MAX_SHARDS'], store)
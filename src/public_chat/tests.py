@@ -1,3 +1,704 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone as datetime_timezone
 
-# Create your tests here.
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.core.paginator import Paginator
+from django.urls import reverse
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone, translation
+from rest_framework.test import APIClient
+
+from account.models import Account
+from codenames_api.metrics import registry
+from private_chat.exceptions import ClientError
+from private_chat.models import PrivateChatRoom
+from public_chat.archive import get_chat_archive
+from public_chat.batching import MessageBatchingMixin
+from public_chat.broadcast import get_connected_user_count_broadcaster
+from public_chat.constants import DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE, MSG_TYPE_MESSAGES_BATCH, MSG_TYPE_NEW_MESSAGE, MSGPACK_FRAME_KEYS, MSGPACK_SUBPROTOCOL, SLOW_CONSUMER_CLOSE_CODE
+from public_chat.local_fanout import LocalFanoutInMemoryChannelLayer
+from public_chat.models import PublicChatRoom, PublicRoomChatMessage
+from public_chat.multiplex import MultiplexChatConsumer
+from public_chat.outbound import OutboundQueueMixin, unavailable_logged, watch_transport
+from public_chat.pagination import get_messages_page_before
+from public_chat.presence import RedisPresenceStore, get_presence_store
+from public_chat.recent_messages import InMemoryRecentMessagesCache, get_recent_messages_cache
+from public_chat.serializers import LazyRoomChatMessageEncoder, calculate_naturalday_timestamp, calculate_timestamp
+from public_chat.sharding import ShardedGroups, InMemoryShardCountStore, get_sharded_groups
+from public_chat.write_behind import ChatMessageWriteBehindBuffer
+
+
+class CalculateTimestampTest(SimpleTestCase):
+    """
+    calculate_timestamp (day boundaries + caches) gives the output of the naturalday reference
+    """
+
+    def assertSameAsReference(self, timestamps):
+        for timestamp in timestamps:
+            self.assertEqual(calculate_timestamp(timestamp), calculate_naturalday_timestamp(timestamp), timestamp)
+
+    def timestamps(self):
+        now = timezone.now()
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        return [
+            now,
+            now - timedelta(minutes=1),
+            midnight,                                   # first second of today
+            midnight - timedelta(seconds=1),            # last second of yesterday
+            midnight - timedelta(days=1),               # first second of yesterday
+            midnight - timedelta(days=1, seconds=1),    # last second of the day before
+            midnight - timedelta(days=1, hours=-12, minutes=-3),
+            midnight - timedelta(days=2, hours=6),
+            now - timedelta(days=400),
+            datetime(2020, 5, 6, 0, 0, tzinfo=timezone.utc),
+        ]
+
+    def test_english(self):
+        with translation.override('en'):
+            self.assertSameAsReference(self.timestamps())
+
+    def test_translated(self):
+        # naturalday returns "aujourd'hui" / "hier": formatted as a date by both
+        with translation.override('fr'):
+            self.assertSameAsReference(self.timestamps())
+
+    def test_timezone_aware_not_utc(self):
+        paris = datetime_timezone(timedelta(hours=2))
+        self.assertSameAsReference([timestamp.astimezone(paris) for timestamp in self.timestamps()])
+
+
+class RecentMessagesCacheTest(SimpleTestCase):
+
+    def test_rebuild_racing_with_a_message_is_skipped(self):
+        async def run():
+            cache = InMemoryRecentMessagesCache()
+            version = await cache.version("PublicChatRoom-1")
+            # saved and appended while the ring is read from the database: not in the read
+            await cache.append("PublicChatRoom-1", {'message': "new"})
+            skipped = not await cache.set("PublicChatRoom-1", [{'message': "old"}], version)
+            missing = await cache.get("PublicChatRoom-1")
+            built = await cache.set("PublicChatRoom-1", [{'message': "new"}, {'message': "old"}], await cache.version("PublicChatRoom-1"))
+            return skipped, missing, built, await cache.get("PublicChatRoom-1")
+        skipped, missing, built, entries = async_to_sync(run)()
+        self.assertTrue(skipped)
+        self.assertIsNone(missing)
+        self.assertTrue(built)
+        self.assertEqual(entries, [{'message': "new"}, {'message': "old"}])
+
+
+class LogLevelViewTest(TestCase):
+
+    def setUp(self):
+        self.admin = Account.objects.create_user("admin@codenames.com", "admin", "password")
+        self.admin.is_staff = True
+        self.admin.save()
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def tearDown(self):
+        logging.getLogger("public_chat.outbound").setLevel(logging.NOTSET)
+
+    def test_change_level(self):
+        url = reverse('chat-log-levels')
+        response = self.client.post(url, {'logger': "public_chat.outbound", 'level': "debug"}, format='json')
+        data = json.loads(response.data)
+        self.assertEqual((response.status_code, data['success'], data['pid']), (200, True, os.getpid()))
+        self.assertEqual(data['levels']["public_chat.outbound"], "DEBUG")
+        response = self.client.post(url, {'logger': "django", 'level': "DEBUG"}, format='json')
+        self.assertEqual((response.status_code, json.loads(response.data)['success']), (400, False))
+        data = json.loads(self.client.get(url).data)
+        self.assertEqual(data['levels']["public_chat.outbound"], "DEBUG")
+
+    def test_invalid_types(self):
+        url = reverse('chat-log-levels')
+        for payload in ({'logger': ["public_chat"], 'level': "DEBUG"}, {'logger': 1, 'level': "DEBUG"}, {'logger': "public_chat.outbound", 'level': 10}, {'logger': "public_chat.outbound"}):
+            response = self.client.post(url, payload, format='json')
+            data = json.loads(response.data)
+            self.assertEqual((response.status_code, data['success'], data['status_code']), (400, False, 400))
+
+
+class FakeProducer:
+
+    def __init__(self):
+        self.calls = []
+
+    def pauseProducing(self):
+        self.calls.append('pause')
+
+    def resumeProducing(self):
+        self.calls.append('resume')
+
+
+class FakeTransport:
+    """
+    What watch_transport uses of the Twisted transport of a Daphne connection
+    """
+
+    def __init__(self, producer):
+        self.producer = producer
+        self.streamingProducer = True
+
+    def registerProducer(self, producer, streaming):
+        if self.producer is not None:
+            raise RuntimeError("Cannot register producer, because one is already registered")
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+class FakeDaphneProtocol:
+
+    def __init__(self):
+        self.daphne_producer = FakeProducer()
+        self.transport = FakeTransport(self.daphne_producer)
+        self.frames = []
+
+
+def daphne_send(protocol):
+    """
+    The ASGI send callable of Daphne 3.0: `lambda message: self.handle_reply(protocol, message)`
+    """
+    namespace = {}
+    exec(compile("def make(protocol):\n    return lambda message: protocol.frames.append(message)\n", "/site-packages/daphne/server.py", "exec"), namespace)
+    return namespace['make'](protocol)
+
+
+class FakeWebsocketConsumer:
+    scope = {}
+    closed = None
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        sent = self.base_send(text_data)
+        if asyncio.iscoroutine(sent):
+            await sent
+
+    async def close(self, code=None):
+        self.closed = code
+
+    async def websocket_disconnect(self, message):
+        pass
+
+
+class OutboundConsumer(OutboundQueueMixin, FakeWebsocketConsumer):
+    metrics_label = "test"
+
+    def __init__(self, send):
+        self.base_send = send
+
+
+class BatchingConsumer(MessageBatchingMixin, FakeWebsocketConsumer):
+    metrics_label = "test"
+
+    def __init__(self, send):
+        self.base_send = send
+
+    def pre_encoded_frame(self, event):
+        return {'text_data': event['text']}
+
+    def pre_encoded_batch(self, events):
+        return {'text_data': "[%s]" % ",".join(event['text'] for event in events)}
+
+
+class MessageBatchingTest(SimpleTestCase):
+
+    def test_window_flush_awaited_on_disconnect(self):
+        async def run():
+            frames = []
+            async def send(message):
+                await asyncio.sleep(0.05)
+                frames.append(message)
+            consumer = BatchingConsumer(send)
+            consumer.batch_window, consumer.batch_max_size = 0.01, 10
+            await consumer.send_pre_encoded({'text': "1"})
+            await consumer.send_pre_encoded({'text': "2"})
+            await asyncio.sleep(0.02)
+            # the window closed, its batch is being sent
+            self.assertIsNotNone(consumer.batch_flush_task)
+            await consumer.websocket_disconnect({'code': 1000})
+            return frames, consumer.batch_flush_task
+        frames, task = async_to_sync(run)()
+        self.assertEqual(frames, ["[1,2]"])
+        self.assertIsNone(task)
+
+    def test_window_flush_failure_logged(self):
+        async def run():
+            async def send(message):
+                raise ConnectionError("gone")
+            consumer = BatchingConsumer(send)
+            consumer.batch_window, consumer.batch_max_size = 0.01, 10
+            await consumer.send_pre_encoded({'text': "1"})
+            await asyncio.sleep(0.05)
+        with self.assertLogs('public_chat.batching', 'ERROR') as logs:
+            async_to_sync(run)()
+        self.assertEqual([record.fields['error'] for record in logs.records], ["ConnectionError('gone')"])
+
+
+@override_settings(WEBSOCKET_OUTBOUND_QUEUE={'MAX_SIZE': 3})
+class OutboundQueueTest(SimpleTestCase):
+
+    def test_bounded_at_the_asgi_level(self):
+        async def run():
+            # a server applying back-pressure in send: nothing written until the gate opens
+            gate, frames = asyncio.Event(), []
+            async def send(message):
+                await gate.wait()
+                frames.append(message)
+            consumer = OutboundConsumer(send)
+            await consumer.send("0")
+            await asyncio.sleep(0)
+            for i in range(1, 6):
+                await consumer.send(str(i))
+            paused = consumer.outbound_stats()
+            self.assertIn('chat_outbound_queued_frames{consumer="test"} 3\n', registry.render())
+            gate.set()
+            await asyncio.sleep(0.01)
+            return paused, frames, consumer.outbound_stats()
+        paused, frames, stats = async_to_sync(run)()
+        # the frame being sent counts
+        self.assertEqual((paused['depth'], paused['dropped']), (3, 3))
+        self.assertEqual(frames, ["0", "4", "5"])
+        self.assertEqual((stats['depth'], stats['bytes']), (0, 0))
+
+    @override_settings(WEBSOCKET_OUTBOUND_QUEUE={'MAX_BYTES': 10, 'POLICY': 'disconnect'})
+    def test_bytes_bound_disconnects(self):
+        async def run():
+            gate = asyncio.Event()
+            async def send(message):
+                await gate.wait()
+            consumer = OutboundConsumer(send)
+            for frame in ("aaaa", "bbbb"):
+                await consumer.send(frame)
+                await asyncio.sleep(0)
+            self.assertIsNone(consumer.closed)
+            await consumer.send("cccc")
+            return consumer.closed
+        self.assertEqual(async_to_sync(run)(), SLOW_CONSUMER_CLOSE_CODE)
+
+    def test_transport_pressure(self):
+        async def run():
+            protocol = FakeDaphneProtocol()
+            consumer = OutboundConsumer(daphne_send(protocol))
+            await consumer.send("0")
+            await asyncio.sleep(0)
+            self.assertIs(protocol.transport.producer, consumer.outbound_pressure)
+            # the client stops reading: Twisted pauses the producer, and Daphne's with it
+            protocol.transport.producer.pauseProducing()
+            for i in range(1, 6):
+                await consumer.send(str(i))
+            await asyncio.sleep(0)
+            paused = list(protocol.frames), consumer.outbound_stats()
+            self.assertIn('chat_outbound_paused_sockets{consumer="test"} 1\n', registry.render())
+            protocol.transport.producer.resumeProducing()
+            await asyncio.sleep(0.01)
+            return protocol, paused, consumer.outbound_stats()
+        protocol, (paused_frames, paused_stats), stats = async_to_sync(run)()
+        self.assertEqual(paused_frames, ["0"])
+        self.assertEqual((paused_stats['depth'], paused_stats['dropped'], paused_stats['transport_paused']), (3, 2, True))
+        self.assertEqual(protocol.frames, ["0", "3", "4", "5"])
+        self.assertEqual((stats['depth'], stats['transport_paused'], stats['transport_pauses']), (0, False, 1))
+        self.assertEqual(protocol.daphne_producer.calls, ['pause', 'resume'])
+
+    def test_transport_pressure_unavailable(self):
+        unavailable_logged.clear()
+        with self.assertLogs('public_chat.outbound', 'WARNING') as logs:
+            self.assertIsNone(watch_transport(lambda message: None))
+            self.assertIsNone(watch_transport(lambda message: None))
+        self.assertEqual([record.fields['reason'] for record in logs.records], ['not_daphne'])
+
+
+class ChatHistoryQueriesTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.room = PublicChatRoom.objects.create(title="lobby")
+        users = [Account.objects.create_user(f"user{i}@codenames.com", f"user{i}", "password") for i in range(5)]
+        PublicRoomChatMessage.objects.bulk_create([
+            PublicRoomChatMessage(user=users[i % len(users)], room=cls.room, content=f"message {i}")
+            for i in range(DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE * 2)
+        ])
+
+    def test_cursor_page_is_one_query(self):
+        with self.assertNumQueries(1):
+            messages, next_cursor = get_messages_page_before(PublicRoomChatMessage.objects, self.room, None)
+            data = LazyRoomChatMessageEncoder().serialize(messages)
+        self.assertEqual(len(data), DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE)
+        self.assertIsNotNone(next_cursor)
+        self.assertEqual(set(data[0]), {'message_type', 'user_id', 'username', 'message', 'profile_image', 'timestamp'})
+
+    def test_page_number_does_not_grow_with_page_size(self):
+        # COUNT(*) + page
+        with self.assertNumQueries(2):
+            page = Paginator(PublicRoomChatMessage.objects.by_room(self.room), DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE).page(1)
+            data = LazyRoomChatMessageEncoder().serialize(page.object_list)
+        self.assertEqual(len(data), DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE)
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    PRESENCE_STORE={'BACKEND': 'public_chat.presence.InMemoryPresenceStore'},
+    RECENT_MESSAGES_CACHE={'BACKEND': 'public_chat.recent_messages.InMemoryRecentMessagesCache'},
+    CONNECTED_USER_COUNT_BROADCAST_WINDOW=0,
+)
+class MultiplexChatConsumerTest(TransactionTestCase):
+    """
+    One socket in a public and a private room, frames tagged by room.
+    (database_sync_to_async closes the connection, no TestCase transaction)
+    """
+
+    def setUp(self):
+        for cached in (get_presence_store, get_recent_messages_cache, get_connected_user_count_broadcaster, get_sharded_groups):
+            cached.cache_clear()
+        self.alice, self.bob, self.carol = [Account.objects.create_user(f"{name}@codenames.com", name, "password") for name in ("alice", "bob", "carol")]
+        self.lobby = PublicChatRoom.objects.create(title="lobby")
+        self.private = PrivateChatRoom.objects.create()
+        self.private.users.add(self.alice, self.bob)
+
+    async def connect(self, user, *rooms, subprotocols=None):
+        communicator = WebsocketCommunicator(MultiplexChatConsumer.as_asgi(), "/chat/", subprotocols=subprotocols)
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        for room in rooms:
+            await communicator.send_json_to({'command': 'join', 'room': room.room_tag})
+        return communicator
+
+    async def receive_all(self, communicator):
+        frames = []
+        while not await communicator.receive_nothing(0.1):
+            frames.append(await communicator.receive_json_from())
+        return frames
+
+    def test_rooms_on_one_socket(self):
+        async def run():
+            alice = await self.connect(self.alice, self.lobby, self.private)
+            carol = await self.connect(self.carol, self.lobby, self.private)
+            joined = [frame for frame in await self.receive_all(alice) if 'join' in frame]
+            self.assertEqual([frame['room'] for frame in joined], ["public:%d" % self.lobby.id, "private:%d" % self.private.id])
+            errors = [frame for frame in await self.receive_all(carol) if 'error' in frame]
+            self.assertEqual([(frame['error'], frame['room']) for frame in errors], [(403, self.private.room_tag)])
+            # alice in a public and a private room, carol in the public one only
+            metrics = registry.render()
+            self.assertIn('chat_websocket_connections{consumer="multiplex_chat",room_type="public"} 2\n', metrics)
+            self.assertIn('chat_websocket_connections{consumer="multiplex_chat",room_type="private"} 1\n', metrics)
+
+            await alice.send_json_to({'command': 'send', 'room': self.private.room_tag, 'message': "private"})
+            await alice.send_json_to({'command': 'send', 'room': self.lobby.room_tag, 'message': "public"})
+            messages = [frame for frame in await self.receive_all(alice) if frame.get('message_type') == MSG_TYPE_NEW_MESSAGE]
+            self.assertEqual([(frame['room'], frame['message']) for frame in messages], [(self.private.room_tag, "private"), (self.lobby.room_tag, "public")])
+            messages = [frame for frame in await self.receive_all(carol) if frame.get('message_type') == MSG_TYPE_NEW_MESSAGE]
+            self.assertEqual([(frame['room'], frame['message']) for frame in messages], [(self.lobby.room_tag, "public")])
+
+            await alice.send_json_to({'command': 'leave', 'room': self.lobby.room_tag})
+            self.assertIn({'leave': str(self.lobby.id), 'room': self.lobby.room_tag}, await self.receive_all(alice))
+            await alice.disconnect()
+            await carol.disconnect()
+        async_to_sync(run)()
+
+    def test_set_batch_window_validation(self):
+        async def run():
+            alice = await self.connect(self.alice)
+            await self.receive_all(alice)
+            replies = []
+            for window_ms in ("abc", [30], -1, True, 10000, 20.5, None):
+                await alice.send_json_to({'command': 'set_batch_window', 'window_ms': window_ms})
+                replies.append(await alice.receive_json_from())
+            await alice.disconnect()
+            return replies
+        replies = async_to_sync(run)()
+        self.assertEqual([reply.get('error') for reply in replies[:4]], [422] * 4)
+        # capped by MAX_WINDOW_MS (50), the socket is still open after the errors
+        self.assertEqual(replies[4:], [{'batch_window_ms': 50}, {'batch_window_ms': 20}, {'batch_window_ms': 0}])
+
+    @override_settings(CHAT_MESSAGE_BATCHING={'MAX_WINDOW_MS': 300, 'MAX_SIZE': 3})
+    def test_batched_messages(self):
+        async def run():
+            alice = await self.connect(self.alice, self.lobby)
+            carol = await self.connect(self.carol, self.lobby)
+            await self.receive_all(alice)
+            await self.receive_all(carol)
+            await carol.send_json_to({'command': 'set_batch_window', 'window_ms': 1000})
+            self.assertEqual(await carol.receive_json_from(), {'batch_window_ms': 300})
+
+            # MAX_SIZE messages: sent at once
+            for i in range(3):
+                await alice.send_json_to({'command': 'send', 'room': self.lobby.room_tag, 'message': f"full {i}"})
+            full = await carol.receive_json_from(timeout=1)
+            # fewer: sent when the window closes, after MAX_WINDOW_MS at most
+            await alice.send_json_to({'command': 'send', 'room': self.lobby.room_tag, 'message': "alone"})
+            await alice.send_json_to({'command': 'send', 'room': self.lobby.room_tag, 'message': "pair"})
+            started = time.monotonic()
+            closed = await carol.receive_json_from(timeout=2)
+            waited = time.monotonic() - started
+            await alice.disconnect()
+            await carol.disconnect()
+            return full, closed, waited
+        full, closed, waited = async_to_sync(run)()
+        self.assertEqual(full['message_type'], MSG_TYPE_MESSAGES_BATCH)
+        self.assertEqual([frame['message'] for frame in full['messages']], ["full 0", "full 1", "full 2"])
+        self.assertEqual([frame['message'] for frame in closed['messages']], ["alone", "pair"])
+        self.assertLess(waited, 0.8)
+
+    def test_binary_protocol_from_json_event(self):
+        async def run():
+            alice = await self.connect(self.alice, self.lobby)
+            bob = await self.connect(self.bob, subprotocols=[MSGPACK_SUBPROTOCOL])
+            await bob.send_to(bytes_data=msgpack.packb({'command': 'join', 'room': self.lobby.room_tag}))
+            await asyncio.sleep(0.1)
+            await self.receive_all(alice)
+            while not await bob.receive_nothing(0.1):
+                await bob.receive_from()
+
+            sent = []
+            layer = get_channel_layer()
+            group_send = layer.group_send
+            async def record(group, event):
+                sent.append(event)
+                await group_send(group, event)
+            layer.group_send = record
+            await alice.send_json_to({'command': 'send', 'room': self.lobby.room_tag, 'message': "hello"})
+            text = [frame for frame in await self.receive_all(alice) if frame.get('message_type') == MSG_TYPE_NEW_MESSAGE]
+            binary = msgpack.unpackb(await bob.receive_from(), strict_map_key=False)
+            await alice.disconnect()
+            await bob.disconnect()
+            return sent, text, binary
+        sent, text, binary = async_to_sync(run)()
+        # only the JSON encoding goes through the channel layer
+        self.assertEqual([sorted(event) for event in sent if event['type'] == 'chat.message'], [['text', 'type', 'user_id']])
+        self.assertEqual(text[0]['message'], "hello")
+        self.assertEqual(binary[MSGPACK_FRAME_KEYS['message']], "hello")
+        self.assertEqual(binary[MSGPACK_FRAME_KEYS['timestamp']], text[0]['timestamp'])
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    PRESENCE_STORE={'BACKEND': 'public_chat.presence.InMemoryPresenceStore'},
+    RECENT_MESSAGES_CACHE={'BACKEND': 'public_chat.recent_messages.InMemoryRecentMessagesCache'},
+    CONNECTED_USER_COUNT_BROADCAST_WINDOW=0,
+)
+class ArchivedHistoryTest(TransactionTestCase):
+    """
+    A room with a few recent messages and archived months: the cursor pages
+    go from the recent messages ring into the archive segments
+    """
+
+    def setUp(self):
+        for cached in (get_presence_store, get_recent_messages_cache, get_connected_user_count_broadcaster, get_sharded_groups, get_chat_archive):
+            cached.cache_clear()
+        self.addCleanup(get_chat_archive.cache_clear)
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        archive_settings = override_settings(CHAT_ARCHIVE={'ENABLED': True, 'ROOT': root, 'AFTER_DAYS': 180})
+        archive_settings.enable()
+        self.addCleanup(archive_settings.disable)
+        self.user = Account.objects.create_user("alice@codenames.com", "alice", "password")
+        self.lobby = PublicChatRoom.objects.create(title="lobby")
+        old = timezone.now() - timedelta(days=400)
+        PublicRoomChatMessage.objects.bulk_create(
+            [PublicRoomChatMessage(user=self.user, room=self.lobby, content=f"archived {i}", timestamp=old + timedelta(minutes=i)) for i in range(40)]
+            + [PublicRoomChatMessage(user=self.user, room=self.lobby, content=f"recent {i}") for i in range(5)]
+        )
+        call_command('archive_chat_messages', stdout=io.StringIO())
+        self.assertEqual(PublicRoomChatMessage.objects.count(), 5)
+
+    def test_cursor_pages_go_on_into_the_archive(self):
+        async def run():
+            communicator = WebsocketCommunicator(MultiplexChatConsumer.as_asgi(), "/chat/")
+            communicator.scope['user'] = self.user
+            await communicator.connect()
+            pages = []
+            cursor = None
+            while True:
+                await communicator.send_json_to({'command': 'get_chatroom_messages', 'room': self.lobby.room_tag, 'before': cursor})
+                frame = await communicator.receive_json_from()
+                pages.append([message['message'] for message in frame['messages']])
+                cursor = frame['next_cursor']
+                if cursor is None:
+                    break
+            await communicator.disconnect()
+            return pages
+        pages = async_to_sync(run)()
+        self.assertEqual([len(page) for page in pages], [DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE, 45 - DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE])
+        self.assertEqual(
+            [message for page in pages for message in page],
+            sorted([f"recent {i}" for i in range(5)], reverse=True) + [f"archived {i}" for i in range(39, -1, -1)],
+        )
+
+
+class FakeRedisPool:
+    """
+    Redis connections answering every script with 1 (first / last connection)
+    """
+
+    @asynccontextmanager
+    async def connection(self):
+        yield self
+
+    async def eval(self, script, keys=None, args=None):
+        await asyncio.sleep(0)
+        return 1
+
+
+class WriteBehindDirectInsertTest(TransactionTestCase):
+    """
+    (database_sync_to_async closes the connection, no TestCase transaction)
+    """
+
+    def test_failed_direct_insert_is_a_client_error(self):
+        user = Account.objects.create_user("alice@codenames.com", "alice", "password")
+        room = PublicChatRoom.objects.create(title="lobby")
+        buffer = ChatMessageWriteBehindBuffer(PublicRoomChatMessage, 10, 0.2, 0, 0, max_depth=0)
+        async def run():
+            await buffer.append(user=user, room=room, content="saved")
+            # NOT NULL content: the insert fails
+            await buffer.append(user=user, room=room, content=None)
+        with self.assertLogs('public_chat.write_behind', 'ERROR') as logs, self.assertRaises(ClientError) as error:
+            async_to_sync(run)()
+        self.assertEqual(error.exception.code, 503)
+        self.assertEqual([record.getMessage() for record in logs.records], ["write_behind_direct_insert_failed"])
+        self.assertEqual(list(PublicRoomChatMessage.objects.values_list('content', flat=True)), ["saved"])
+        self.assertEqual(buffer.stats()['direct_inserts'], 2)
+
+
+class RedisPresenceHeartbeatTest(SimpleTestCase):
+
+    def test_one_heartbeat_while_connected(self):
+        async def run():
+            store = RedisPresenceStore(worker_ttl=30)
+            store.redis = FakeRedisPool()
+            beats = []
+            async def heartbeat():
+                beats.append(time.monotonic())
+                await asyncio.sleep(0.01)
+            store.heartbeat = heartbeat
+            # concurrent first connections: one heartbeat started, all wait for its first beat
+            await asyncio.gather(*(store.add("PublicChatRoom-1", user_id) for user_id in range(5)))
+            task = store.heartbeat_task
+            started = (len(beats), task.done(), store.local_connections)
+            for user_id in range(4):
+                await store.remove("PublicChatRoom-1", user_id)
+            self.assertFalse(task.done())
+            await store.remove("PublicChatRoom-1", 4)
+            await asyncio.sleep(0)
+            return started, task.cancelled(), store.heartbeat_task
+        started, cancelled, heartbeat_task = async_to_sync(run)()
+        self.assertEqual(started, (1, False, 5))
+        # no connection left on this worker: the heartbeat stops
+        self.assertTrue(cancelled)
+        self.assertIsNone(heartbeat_task)
+
+
+@override_settings(PRESENCE_STORE={'BACKEND': 'public_chat.presence.InMemoryPresenceStore'})
+class ShardedGroupsTest(TestCase):
+
+    def setUp(self):
+        get_presence_store.cache_clear()
+        self.store = InMemoryShardCountStore()
+        self.groups = ShardedGroups(True, 2, 4, self.store)
+
+    def test_shards_grow_with_members(self):
+        self.assertEqual([self.groups.shards_for(members) for members in (0, 2, 3, 5, 8, 9, 100)], [1, 1, 2, 4, 4, 4, 4])
+
+    def test_every_member_receives(self):
+        async def run():
+            layer = InMemoryChannelLayer()
+            presence = get_presence_store()
+            channels = []
+            for user_id in range(10):
+                await presence.add("PublicChatRoom-1", user_id)
+                channels.append(await layer.new_channel())
+                await self.groups.add(layer, "PublicChatRoom-1", channels[-1])
+            await self.groups.send(layer, "PublicChatRoom-1", {"type": "chat.message", "text": "hello"})
+            return [(await layer.receive(channel))["text"] for channel in channels]
+        self.assertEqual(async_to_sync(run)(), ["hello"] * 10)
+        self.assertEqual(self.groups.stats()['max_shards'], 4)
+
+    def test_shard_count_kept_until_the_room_empties(self):
+        async def run():
+            layer = InMemoryChannelLayer()
+            presence = get_presence_store()
+            joined = []
+            for user_id in range(10):
+                await presence.add("PublicChatRoom-1", user_id)
+                channel = await layer.new_channel()
+                joined.append((user_id, channel, await self.groups.add(layer, "PublicChatRoom-1", channel)))
+            # everyone but the members of the last sub-group leaves
+            last = max(group for _, _, group in joined)
+            staying = [(user_id, channel, group) for user_id, channel, group in joined if group == last]
+            for user_id, channel, group in joined:
+                if group != last:
+                    await self.groups.discard(layer, "PublicChatRoom-1", group, channel)
+                    await presence.remove("PublicChatRoom-1", user_id)
+            shards_left = await self.store.get("PublicChatRoom-1")
+            await self.groups.send(layer, "PublicChatRoom-1", {"type": "chat.message", "text": "still here"})
+            received = [(await layer.receive(channel))["text"] for _, channel, _ in staying]
+            for user_id, channel, group in staying:
+                await self.groups.discard(layer, "PublicChatRoom-1", group, channel)
+                await presence.remove("PublicChatRoom-1", user_id)
+            return last, shards_left, received, await self.store.get("PublicChatRoom-1")
+        last, shards_left, received, shards_empty = async_to_sync(run)()
+        # a sub-group, not reached if the shard count went back to 1
+        self.assertNotEqual(last, "PublicChatRoom-1")
+        self.assertEqual(shards_left, 4)
+        self.assertEqual(received, ["still here"] * len(received))
+        # the last socket gone, the room goes back to one group
+        self.assertEqual(shards_empty, 1)
+        self.assertEqual(self.store.members, {})
+
+
+class LocalFanoutTest(TestCase):
+    """
+    Two processes sharing one in-memory layer: each event reaches every member once,
+    through the layer once per process, in the same order everywhere.
+    """
+
+    def test_exactly_once_per_member(self):
+        async def run():
+            first, second = LocalFanoutInMemoryChannelLayer(), LocalFanoutInMemoryChannelLayer()
+            # the same layer state, as with redis
+            second.channels, second.groups = first.channels, first.groups
+            members = [(layer, await layer.new_channel()) for layer in (first, first, first, second, second)]
+            for layer, channel in members:
+                await layer.group_add("PublicChatRoom-1", channel)
+            self.assertEqual(len(first.groups["PublicChatRoom-1"]), 2)
+
+            for i in range(3):
+                await first.group_send("PublicChatRoom-1", {"type": "chat.message", "text": f"from first {i}"})
+                await second.group_send("PublicChatRoom-1", {"type": "chat.message", "text": f"from second {i}"})
+            received = [[(await layer.receive(channel))["text"] for _ in range(6)] for layer, channel in members]
+
+            await members[0][0].group_discard("PublicChatRoom-1", members[0][1])
+            await second.group_send("PublicChatRoom-1", {"type": "chat.message", "text": "after leave"})
+            await asyncio.sleep(0.01)
+            left = first.local_inboxes[members[0][1]].qsize()
+            for layer in (first, second):
+                layer.relay_task.cancel()
+            return received, left
+        received, left = async_to_sync(run)()
+        # senders of different processes interleaved the same way for every member
+        self.assertEqual(received, [received[0]] * len(received))
+        self.assertEqual(received[0], [f"from {sender} {i}" for i in range(3) for sender in ("first", "second")])
+        self.assertEqual(left, 0)
+
+    def test_bound_to_one_event_loop(self):
+        layer = LocalFanoutInMemoryChannelLayer()
+        channel = async_to_sync(layer.new_channel)()
+        # the channel can only be read from its loop
+        with self.assertRaises(RuntimeError):
+            async_to_sync(layer.receive)(channel)
+        self.assertIn(channel, layer.local_inboxes)
+        layer.local_forget(channel)
+        # empty again: usable from another loop
+        self.assertTrue(async_to_sync(layer.new_channel)())
@@ -0,0 +1,7 @@
+from django.urls import path
+from public_chat.views import LogLevelView
+
+
+urlpatterns = [
+    path('log-levels/', LogLevelView.as_view(), name='chat-log-levels'),
+]
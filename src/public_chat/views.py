@@ -1,3 +1,72 @@
-from django.shortcuts import render
+import os
 
-# Create your views here.
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from rest_framework.permissions import IsAdminUser
+
+from codenames_api.log import get_log_levels, set_log_level
+
+
+class LogLevelView(APIView):
+    """
+    Log levels of the chat subsystems (staff only).
+    GET: {logger name: level}
+    POST {"logger": "public_chat.consumers", "level": "DEBUG"}: change a level at runtime
+    Levels live in the process answering the request: with several workers (daphne
+    processes behind a load balancer) the other processes keep their level, the
+    response names the process ('pid') that was read or changed.
+    """
+
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        status_code = status.HTTP_200_OK
+        response = JSONRenderer().render({
+            'success': True,
+            'status_code': status_code,
+            'message': "Log levels of this process.",
+            'pid': os.getpid(),
+            'levels': get_log_levels(),
+        })
+        return Response(response, status=status_code)
+
+    def post(self, request):
+        name = request.data.get('logger')
+        level = request.data.get('level')
+        if not isinstance(name, str) or not isinstance(level, str):
+            status_code = status.HTTP_400_BAD_REQUEST
+            response = JSONRenderer().render({
+                'success': False,
+                'status_code': status_code,
+                'message': "logger and level must be strings."
+            })
+            return Response(response, status=status_code)
+        if not name or name.split('.')[0] not in ('public_chat', 'private_chat'):
+            status_code = status.HTTP_400_BAD_REQUEST
+            response = JSONRenderer().render({
+                'success': False,
+                'status_code': status_code,
+                'message': "Unknown logger."
+            })
+            return Response(response, status=status_code)
+        try:
+            set_log_level(name, level)
+        except ValueError as e:
+            status_code = status.HTTP_400_BAD_REQUEST
+            response = JSONRenderer().render({
+                'success': False,
+                'status_code': status_code,
+                'message': str(e)
+            })
+            return Response(response, status=status_code)
+        status_code = status.HTTP_200_OK
+        response = JSONRenderer().render({
+            'success': True,
+            'status_code': status_code,
+            'message': f"Log level of {name} changed in this process only.",
+            'pid': os.getpid(),
+            'levels': get_log_levels(),
+        })
+        return Response(response, status=status_code)
@@ -0,0 +1,256 @@
+import asyncio
+import atexit
+import sys
+from functools import lru_cache
+
+from django.conf import settings
+from django.dispatch import Signal
+from django.utils import timezone
+
+from codenames_api.log import get_logger
+from codenames_api.metrics import (
+    WRITE_BEHIND_DEPTH,
+    WRITE_BEHIND_DIRECT_INSERTS,
+    WRITE_BEHIND_DROPPED,
+    WRITE_BEHIND_FAILED_FLUSHES,
+    WRITE_BEHIND_FLUSHED,
+    WRITE_BEHIND_REQUEUED,
+    metered_database_sync_to_async,
+)
+from private_chat.exceptions import ClientError
+
+
+log = get_logger(__name__)
+
+# sent (sender: the message model, messages: the batch) once a batch is inserted,
+# bulk_create sends no post_save
+messages_flushed = Signal(providing_args=["messages"])
+
+DEFAULT_CHAT_MESSAGE_WRITE_BEHIND = {
+    'ENABLED': False,
+    'BATCH_SIZE': 100,        # flush as soon as this many messages are waiting
+    'FLUSH_INTERVAL': 0.2,    # seconds, flush at least this often while messages are waiting
+    'MAX_RETRIES': 3,         # failed flushes of a batch before it goes back to the buffer
+    'RETRY_DELAY': 0.5,       # seconds, doubled on every retry
+    'MAX_DEPTH': 10000,       # messages waiting before the new ones are inserted right away
+}
+
+
+def get_write_behind_config():
+    config = dict(DEFAULT_CHAT_MESSAGE_WRITE_BEHIND)
+    config.update(getattr(settings, 'CHAT_MESSAGE_WRITE_BEHIND', {}))
+    return config
+
+
+def is_write_behind_enabled():
+    return get_write_behind_config()['ENABLED']
+
+
+class ChatMessageWriteBehindBuffer:
+    """
+    In-process buffer of chat messages waiting to be inserted.
+    Messages are broadcast right away by the consumers and saved here later
+    with one bulk_create per batch, on a size or time threshold.
+    - the timestamp of a message is set when it is queued (send time), not at the insert
+    - a failed batch is retried with a growing delay, then put back at the head of
+      the buffer (order is kept) and retried with the next flush: nothing is dropped
+      while the process lives
+    - past MAX_DEPTH waiting messages (database down or too slow) new messages are
+      inserted right away, the sender waits for its insert as without write-behind
+      and gets a ClientError if it fails (its socket stays open)
+    - the buffer is drained before the Daphne worker stops (drain_on_shutdown),
+      and synchronously at exit for what is left
+    - depth is exported by the chat_write_behind_depth gauge
+    """
+
+    def __init__(self, model, batch_size, flush_interval, max_retries, retry_delay, max_depth):
+        self.model = model
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_depth = max_depth
+        self.buffer = []
+        self.flushing = 0          # messages of the batch being inserted right now
+        self.flush_task = None
+        self.batch_ready = None
+        self.lock = None
+        self.flushed = 0
+        self.failed_flushes = 0
+        self.requeued = 0
+        self.direct_inserts = 0
+        self.dropped = 0
+        atexit.register(self.drain_sync)
+
+    @property
+    def label(self):
+        return self.model.__name__
+
+    @property
+    def depth(self):
+        """
+        Number of messages not saved yet
+        """
+        return len(self.buffer) + self.flushing
+
+    def report_depth(self):
+        WRITE_BEHIND_DEPTH.set(self.depth, model=self.label)
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'flushed': self.flushed,
+            'failed_flushes': self.failed_flushes,
+            'requeued': self.requeued,
+            'direct_inserts': self.direct_inserts,
+            'dropped': self.dropped,
+        }
+
+    async def append(self, **fields):
+        """
+        Queue a message, same kwargs as Model.objects.create. return the message (not saved yet)
+        ClientError if the buffer is full and the direct insert fails.
+        """
+        fields.setdefault('timestamp', timezone.now())
+        message = self.model(**fields)
+        if self.depth >= self.max_depth:
+            # the buffer does not grow without limit while the database is down
+            self.direct_inserts += 1
+            WRITE_BEHIND_DIRECT_INSERTS.inc(model=self.label)
+            try:
+                await bulk_insert(self.model, [message])
+            except Exception as e:
+                log.error("write_behind_direct_insert_failed", model=self.label, depth=self.depth, error=str(e))
+                # HTTPstatus 503, not broadcast: the sender can send it again
+                raise ClientError(503, "Your message could not be saved, try again later.")
+            return message
+        self.buffer.append(message)
+        self.report_depth()
+        if self.batch_ready is None:
+            self.batch_ready = asyncio.Event()
+        if len(self.buffer) >= self.batch_size:
+            self.batch_ready.set()
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.ensure_future(self.run())
+        return message
+
+    async def run(self):
+        """
+        Flush on BATCH_SIZE or every FLUSH_INTERVAL until the buffer is empty.
+        """
+        while self.buffer:
+            try:
+                await asyncio.wait_for(self.batch_ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.batch_ready.clear()
+            await self.flush()
+
+    async def flush(self):
+        """
+        Insert the next batch, retrying it on failure.
+        return False if it went back to the buffer
+        """
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            batch = self.buffer[:self.batch_size]
+            del self.buffer[:self.batch_size]
+            self.flushing = len(batch)
+            try:
+                for attempt in range(self.max_retries + 1):
+                    try:
+                        await bulk_insert(self.model, batch)
+                        self.flushed += len(batch)
+                        WRITE_BEHIND_FLUSHED.inc(len(batch), model=self.label)
+                        return True
+                    except Exception as e:
+                        self.failed_flushes += 1
+                        WRITE_BEHIND_FAILED_FLUSHES.inc(model=self.label)
+                        log.warning("write_behind_flush_failed", model=self.label, size=len(batch), attempt=attempt + 1, error=str(e))
+                        if attempt < self.max_retries:
+                            await asyncio.sleep(self.retry_delay * (2 ** attempt))
+                # already broadcast: never dropped, back at the head of the buffer
+                self.buffer[:0] = batch
+                self.requeued += len(batch)
+                WRITE_BEHIND_REQUEUED.inc(len(batch), model=self.label)
+                log.error("write_behind_requeued", model=self.label, size=len(batch), depth=len(self.buffer))
+                return False
+            finally:
+                self.flushing = 0
+                self.report_depth()
+
+    async def drain(self):
+        """
+        Flush everything still waiting (graceful shutdown).
+        Stops at the first batch failing all its retries, drain_sync tries it again at exit.
+        """
+        while self.buffer:
+            if not await self.flush():
+                break
+
+    def drain_sync(self):
+        """
+        atexit hook: the event loop is gone, insert what is left from this thread.
+        """
+        batch, self.buffer = self.buffer, []
+        if not batch:
+            return
+        try:
+            self.model.objects.bulk_create(batch, batch_size=self.batch_size)
+            self.flushed += len(batch)
+            messages_flushed.send(sender=self.model, messages=batch)
+        except Exception:
+            self.dropped += len(batch)
+            WRITE_BEHIND_DROPPED.inc(len(batch), model=self.label)
+            log.exception("write_behind_drain_failed", model=self.label, size=len(batch))
+
+
+@metered_database_sync_to_async
+def bulk_insert(model, batch):
+    model.objects.bulk_create(batch)
+    messages_flushed.send(sender=model, messages=batch)
+
+
+async def drain_all():
+    for buffer in list(buffers):
+        try:
+            await buffer.drain()
+        except Exception:
+            log.exception("write_behind_drain_failed", model=buffer.label)
+
+
+def drain_on_shutdown():
+    """
+    Drain the buffers before the Daphne worker stops: a "before shutdown" trigger of
+    its Twisted reactor, run while the event loop still works (Daphne closes the
+    sockets in the same phase). Nothing to do outside Daphne, atexit still drains.
+    """
+    if 'twisted.internet.reactor' not in sys.modules:
+        return
+    from twisted.internet import defer, reactor
+    reactor.addSystemEventTrigger('before', 'shutdown', lambda: defer.Deferred.fromFuture(asyncio.ensure_future(drain_all())))
+
+
+# every buffer of the process
+buffers = []
+
+
+@lru_cache(maxsize=None)
+def get_write_behind_buffer(model):
+    """
+    One buffer per message model, configured by settings.CHAT_MESSAGE_WRITE_BEHIND
+    """
+    config = get_write_behind_config()
+    buffer = ChatMessageWriteBehindBuffer(
+        model,
+        batch_size=config['BATCH_SIZE'],
+        flush_interval=config['FLUSH_INTERVAL'],
+        max_retries=config['MAX_RETRIES'],
+        retry_delay=config['RETRY_DELAY'],
+        max_depth=config['MAX_DEPTH'],
+    )
+    if not buffers:
+        drain_on_shutdown()
+    buffers.append(buffer)
+    return buffer